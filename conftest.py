@@ -0,0 +1,26 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+AI_SERVICE_DIR = os.path.join(os.path.dirname(__file__), "src", "main", "java", "tan", "fandbaispring", "ai-service")
+sys.path.insert(0, AI_SERVICE_DIR)
+
+# Script gọi service đang chạy ở localhost:8000, không phải unit test
+collect_ignore = ["test_ai_service.py", os.path.join(AI_SERVICE_DIR, "test_service.py")]
+
+
+@pytest.fixture(scope="session")
+def ai_service(tmp_path_factory):
+    """ai_service_gemini import offline: embeddings hashing, Chroma/SQLite/log ghi vào thư mục tạm."""
+    os.environ.setdefault("GOOGLE_API_KEY", "test")
+    os.environ.setdefault("EMBEDDING_PROVIDER", "hashing")
+    os.environ.setdefault("INDEX_QUEUE_ENABLED", "false")
+    os.environ["ANONYMIZED_TELEMETRY"] = "False"
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("ai_service"))
+    try:
+        yield importlib.import_module("ai_service_gemini")
+    finally:
+        os.chdir(cwd)
@@ -1,21 +1,52 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_chroma import Chroma
 from chromadb import PersistentClient
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from local_embeddings import LOCAL_PROVIDERS, local_embeddings_from_env
+from vn_gazetteer import PlaceMatcher, alias_key, build_gazetteer, fold
+from amenity_vocab import AmenityVocabulary
+from inventory import InventoryCalendar, fetch_inventory, stay_nights
+from metrics import METRICS, Counter, Histogram, record_cache, render_metrics
+from bulkheads import (CHROMA_BULKHEAD, EMBEDDINGS_BULKHEAD, LLM_BULKHEAD, LOAD_SHED_RETRY_AFTER_S, POSTGRES_BULKHEAD,
+                       AdmissionMiddleware, Overloaded, load_stats)
+from deadlines import (DEADLINE_RESERVE_MS, PARTIAL_RESULT_HEADER, DeadlineExceeded, await_within_budget, check_budget,
+                       mark_partial, optional_stage)
+from change_sync import CDC_SYNC_MODE, ChangeSync
+from db import DB_CONFIG, connect
+from embedding_batcher import EMBED_BATCH_WINDOW_MS, BatchingEmbeddings, embed_query_batch
+from facets import FACET_AMENITY_OPTIONS, FACET_PRICE_BUCKETS, FacetIndex, as_int
+from index_queue import INDEX_BATCH_SIZE, INDEX_QUEUE_ENABLED, INDEX_QUEUE_PATH, IndexQueue
+from quantized_index import (VECTOR_DIMS, VECTOR_FLOAT_PATH, VECTOR_REDUCTION, VECTOR_RERANK_POOL,
+                             VECTOR_STORAGE_MODE, QuantizedIndex)
+from search_planner import (PLANNER_SQL_COOLDOWN_S, PLANNER_SQL_MAX_IDS, PLANNER_STATS_TTL_S, SEARCH_PLANNER_MODE,
+                            SEARCH_PLANS, CatalogStats, choose_search_plan)
+from single_flight import SingleFlight, flight_key
+from tracing import REQUEST_ID_HEADER, RequestTrace, current_trace, export_slow_trace, stage_timer, timed_operation
 import json
 import os
-import psycopg2 
 from typing import Dict, Any, List, Optional
 import logging
 from dotenv import load_dotenv
 import unicodedata
 import warnings
 import re
-from datetime import datetime, timedelta
+import time
+import threading
+import functools
+import hashlib
+import uuid
+import sqlite3
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from collections import OrderedDict
+from contextlib import closing, asynccontextmanager
+from datetime import date, datetime, timedelta
 from langchain_core._api import LangChainDeprecationWarning
 warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
 
@@ -30,24 +61,104 @@ if not os.getenv("GOOGLE_API_KEY"):
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app):
+    start_background_workers()
+    try:
+        yield
+    finally:
+        stop_background_workers()
 
-# *** SỬA LỖI DB_CONFIG: Tách host và port để khớp với psycopg2 ***
-db_host, db_port = "localhost", 5432 # Mặc định
-if ":" in "localhost:5432":
-    db_host, db_port_str = "localhost:5432".split(":")
-    db_port = int(db_port_str)
 
-DB_CONFIG = {
-    "host": db_host, 
-    "port": db_port, # Thêm port
-    "database": "fast_planner_db",
-    "user": "postgres",
-    "password": "root" 
-}
+app = FastAPI(lifespan=lifespan)
 
 CHROMA_PATH = "./chroma_db_gemini"
 
+# Embedding: "google" (API, mặc định) | "hashing" (tất định, không cần mạng) | "local" (sentence-transformers CPU).
+# Mỗi provider cục bộ dùng collection riêng (hậu tố theo model) → gọi POST /reindex sau khi đổi
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "google").strip().lower()
+CHROMA_COLLECTION = "fast_planner_establishments"
+
+# Chế độ index: "single" = 1 document/cơ sở; "chunked" = nhiều chunk (tổng quan, tiện ích, đoạn mô tả)
+# cùng parent id, khi tìm kiếm gộp điểm các chunk theo cơ sở (max hoặc sum)
+INDEX_CHUNK_MODE = os.getenv("INDEX_CHUNK_MODE", "single").strip().lower()
+CHUNK_SCORE_AGG = os.getenv("CHUNK_SCORE_AGG", "max").strip().lower()
+CHUNK_MAX_CHARS = int(os.getenv("CHUNK_MAX_CHARS", "600"))
+SEARCH_K = int(os.getenv("SEARCH_K", "40" if INDEX_CHUNK_MODE == "chunked" else "100"))
+# Phân mảnh: "single" = một collection; "city" = một collection/city (POST /reindex sau khi bật)
+INDEX_SHARD_MODE = os.getenv("INDEX_SHARD_MODE", "single").strip().lower()
+SHARD_FANOUT_WORKERS = int(os.getenv("SHARD_FANOUT_WORKERS", "8"))
+
+# --- METRICS (registry trong metrics.py, xuất dạng Prometheus text tại /metrics) ---
+LLM_TOKENS = Counter("ai_llm_tokens_total", "Số token LLM (input/output)", ("operation", "kind"))
+QUIZ_FALLBACKS = Counter("ai_quiz_fallback_total", "Số lần quiz dùng trích xuất tất định do lỗi provider", ("reason",))
+LLM_REQUEST_TOKENS = Histogram("ai_llm_request_tokens", "Token LLM mỗi request (ước lượng nếu provider không trả usage)",
+                               ("operation", "prompt", "kind"), buckets=(25, 50, 100, 200, 400, 800, 1600, 3200, 6400))
+METRICS += [LLM_TOKENS, LLM_REQUEST_TOKENS, QUIZ_FALLBACKS]
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    # Ước lượng thô khi provider không trả usage_metadata (~3 ký tự/token với tiếng Việt có dấu)
+    return (len(text or "") + 2) // 3
+
+
+def record_llm_usage(operation: str, message: Any, prompt_text: Optional[str] = None, prompt: str = "") -> Dict[str, int]:
+    """Cộng token thật vào counter; nếu có prompt_text thì ghi thêm token/request (thật hoặc ước lượng)."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage.get("input_tokens"):
+        LLM_TOKENS.inc(usage["input_tokens"], operation=operation, kind="input")
+    if usage.get("output_tokens"):
+        LLM_TOKENS.inc(usage["output_tokens"], operation=operation, kind="output")
+    if prompt_text is None:
+        return {}
+    tokens = {
+        "input": int(usage.get("input_tokens") or estimate_tokens(prompt_text)),
+        "output": int(usage.get("output_tokens") or estimate_tokens(str(getattr(message, "content", "") or ""))),
+    }
+    for kind, n in tokens.items():
+        LLM_REQUEST_TOKENS.observe(n, operation=operation, prompt=prompt, kind=kind)
+    tokens["estimated"] = int(not usage.get("input_tokens"))
+    return tokens
+
+
+# --- DEADLINE + HUỶ THEO REQUEST (deadlines.py) ---
+
+
+# --- ADMISSION CONTROL + BULKHEAD theo dependency (bulkheads.py) ---
+# --- TRACING (tracing.py): request id + span theo từng bước, log request chậm ra JSONL/OTLP ---
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    trace = RequestTrace(request_id, request.method, request.url.path)
+    token = current_trace.set(trace)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+    finally:
+        current_trace.reset(token)
+        export_slow_trace(trace, status_code)
+
+
+# Thêm sau tracing → chạy trước: request bị từ chối không tốn gì thêm
+app.add_middleware(AdmissionMiddleware)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_handler(_request: Request, exc: DeadlineExceeded):
+    # 499: client đã ngắt kết nối (không ai đọc phản hồi này)
+    status_code = 499 if exc.reason == "client_disconnected" else 504
+    return JSONResponse(status_code=status_code, content={"detail": f"Request bị huỷ: {exc.reason}"})
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(_request: Request, exc: Overloaded):
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)},
+                        headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER_S)})
+
+
 # Khởi tạo LLM và Vector Store (có fallback)
 llm = None
 embeddings = None
@@ -65,10 +176,17 @@ except Exception as e1:
         llm = None
 
 try:
-    embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004")
+    if EMBEDDING_PROVIDER in LOCAL_PROVIDERS:
+        embeddings = local_embeddings_from_env(EMBEDDING_PROVIDER)
+        collection_name = f"{CHROMA_COLLECTION}_{embeddings.collection_tag}"
+    else:
+        embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004")
+        collection_name = CHROMA_COLLECTION
+    if EMBED_BATCH_WINDOW_MS > 0:
+        embeddings = BatchingEmbeddings(embeddings)
     chroma_client = PersistentClient(path=CHROMA_PATH)
     vectorstore = Chroma(
-        collection_name="fast_planner_establishments",
+        collection_name=collection_name,
         embedding_function=embeddings,
         client=chroma_client
     )
@@ -84,6 +202,8 @@ class QuizRequest(BaseModel):
     # SỬA LỖI: Sử dụng alias để ánh xạ từ Java camelCase sang Python snake_case
     user_prompt: str = Field(..., alias="userPrompt")
     current_params: Dict[str, Any] = Field(..., alias="currentParams")
+    # Tuỳ chọn: có session_id thì server giữ tham số đã chuẩn hoá, currentParams chỉ cần phần thay đổi
+    session_id: Optional[str] = Field(None, alias="sessionId")
 
     class Config:
         # Cấu hình Pydantic để chấp nhận tên trường theo alias khi deserialize (input)
@@ -105,6 +225,7 @@ class QuizResponseModel(BaseModel):
     final_params: Dict[str, Any] = Field(description="Các tham số đã được cập nhật và chuẩn hóa.")
     image_options: Optional[List[ImageOption]] = Field(default=None, description="Các lựa chọn dạng thẻ ảnh cho câu hỏi hiện tại")
     options: Optional[List[str]] = Field(default=None, description="Các lựa chọn dạng text/tag cho câu hỏi hiện tại")
+    session_id: Optional[str] = Field(default=None, description="Phiên quiz phía server (nếu client gửi sessionId)")
 
 # Danh sách tham số cốt lõi (dùng cho cả fallback)
 PARAM_ORDER = [
@@ -121,6 +242,9 @@ def effective_param_order(final_params: Dict[str, Any]) -> list[str]:
         if str(est_type).upper() == "RESTAURANT":
             # Nhà hàng: không hỏi số đêm
             order = [k for k in order if k != "duration"]
+        if (final_params or {}).get("date_from"):
+            # Ngày linh hoạt: không hỏi ngày nhận phòng cố định
+            order = [k for k in order if k != "check_in_date"]
         return order
     except Exception:
         return list(PARAM_ORDER)
@@ -144,6 +268,18 @@ FALLBACK_OPTIONS = {
 }
 
 
+def establishment_where(city: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Điều kiện where để lấy MỘT document/cơ sở (ở chế độ chunked chỉ lấy chunk tổng quan)."""
+    conds: List[Dict[str, Any]] = []
+    if city:
+        conds.append({"city": city})
+    if INDEX_CHUNK_MODE == "chunked":
+        conds.append({"chunk_type": "summary"})
+    if not conds:
+        return None
+    return conds[0] if len(conds) == 1 else {"$and": conds}
+
+
 def image_options_from_real_data(param_key: str, final_params: Dict[str, Any]) -> Optional[List[ImageOption]]:
     """Gợi ý ảnh từ dữ liệu thật trong Chroma metadata (ưu tiên theo city)."""
     try:
@@ -151,7 +287,7 @@ def image_options_from_real_data(param_key: str, final_params: Dict[str, Any]) -
             return None
         # Lấy 12 cơ sở ở city nếu có
         city = (final_params or {}).get("city")
-        where = {"city": city} if city else None
+        where = establishment_where(city)
         coll = vectorstore._collection  # type: ignore
         ids = coll.get(where=where, include=["metadatas", "documents"], limit=12)
         metas = ids.get("metadatas") or []
@@ -176,7 +312,7 @@ def detect_brand_name(mixed_text: str, city: Optional[str]) -> Optional[str]:
         if vectorstore is None:
             return None
         coll = vectorstore._collection  # type: ignore
-        where = {"city": city} if city else None
+        where = establishment_where(city)
         data = coll.get(where=where, include=["metadatas"], limit=50)
         metas = data.get("metadatas") or []
         text_lc = (mixed_text or "").lower()
@@ -199,53 +335,82 @@ def detect_brand_name(mixed_text: str, city: Optional[str]) -> Optional[str]:
 def strip_accents(s: Optional[str]) -> str:
     if not s:
         return ""
+    # Giữ nguyên "đ" (NFD không tách được): so khớp địa danh/tiện ích/từ khoá dùng vn_gazetteer.fold (đ → d)
     return ''.join(c for c in unicodedata.normalize('NFD', str(s).strip()) if unicodedata.category(c) != 'Mn').lower()
 
-# canonical -> display
-CITY_DISPLAY = {
-    "danang": "Đà Nẵng",
-    "hanoi": "Hà Nội",
-    "hochiminh": "Hồ Chí Minh",
-    "nhatrang": "Nha Trang",
-    "dalat": "Đà Lạt",
-    "hue": "Huế",
-    "cantho": "Cần Thơ",
-}
-
-# aliases -> canonical
-CITY_ALIASES = {
-    "da nang": "danang",
-    "danang": "danang",
-    "dn": "danang",
-    "ha noi": "hanoi",
-    "hanoi": "hanoi",
-    "ho chi minh": "hochiminh",
-    "tp ho chi minh": "hochiminh",
-    "tphcm": "hochiminh",
-    "hcm": "hochiminh",
-    "sai gon": "hochiminh",
-    "saigon": "hochiminh",
-    "nha trang": "nhatrang",
-    "nhatrang": "nhatrang",
-    "da lat": "dalat",
-    "dalat": "dalat",
-}
+# canonical -> display, aliases -> canonical: toàn bộ tỉnh/thành + điểm du lịch (vn_gazetteer.py)
+CITY_DISPLAY, CITY_ALIASES, _CITY_ACCENTED = build_gazetteer()
+_city_matcher = PlaceMatcher(CITY_ALIASES, _CITY_ACCENTED)
 
 def infer_city_from_text(text: str) -> Optional[str]:
-    t = strip_accents(text)
-    # tìm alias dài trước để tránh va chạm
-    for alias in sorted(CITY_ALIASES.keys(), key=len, reverse=True):
-        if alias in t:
-            canonical = CITY_ALIASES[alias]
-            return CITY_DISPLAY.get(canonical, canonical)
-    return None
+    # Một lượt duyệt trie trên văn bản đã bỏ dấu; alias dài nhất thắng để tránh va chạm ("thua thien hue" > "hue")
+    canonical = _city_matcher.find(text)
+    return CITY_DISPLAY.get(canonical, canonical) if canonical else None
+
 
+_FLEX_MONTH_RE = re.compile(r"\bthang\s*(\d{1,2})\b")
+_FLEX_NIGHTS_RE = re.compile(r"(\d+)\s*(dem|ngay)\b")
 
-def normalize_params(final_params: Dict[str, Any], user_prompt: str) -> Dict[str, Any]:
-    """Chuẩn hóa: tách brand name nếu phát hiện."""
+
+def infer_flexible_dates(text: Optional[str], today: Optional[date] = None) -> Dict[str, Any]:
+    """Khoảng ngày nhận phòng linh hoạt từ câu tự nhiên: {"date_from", "date_to", "weekend_only"?, "duration"?}.
+
+    "cuối tuần tháng 10" → nhận phòng T6/T7 trong tháng 10, 2 đêm; "3 đêm tháng sau" → cả tháng sau, 3 đêm.
+    Trả {} nếu câu không nhắc tới tháng/tuần/cuối tuần.
+    """
+    t = fold(text)
+    if not t:
+        return {}
+    today = today or datetime.now().date()
+    weekend = "cuoi tuan" in t or "weekend" in t
+    start: Optional[date] = None
+    end: Optional[date] = None
+    m = _FLEX_MONTH_RE.search(t)
+    if m and 1 <= int(m.group(1)) <= 12:
+        month = int(m.group(1))
+        start = date(today.year + (1 if month < today.month else 0), month, 1)
+    elif "thang sau" in t or "thang toi" in t:
+        start = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+    elif "thang nay" in t:
+        start = today.replace(day=1)
+    if start is not None:
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    elif "tuan sau" in t or "tuan toi" in t:
+        start = today + timedelta(days=7 - today.weekday())
+        end = start + timedelta(days=6)
+    elif weekend:
+        # "cuối tuần" không kèm tháng/tuần: hai cuối tuần sắp tới
+        start, end = today, today + timedelta(days=13)
+    if start is None or end is None:
+        return {}
+    start = max(start, today)
+    if end < start:
+        return {}
+    out: Dict[str, Any] = {"date_from": start.strftime("%Y-%m-%d"), "date_to": end.strftime("%Y-%m-%d")}
+    if weekend:
+        out["weekend_only"] = True
+    nights = _FLEX_NIGHTS_RE.search(t)
+    if nights and int(nights.group(1)) > 0:
+        out["duration"] = int(nights.group(1))
+    elif weekend:
+        out["duration"] = 2
+    return out
+
+
+def normalize_params(final_params: Dict[str, Any], user_prompt: str,
+                     previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Chuẩn hóa: tách brand name nếu phát hiện.
+
+    `previous` là tham số đã chuẩn hoá của phiên: city/tiện ích không đổi thì chỉ dò brand trong câu mới.
+    """
     params = dict(final_params or {})
     city = params.get("city")
     mixed = f"{user_prompt} {params.get('amenities_priority','')}"
+    unchanged = previous is not None and all(
+        previous.get(k) == params.get(k) for k in ("city", "amenities_priority")
+    )
+    if unchanged:
+        mixed = user_prompt or ""
     # Suy luận loại cơ sở từ prompt nếu có
     prompt_lc = (user_prompt or "").lower()
     if not params.get("establishment_type"):
@@ -334,6 +499,10 @@ def normalize_params(final_params: Dict[str, Any], user_prompt: str) -> Dict[str
     except Exception:
         # Bỏ qua lỗi parse ngày để không chặn luồng
         pass
+    # Chưa có ngày nhận phòng cố định: "cuối tuần tháng 10", "3 đêm tháng sau" → tìm theo ngày linh hoạt
+    if not params.get("check_in_date") and not params.get("date_from"):
+        for k, v in infer_flexible_dates(user_prompt).items():
+            params.setdefault(k, v)
 
     # --- Suy luận ngân sách tối đa (max_price) từ prompt: hỗ trợ 300k, 0.5tr, 1 triệu, 1.2m, 500.000đ, 500k vnd ---
     try:
@@ -367,9 +536,11 @@ def normalize_params(final_params: Dict[str, Any], user_prompt: str) -> Dict[str
                 params["max_price"] = price
     except Exception:
         pass
-    brand = detect_brand_name(mixed, city)
-    if brand:
-        params["brand_name"] = brand
+    if mixed.strip():
+        with stage_timer("generate_quiz", "detect_brand_name"):
+            brand = detect_brand_name(mixed, city)
+        if brand:
+            params["brand_name"] = brand
     # Chuẩn hoá cờ xác nhận tiện ích về boolean
     if "_amenities_confirmed" in params:
         try:
@@ -412,93 +583,315 @@ def apply_defaults(params: Dict[str, Any]) -> Dict[str, Any]:
 
 class SearchRequest(BaseModel):
     params: Dict[str, Any]
+    # Opt-in: trả thêm dữ liệu hiển thị card để FE/Java không phải gọi lại từng cơ sở (1 + N)
+    expand: bool = False
+
+class DateOption(BaseModel):
+    check_in_date: str
+    check_out_date: str
+    # Tổng giá rẻ nhất cho cả kỳ nghỉ (None nếu thiếu giá) và số phòng còn trống ít nhất trong các đêm
+    # (None nếu loại phòng không giới hạn số lượng)
+    min_total_price: Optional[int] = None
+    units_left: Optional[int] = None
 
 class SearchResult(BaseModel):
     establishment_id: str
     name: str
+    # Các trường mở rộng chỉ có khi SearchRequest.expand = true
+    image_url_main: Optional[str] = None
+    city: Optional[str] = None
+    type: Optional[str] = None
+    price_range_vnd: Optional[int] = None
+    star_rating: Optional[int] = None
+    score: Optional[float] = None
+    min_available_price: Optional[int] = None
+    # Chỉ có khi tìm theo ngày linh hoạt (params.date_from/date_to)
+    date_options: Optional[List[DateOption]] = None
 
 class AddEstablishmentRequest(BaseModel):
     id: str
 
 # --- Hàm Hỗ trợ: Truy vấn DB (Lấy dữ liệu cho RAG) ---
+establishment_flight = SingleFlight("fetch_establishment", copy_result=True)
+
+
 def fetch_single_establishment(establishment_id: str) -> Optional[Dict[str, Any]]:
-    """Truy vấn PostgreSQL để lấy data của một cơ sở mới."""
-    conn = None
-    data = None
+    """Truy vấn PostgreSQL để lấy data của một cơ sở mới (gộp các lời gọi trùng ID đang chạy)."""
+    return establishment_flight.do(str(establishment_id), lambda: query_single_establishment(establishment_id))
+
+
+@POSTGRES_BULKHEAD.guard
+def query_single_establishment(establishment_id: str) -> Optional[Dict[str, Any]]:
     try:
-        # DB_CONFIG đã được sửa để hoạt động với psycopg2
-        conn = psycopg2.connect(
-            host=DB_CONFIG['host'],
-            port=DB_CONFIG['port'],
-            database=DB_CONFIG['database'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password']
-        )
-        cur = conn.cursor()
+        with connect() as conn:
+            cur = conn.cursor()
+            data = select_establishments(cur, [str(establishment_id)]).get(str(establishment_id))
+            if not data:
+                logging.info("DB query returned 0 rows for id=%s", establishment_id)
+            return data
+    except Exception as error:
+        logging.error("DB error in query_single_establishment: %s", error)
+        return None
+
+def fetch_establishments_batch(establishment_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Như fetch_single_establishment nhưng cho nhiều ID trên một kết nối (dùng cho worker index)."""
+    if not establishment_ids:
+        return {}
+    try:
+        with connect() as conn:
+            cur = conn.cursor()
+            return select_establishments(cur, [str(i) for i in establishment_ids])
+    except Exception as error:
+        logging.error("DB error in fetch_establishments_batch: %s", error)
+        raise
+
+
+def select_establishments(cur, establishment_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Projection dùng chung cho đường đơn lẻ và theo lô: metadata trong Chroma giống nhau dù index bằng đường nào."""
+    out: Dict[str, Dict[str, Any]] = {}
+    cur.execute("""
+        SELECT 
+            id, name, type, price_range_vnd, star_rating, owner_id, description_long, city, image_url_main, is_available
+        FROM 
+            establishment
+        WHERE 
+            id = ANY(%s);
+    """, (list(establishment_ids),))
+    col_names = [desc[0] for desc in cur.description]
+    for row in cur.fetchall():
+        data = dict(zip(col_names, row))
+        data['amenities_list'] = ''
+        out[str(data['id'])] = data
+    if not out:
+        return out
+    # Lấy amenities từ bảng phụ (ElementCollection của JPA); thử tên column phổ biến do JPA sinh ra
+    amenities_by_id: Dict[str, List[str]] = {}
+    for column in ("amenities_list", "element"):
         try:
-            cur.execute("SET search_path TO public;")
+            cur.execute(f"""
+                SELECT establishment_id, {column} FROM establishment_amenities_list WHERE establishment_id = ANY(%s)
+            """, (list(out.keys()),))
         except Exception:
-            pass
-        
+            continue
+        # Lọc None/empty và ép về string để tránh lỗi join
+        for est_id, amen in cur.fetchall():
+            if amen is not None and str(amen).strip():
+                amenities_by_id.setdefault(str(est_id), []).append(str(amen).strip())
+        break
+    else:
+        logger.info("Amenities table not found with default names; skip amenities fetch")
+    for est_id, amenities in amenities_by_id.items():
+        out[est_id]['amenities_list'] = ", ".join(amenities)
+    # Sức chứa lớn nhất (cho facet quiz); bỏ qua nếu schema không có unit_type
+    try:
         cur.execute("""
-            SELECT 
-                id, name, type, price_range_vnd, star_rating, owner_id, description_long, city, image_url_main
-            FROM 
-                establishment
-            WHERE 
-                id = %s;
-        """, (establishment_id,))
-        
-        col_names = [desc[0] for desc in cur.description]
-        row = cur.fetchone()
-        if not row:
-            logging.info("DB query returned 0 rows for id=%s", establishment_id)
-        
-        if row:
-            data = dict(zip(col_names, row))
-            # Lấy amenities từ bảng phụ (ElementCollection của JPA)
-            amenities_raw: List[Any] = []
-            try:
-                # Thử tên bảng/column phổ biến do JPA sinh ra
-                cur.execute("""
-                    SELECT amenities_list FROM establishment_amenities_list WHERE establishment_id = %s
-                """, (establishment_id,))
-                rows = cur.fetchall()
-                amenities_raw = [r[0] for r in rows]
-            except Exception:
-                try:
-                    cur.execute("""
-                        SELECT element FROM establishment_amenities_list WHERE establishment_id = %s
-                    """, (establishment_id,))
-                    rows = cur.fetchall()
-                    amenities_raw = [r[0] for r in rows]
-                except Exception:
-                    logger.info("Amenities table not found with default names; skip amenities fetch")
+            SELECT establishment_id, MAX(capacity) FROM unit_type
+            WHERE establishment_id = ANY(%s) AND COALESCE(active, TRUE)
+            GROUP BY establishment_id
+        """, (list(out.keys()),))
+        for est_id, max_capacity in cur.fetchall():
+            if max_capacity is not None and str(est_id) in out:
+                out[str(est_id)]['max_capacity'] = int(max_capacity)
+    except Exception:
+        logger.info("unit_type capacity not available; skip max_capacity")
+    return out
 
-            # Lọc None/empty và ép về string để tránh lỗi join
-            amenities: List[str] = [str(x).strip() for x in amenities_raw if x is not None and str(x).strip()]
-            data['amenities_list'] = ", ".join(amenities) if amenities else ''
-            
-        return data
-    except Exception as error:
-        logging.error("DB error in fetch_single_establishment: %s", error)
+
+def build_source_text(new_data: Dict[str, Any]) -> str:
+    city = new_data.get('city', '')
+    amenities = new_data.get('amenities_list', '')
+    return (
+        f"ID: {new_data['id']}, Tên: {new_data['name']}, Thành phố: {city}, Loại: {new_data['type']}, "
+        f"Giá: {new_data.get('price_range_vnd')}, Sao: {new_data.get('star_rating')}. "
+        f"Tiện ích: {amenities}. "
+        f"Mô tả chi tiết: {new_data['description_long']}"
+    )
+
+
+def split_description(text: str, max_chars: int = CHUNK_MAX_CHARS) -> List[str]:
+    """Tách mô tả dài thành các đoạn; đoạn quá dài được cắt theo câu."""
+    parts: List[str] = []
+    for para in re.split(r"\n\s*\n|\n", text or ""):
+        para = para.strip()
+        if not para:
+            continue
+        if len(para) <= max_chars:
+            parts.append(para)
+            continue
+        buf = ""
+        for sentence in re.split(r"(?<=[.!?])\s+", para):
+            if buf and len(buf) + len(sentence) + 1 > max_chars:
+                parts.append(buf)
+                buf = sentence
+            else:
+                buf = f"{buf} {sentence}".strip()
+        if buf:
+            parts.append(buf)
+    return parts
+
+
+# Tiện ích chuẩn (amenity_vocab.py): mỗi cơ sở lưu mask bit trong metadata "amenity_mask" lúc index
+AMENITY_VOCAB = AmenityVocabulary()
+
+
+@functools.lru_cache(maxsize=4096)
+def amenity_mask(text: Optional[str]) -> int:
+    return AMENITY_VOCAB.mask(text)
+
+
+def meta_amenity_mask(meta: Dict[str, Any]) -> int:
+    """Mask tiện ích của một document; document index trước khi có amenity_mask thì tính từ amenities_list."""
+    mask = meta.get("amenity_mask")
+    if isinstance(mask, int):
+        return mask
+    return amenity_mask(meta.get("amenities_list") or meta.get("amenities") or "")
+
+
+def build_index_documents(new_data: Dict[str, Any]) -> tuple[List[str], List[Dict[str, Any]]]:
+    """Texts + metadatas để ghi vào Chroma theo INDEX_CHUNK_MODE."""
+    new_data = {**new_data, "amenity_mask": amenity_mask(new_data.get("amenities_list") or "")}
+    if INDEX_CHUNK_MODE != "chunked":
+        return [build_source_text(new_data)], [new_data]
+    name, city = new_data.get('name'), new_data.get('city', '')
+    chunks: List[tuple[str, str]] = [
+        ("summary", f"{name}: {new_data.get('type')} ở {city}. Giá: {new_data.get('price_range_vnd')}, Sao: {new_data.get('star_rating')}."),
+    ]
+    if new_data.get('amenities_list'):
+        chunks.append(("amenities", f"{name} ({city}) có các tiện ích: {new_data.get('amenities_list')}."))
+    for para in split_description(new_data.get('description_long') or ''):
+        chunks.append(("description", f"{name} ({city}): {para}"))
+    texts: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+    for idx, (chunk_type, text) in enumerate(chunks):
+        texts.append(text)
+        # Giữ nguyên metadata đầy đủ trên mỗi chunk để hậu kiểm city/type/amenities không đổi
+        metadatas.append({**new_data, "parent_id": new_data['id'], "chunk_type": chunk_type, "chunk_index": idx})
+    return texts, metadatas
+
+
+def fetch_cheapest_prices(est_ids: List[str], start_dt: Optional[datetime], end_dt: Optional[datetime],
+                          num_guests: Optional[int]) -> Dict[str, int]:
+    """Giá rẻ nhất còn trống cho nhiều cơ sở trên MỘT kết nối DB (dùng cho kết quả mở rộng).
+
+    Có ngày: giá đêm (override_price, hoặc base_price khi ngày đó không có dòng lịch) của các đêm còn phòng;
+    không có ngày: base_price.
+    """
+    if not est_ids:
+        return {}
+    start, end = stay_nights(start_dt, end_dt)
+    first = start or date.today()
+    inventory = fetch_inventory(est_ids, first, end or first)
+    if inventory is None:
+        return {}
+    prices = {eid: inventory.cheapest_price(eid, num_guests, start, end) for eid in est_ids}
+    return {eid: price for eid, price in prices.items() if price is not None}
+
+
+# --- PHIÊN QUIZ (tuỳ chọn): server giữ tham số đã chuẩn hoá theo session_id ---
+QUIZ_SESSION_MAX = int(os.getenv("QUIZ_SESSION_MAX", "10000"))
+QUIZ_SESSION_TTL_S = float(os.getenv("QUIZ_SESSION_TTL_S", "21600"))
+# Đường dẫn SQLite để phiên sống qua restart; để trống thì chỉ giữ trong RAM
+QUIZ_SESSION_DB = os.getenv("QUIZ_SESSION_DB", "")
+
+
+class SessionStore:
+    """LRU trong RAM (giới hạn số phiên + TTL), ghi xuyên xuống SQLite nếu có đường dẫn."""
+
+    def __init__(self, max_items: int, ttl_s: float, path: Optional[str] = None):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.path = path or None
+        self._items: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        if self.path:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS quiz_sessions (
+                        session_id TEXT PRIMARY KEY,
+                        params TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is not None:
+                if now - item[0] <= self.ttl_s:
+                    self._items.move_to_end(session_id)
+                    return dict(item[1])
+                del self._items[session_id]
+        if not self.path:
+            return None
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT params, updated_at FROM quiz_sessions WHERE session_id = ?",
+                               (session_id,)).fetchone()
+        if row is None or now - row[1] > self.ttl_s:
+            return None
+        params = json.loads(row[0])
+        self._remember(session_id, params, row[1])
+        return dict(params)
+
+    def put(self, session_id: str, params: Dict[str, Any]) -> None:
+        now = time.time()
+        self._remember(session_id, dict(params), now)
+        if self.path:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("""
+                    INSERT INTO quiz_sessions (session_id, params, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(session_id) DO UPDATE SET params = excluded.params, updated_at = excluded.updated_at
+                """, (session_id, json.dumps(params, ensure_ascii=False, default=str), now))
+                conn.execute("DELETE FROM quiz_sessions WHERE updated_at < ?", (now - self.ttl_s,))
+
+    def _remember(self, session_id: str, params: Dict[str, Any], ts: float) -> None:
+        with self._lock:
+            self._items[session_id] = (ts, params)
+            self._items.move_to_end(session_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = len(self._items)
+        return {"in_memory": size, "max": self.max_items, "evictions": self.evictions, "persistent": bool(self.path)}
+
+
+quiz_sessions = SessionStore(QUIZ_SESSION_MAX, QUIZ_SESSION_TTL_S, QUIZ_SESSION_DB)
+
+
+def load_quiz_session(session_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not session_id:
         return None
-    finally:
-        if conn is not None:
-            conn.close()
+    try:
+        params = quiz_sessions.get(session_id)
+    except Exception as e:
+        logger.warning("Quiz session read failed (%s): %s", session_id, e)
+        params = None
+    record_cache("quiz_session", params is not None)
+    return params
 
-# --- API 1: Conditional Quiz Generation (Sử dụng LLM Suy luận) ---
-@app.post("/generate-quiz", response_model=QuizResponseModel)
-async def generate_quiz(req: QuizRequest):
-    # Chỉ dùng LLM; nếu chưa sẵn sàng thì báo lỗi
-    if not llm:
-        raise HTTPException(status_code=503, detail="LLM chưa được khởi tạo")
-    
-    # Sử dụng LangChain JsonOutputParser
-    parser = JsonOutputParser(pydantic_object=QuizResponseModel)
 
-    # Prompt cho LLM (tránh chèn trực tiếp JSON/Schema vào template để không bị bắt nhầm biến)
-    template = """
+def save_quiz_session(session_id: Optional[str], result: Dict[str, Any]) -> Dict[str, Any]:
+    if session_id:
+        try:
+            quiz_sessions.put(session_id, result.get("final_params") or {})
+        except Exception as e:
+            logger.warning("Quiz session write failed (%s): %s", session_id, e)
+        result["session_id"] = session_id
+    return result
+
+
+# --- API 1: Conditional Quiz Generation (Sử dụng LLM Suy luận) ---
+# Prompt đầy đủ (cũ): LLM tự kiểm tra thiếu gì, kèm JSON schema của QuizResponseModel
+FULL_QUIZ_TEMPLATE = """
     Bạn là trợ lý AI đặt chỗ. Nhiệm vụ của bạn là thu thập 7 tham số sau: {param_order}.
     
     Quy tắc:
@@ -515,112 +908,357 @@ async def generate_quiz(req: QuizRequest):
     Định dạng đầu ra phải là JSON.
     JSON SCHEMA: {format_instructions}
     """
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "Bạn là một AI phân tích ngôn ngữ tự nhiên và chuyển đổi ý định người dùng thành các tham số đặt chỗ. Chỉ trả lời bằng JSON."),
-        ("human", template)
-    ])
-    chain = prompt | llm | parser
+FULL_QUIZ_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Bạn là một AI phân tích ngôn ngữ tự nhiên và chuyển đổi ý định người dùng thành các tham số đặt chỗ. Chỉ trả lời bằng JSON."),
+    ("human", FULL_QUIZ_TEMPLATE)
+])
+
+# Prompt gọn: LLM chỉ trích xuất tham số mới/thay đổi; missing_quiz, key_to_collect, options do service tự quyết
+QUIZ_PROMPT_MODE = os.getenv("QUIZ_PROMPT_MODE", "compact").strip().lower()
+COMPACT_QUIZ_TEMPLATE = """Khóa: establishment_type(HOTEL|RESTAURANT), city, check_in_date(YYYY-MM-DD), \
+travel_companion(single|couple|family|friends|số người), duration(số đêm), max_price(VND), amenities_priority(toàn bộ danh sách sau cập nhật, cách nhau dấu phẩy)
+Đã có: {current_params}
+Câu: "{user_prompt}"
+Trả JSON chỉ gồm khóa mới/thay đổi; duration, max_price là số nguyên; {{}} nếu không có."""
+COMPACT_QUIZ_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Trích xuất tham số đặt chỗ từ câu của người dùng. Chỉ trả JSON."),
+    ("human", COMPACT_QUIZ_TEMPLATE)
+])
+
+
+def compact_known_params(params: Dict[str, Any]) -> str:
+    """Tham số đã có, chỉ các khóa cốt lõi có giá trị, JSON không khoảng trắng."""
+    known = {k: params[k] for k in PARAM_ORDER if not k.startswith("_") and params.get(k) not in (None, "")}
+    return json.dumps(known, ensure_ascii=False, separators=(",", ":"))
+
+
+# Structured output: schema gốc của provider (Gemini response_schema) thay cho JsonOutputParser;
+# lỗi provider → trích xuất tất định (luật + normalize_params) thay vì trả 502
+QUIZ_EXTRACTION_MODE = os.getenv("QUIZ_EXTRACTION_MODE", "structured").strip().lower()
+QUIZ_STRUCTURED_METHOD = os.getenv("QUIZ_STRUCTURED_METHOD", "json_mode").strip().lower()
+QUIZ_DELTA_SCHEMA = {
+    "title": "booking_params",
+    "description": "Các tham số đặt chỗ mới hoặc thay đổi trong câu của người dùng",
+    "type": "object",
+    "properties": {
+        "establishment_type": {"type": "string", "enum": ["HOTEL", "RESTAURANT"]},
+        "city": {"type": "string"},
+        "check_in_date": {"type": "string", "description": "YYYY-MM-DD"},
+        "travel_companion": {"type": "string", "description": "single | couple | family | friends hoặc số người"},
+        "duration": {"type": "integer", "description": "Số đêm"},
+        "max_price": {"type": "integer", "description": "Ngân sách tối đa (VND)"},
+        "amenities_priority": {"type": "string", "description": "Toàn bộ danh sách tiện ích sau cập nhật, cách nhau dấu phẩy"},
+    },
+}
+COMPANION_KEYWORDS = {
+    "single": ["mot minh", "1 minh", "solo"],
+    "couple": ["cap doi", "hai vo chong", "vo chong", "nguoi yeu", "couple"],
+    "family": ["gia dinh", "family"],
+    "friends": ["ban be", "nhom ban", "friends"],
+}
 
-    try:
-        # Tiền xử lý: bổ sung city/type suy luận trước khi gửi vào LLM để tránh hỏi lại
-        pre_params: Dict[str, Any] = dict(req.current_params or {})
-        if not pre_params.get("city"):
-            guessed_city = infer_city_from_text(req.user_prompt or "")
-            if guessed_city:
-                pre_params["city"] = guessed_city
-        if not pre_params.get("establishment_type"):
-            plc = (req.user_prompt or "").lower()
-            if any(k in plc for k in ["khach san","khách sạn","hotel"]):
-                pre_params["establishment_type"] = "HOTEL"
-            elif any(k in plc for k in ["nha hang","nhà hàng","restaurant"]):
-                pre_params["establishment_type"] = "RESTAURANT"
-
-        result = chain.invoke({
+_structured_llm: Optional[tuple] = None  # (llm gốc, runnable đã gắn schema)
+
+
+def structured_quiz_llm():
+    """LLM gắn schema delta (tạo một lần, dùng lại giữa các request)."""
+    global _structured_llm
+    if _structured_llm is None or _structured_llm[0] is not llm:
+        runnable = llm.with_structured_output(QUIZ_DELTA_SCHEMA, method=QUIZ_STRUCTURED_METHOD, include_raw=True)
+        _structured_llm = (llm, runnable)
+    return _structured_llm[1]
+
+
+def deterministic_extract(user_prompt: str) -> Dict[str, Any]:
+    """Trích xuất không cần LLM: người đi cùng + tiện ích theo từ khoá.
+
+    city/type/ngày/số đêm/ngân sách đã do pre_infer_params và normalize_params xử lý.
+    """
+    text = fold(user_prompt)
+    delta: Dict[str, Any] = {}
+    def has(phrase: str) -> bool:
+        return re.search(rf"\b{re.escape(phrase)}\b", text) is not None
+
+    for companion, keywords in COMPANION_KEYWORDS.items():
+        if any(has(k) for k in keywords):
+            delta["travel_companion"] = companion
+            break
+    # Chỉ các tiện ích quiz đưa ra làm lựa chọn, nhưng nhận cả từ đồng nghĩa ("bể bơi" → Hồ bơi)
+    found = AMENITY_VOCAB.mask(user_prompt) & amenity_mask(", ".join(FALLBACK_OPTIONS.get("amenities_priority", [])))
+    if found:
+        delta["amenities_priority"] = ", ".join(AMENITY_VOCAB.names(found))
+    return delta
+
+
+def clean_delta(raw: Any) -> Dict[str, Any]:
+    # Chỉ nhận delta: bỏ giá trị rỗng để không xoá tham số đã có
+    delta = raw if isinstance(raw, dict) else {}
+    if isinstance(delta.get("final_params"), dict):
+        delta = delta["final_params"]
+    return {k: v for k, v in delta.items() if v is not None and v != ""}
+
+
+def pre_infer_params(req: QuizRequest, session_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Bổ sung city/type suy luận trước khi gửi vào LLM để tránh hỏi lại."""
+    # Phiên server: tham số đã chuẩn hoá + phần thay đổi client gửi lên
+    pre_params: Dict[str, Any] = {**(session_params or {}), **(req.current_params or {})}
+    if not pre_params.get("city"):
+        guessed_city = infer_city_from_text(req.user_prompt or "")
+        if guessed_city:
+            pre_params["city"] = guessed_city
+    if not pre_params.get("establishment_type"):
+        plc = (req.user_prompt or "").lower()
+        if any(k in plc for k in ["khach san","khách sạn","hotel"]):
+            pre_params["establishment_type"] = "HOTEL"
+        elif any(k in plc for k in ["nha hang","nhà hàng","restaurant"]):
+            pre_params["establishment_type"] = "RESTAURANT"
+    return pre_params
+
+
+def extract_with_llm(pre_params: Dict[str, Any], user_prompt: str) -> Dict[str, Any]:
+    """Gọi LLM theo QUIZ_EXTRACTION_MODE/QUIZ_PROMPT_MODE; trả về dict có 'final_params' (đầy đủ hoặc delta)."""
+    if QUIZ_EXTRACTION_MODE == "structured":
+        messages = COMPACT_QUIZ_PROMPT.format_messages(current_params=compact_known_params(pre_params),
+                                                       user_prompt=user_prompt)
+        try:
+            with stage_timer("generate_quiz", "llm"), LLM_BULKHEAD.slot():
+                out = structured_quiz_llm().invoke(messages)
+            raw = out.get("raw")
+            tokens = record_llm_usage("generate_quiz", raw, prompt_text="\n".join(str(m.content) for m in messages),
+                                      prompt="structured")
+            logger.info("generate_quiz tokens (structured): %s", tokens)
+            if out.get("parsing_error") is not None:
+                raise ValueError(out["parsing_error"])
+            return {"quiz_completed": False, "final_params": clean_delta(out.get("parsed"))}
+        except (Overloaded, DeadlineExceeded):
+            # Quá tải / hết hạn không phải lỗi trích xuất: để handler trả 503/429/504 như đường LLM thường
+            raise
+        except Exception as e:
+            logger.warning("Structured extraction failed, using deterministic extractor: %s", getattr(e, 'message', str(e)))
+            QUIZ_FALLBACKS.inc(reason=type(e).__name__)
+            return {"quiz_completed": False, "final_params": deterministic_extract(user_prompt), "_fallback": True}
+
+    if QUIZ_PROMPT_MODE == "compact":
+        parser = JsonOutputParser()
+        prompt = COMPACT_QUIZ_PROMPT
+        inputs = {"current_params": compact_known_params(pre_params), "user_prompt": user_prompt}
+    else:
+        # Sử dụng LangChain JsonOutputParser
+        parser = JsonOutputParser(pydantic_object=QuizResponseModel)
+        prompt = FULL_QUIZ_PROMPT
+        inputs = {
             "param_order": ", ".join(PARAM_ORDER),
             "current_params": json.dumps(pre_params, ensure_ascii=False),
-            "user_prompt": req.user_prompt,
+            "user_prompt": user_prompt,
             "format_instructions": parser.get_format_instructions()
-        })
-
-        # Chuẩn hóa + bổ sung mặc định để tránh hỏi lặp hoặc bất hợp lý
-        # Gộp với pre_params để giữ các giá trị đã suy luận trước đó
-        merged_after_llm = { **pre_params, **(result.get('final_params', {}) or {}) }
-        normalized = normalize_params(merged_after_llm, req.user_prompt)
+        }
+    messages = prompt.format_messages(**inputs)
+    with stage_timer("generate_quiz", "llm"), LLM_BULKHEAD.slot():
+        message = llm.invoke(messages)
+    tokens = record_llm_usage("generate_quiz", message,
+                              prompt_text="\n".join(str(m.content) for m in messages), prompt=QUIZ_PROMPT_MODE)
+    logger.info("generate_quiz tokens (%s prompt): %s", QUIZ_PROMPT_MODE, tokens)
+    with stage_timer("generate_quiz", "parser"):
+        result = parser.invoke(message)
+    if QUIZ_PROMPT_MODE == "compact":
+        result = {"quiz_completed": False, "final_params": clean_delta(result)}
+    return result
+
+
+def build_quiz_response(result: Dict[str, Any], pre_params: Dict[str, Any], user_prompt: str,
+                        session_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Gộp kết quả LLM với pre_params, chuẩn hoá và tự quyết định câu hỏi tiếp theo."""
+    result.pop("_fallback", None)
+    # Chuẩn hóa + bổ sung mặc định để tránh hỏi lặp hoặc bất hợp lý
+    # Gộp với pre_params để giữ các giá trị đã suy luận trước đó
+    merged_after_llm = { **pre_params, **(result.get('final_params', {}) or {}) }
+    with stage_timer("generate_quiz", "normalize_params"):
+        normalized = normalize_params(merged_after_llm, user_prompt, previous=session_params)
         normalized = apply_defaults(normalized)
-        result['final_params'] = normalized
-
-        # Không xử lý hoặc chấp nhận bất kỳ khóa 'style' nào từ LLM
-
-        # Tự quyết định thiếu gì dựa trên PARAM_ORDER
-        ord2 = effective_param_order(result['final_params'])
-        # Xác định thiếu thực sự (coi như có nếu không rỗng sau chuẩn hoá)
-        missing_key_default = None
-        for k in ord2:
-            v = result['final_params'].get(k)
-            if v is None:
-                missing_key_default = k; break
-            if isinstance(v, str) and not v.strip():
-                missing_key_default = k; break
-        # Cho phép hỏi THÊM tiện ích đúng một lần nếu đã có giá trị nhưng chưa xác nhận
-        missing_key = missing_key_default
-        try:
-            fp = result.get('final_params') or {}
-            has_amen = bool(fp.get('amenities_priority'))
-            amen_confirmed = bool(fp.get('_amenities_confirmed'))
-            if missing_key_default is None and has_amen and not amen_confirmed:
-                missing_key = 'amenities_priority'
-        except Exception:
-            pass
-        # Ưu tiên cho phép người dùng CHỌN THÊM tiện ích một lần nữa nếu chưa xác nhận
-        try:
-            fp = result.get('final_params') or {}
-            has_amen = bool(fp.get('amenities_priority'))
-            amenities_confirmed = bool(fp.get('_amenities_confirmed'))
-            if has_amen and not amenities_confirmed:
-                missing_key = 'amenities_priority'
-        except Exception:
-            pass
-        # Nếu người dùng chỉ nêu city nhưng chưa rõ loại cơ sở -> ưu tiên hỏi establishment_type trước
-        if missing_key == 'city' and result['final_params'].get('city') and not result['final_params'].get('establishment_type'):
-            missing_key = 'establishment_type'
-        if missing_key:
-            result['quiz_completed'] = False
-            result['key_to_collect'] = missing_key
-            if missing_key == 'amenities_priority' and (result.get('final_params') or {}).get('amenities_priority'):
-                result['missing_quiz'] = 'Bạn có muốn chọn thêm tiện ích không? (bạn có thể bỏ qua nếu đủ)'
-            else:
-                result['missing_quiz'] = FALLBACK_QUESTIONS.get(missing_key)
-            result['options'] = FALLBACK_OPTIONS.get(missing_key)
-            result['image_options'] = None
+    result['final_params'] = normalized
+
+    # Không xử lý hoặc chấp nhận bất kỳ khóa 'style' nào từ LLM
+
+    # Tự quyết định thiếu gì dựa trên PARAM_ORDER
+    ord2 = effective_param_order(result['final_params'])
+    # Xác định thiếu thực sự (coi như có nếu không rỗng sau chuẩn hoá)
+    missing_key_default = None
+    for k in ord2:
+        v = result['final_params'].get(k)
+        if v is None:
+            missing_key_default = k; break
+        if isinstance(v, str) and not v.strip():
+            missing_key_default = k; break
+    # Cho phép hỏi THÊM tiện ích đúng một lần nếu đã có giá trị nhưng chưa xác nhận
+    missing_key = missing_key_default
+    try:
+        fp = result.get('final_params') or {}
+        has_amen = bool(fp.get('amenities_priority'))
+        amen_confirmed = bool(fp.get('_amenities_confirmed'))
+        if missing_key_default is None and has_amen and not amen_confirmed:
+            missing_key = 'amenities_priority'
+    except Exception:
+        pass
+    # Ưu tiên cho phép người dùng CHỌN THÊM tiện ích một lần nữa nếu chưa xác nhận
+    try:
+        fp = result.get('final_params') or {}
+        has_amen = bool(fp.get('amenities_priority'))
+        amenities_confirmed = bool(fp.get('_amenities_confirmed'))
+        if has_amen and not amenities_confirmed:
+            missing_key = 'amenities_priority'
+    except Exception:
+        pass
+    # Nếu người dùng chỉ nêu city nhưng chưa rõ loại cơ sở -> ưu tiên hỏi establishment_type trước
+    if missing_key == 'city' and result['final_params'].get('city') and not result['final_params'].get('establishment_type'):
+        missing_key = 'establishment_type'
+    if missing_key:
+        result['quiz_completed'] = False
+        result['key_to_collect'] = missing_key
+        if missing_key == 'amenities_priority' and (result.get('final_params') or {}).get('amenities_priority'):
+            result['missing_quiz'] = 'Bạn có muốn chọn thêm tiện ích không? (bạn có thể bỏ qua nếu đủ)'
         else:
-            result['quiz_completed'] = True
-            result['key_to_collect'] = None
-            result['missing_quiz'] = None
-            result['options'] = None
-            result['image_options'] = None
-        
-        return result
+            result['missing_quiz'] = FALLBACK_QUESTIONS.get(missing_key)
+        result['options'] = facet_options(missing_key, result['final_params'])
+        result['image_options'] = None
+        # Chỉ còn bước tiện ích: tìm kiếm cho params hiện tại nhiều khả năng chính là lần /rag-search kế tiếp
+        if missing_key in PREFETCH_KEYS:
+            try:
+                schedule_search_prefetch(result['final_params'])
+            except Exception as e:
+                logger.warning("Search prefetch failed to start: %s", getattr(e, 'message', str(e)))
+    else:
+        result['quiz_completed'] = True
+        result['key_to_collect'] = None
+        result['missing_quiz'] = None
+        result['options'] = None
+        result['image_options'] = None
+    return result
+
+
+quiz_flight = SingleFlight("generate_quiz", copy_result=True)
+
+
+@app.post("/generate-quiz", response_model=QuizResponseModel)
+@timed_operation("generate_quiz")
+async def generate_quiz(req: QuizRequest, request: Request):
+    # Chỉ dùng LLM; nếu chưa sẵn sàng thì báo lỗi
+    if not llm:
+        raise HTTPException(status_code=503, detail="LLM chưa được khởi tạo")
+
+    try:
+        session_params = load_quiz_session(req.session_id)
+        with stage_timer("generate_quiz", "pre_infer"):
+            pre_params = pre_infer_params(req, session_params)
+        check_budget("generate_quiz", "llm")
+        try:
+            # Cùng tham số + cùng câu trả lời đang xử lý → dùng chung một lời gọi LLM
+            result = await await_within_budget(
+                quiz_flight.do_async(flight_key(pre_params, (req.user_prompt or "").strip()),
+                                     lambda: extract_with_llm(pre_params, req.user_prompt)),
+                request, reserve_ms=DEADLINE_RESERVE_MS)
+        except DeadlineExceeded as e:
+            # LLM không kịp trong ngân sách: chế độ structured vẫn trả được câu hỏi tiếp theo bằng trích xuất tất định
+            if e.reason != "deadline" or QUIZ_EXTRACTION_MODE != "structured":
+                raise
+            QUIZ_FALLBACKS.inc(reason="deadline")
+            result = {"quiz_completed": False, "final_params": deterministic_extract(req.user_prompt), "_fallback": True}
+        return save_quiz_session(req.session_id, build_quiz_response(result, pre_params, req.user_prompt, session_params))
+    except (Overloaded, DeadlineExceeded):
+        raise
     except Exception as e:
         logging.error(f"LỖI GỌI LLM/Parser: {e}")
         raise HTTPException(status_code=502, detail=f"Lỗi LLM hoặc Parser: {e}")
 
 
+@app.post("/generate-quiz/stream")
+@timed_operation("generate_quiz_stream")
+async def generate_quiz_stream(req: QuizRequest, request: Request):
+    """NDJSON: {"event": "partial", "params": {...}} mỗi khi LLM trích thêm được tham số, rồi {"event": "result", ...}.
+
+    Cần QUIZ_EXTRACTION_MODE=structured; lỗi provider hoặc hết hạn giữa chừng → kết quả từ trích xuất tất định.
+    """
+    if not llm:
+        raise HTTPException(status_code=503, detail="LLM chưa được khởi tạo")
+    if QUIZ_EXTRACTION_MODE != "structured":
+        raise HTTPException(status_code=400, detail="Streaming cần QUIZ_EXTRACTION_MODE=structured")
+    session_params = load_quiz_session(req.session_id)
+    with stage_timer("generate_quiz_stream", "pre_infer"):
+        pre_params = pre_infer_params(req, session_params)
+    messages = COMPACT_QUIZ_PROMPT.format_messages(current_params=compact_known_params(pre_params),
+                                                   user_prompt=req.user_prompt)
+    key = flight_key(pre_params, (req.user_prompt or "").strip())
+
+    async def events():
+        delta: Dict[str, Any] = {}
+        fallback = False
+        try:
+            check_budget("generate_quiz_stream", "llm")
+            if quiz_flight.in_flight(key):
+                # /generate-quiz đang xử lý đúng câu trả lời này: dùng chung kết quả, không gọi LLM lần hai
+                result = await await_within_budget(
+                    quiz_flight.do_async(key, lambda: extract_with_llm(pre_params, req.user_prompt)),
+                    request, reserve_ms=DEADLINE_RESERVE_MS)
+                delta, fallback = result.get("final_params") or {}, bool(result.get("_fallback"))
+            else:
+                # Không dùng include_raw khi stream: parser JSON trả dict từng phần theo token
+                streaming = llm.with_structured_output(QUIZ_DELTA_SCHEMA, method=QUIZ_STRUCTURED_METHOD)
+                async with LLM_BULKHEAD.async_slot():
+                    with stage_timer("generate_quiz_stream", "llm"):
+                        parts = streaming.astream(messages).__aiter__()
+                        while True:
+                            # Mỗi phần chờ trong ngân sách còn lại; hết hạn/ngắt kết nối → huỷ stream của provider
+                            try:
+                                partial = await await_within_budget(parts.__anext__(), request,
+                                                                    reserve_ms=DEADLINE_RESERVE_MS)
+                            except StopAsyncIteration:
+                                break
+                            current = clean_delta(partial)
+                            if current and current != delta:
+                                delta = current
+                                yield json.dumps({"event": "partial", "params": delta}, ensure_ascii=False) + "\n"
+        except DeadlineExceeded as e:
+            if e.reason == "client_disconnected":
+                return
+            # Header 200 đã gửi: không trả 504 được nữa → kết thúc bằng trích xuất tất định như /generate-quiz
+            QUIZ_FALLBACKS.inc(reason="deadline")
+            delta, fallback = deterministic_extract(req.user_prompt), True
+        except Exception as e:
+            logger.warning("Structured streaming failed, using deterministic extractor: %s", getattr(e, 'message', str(e)))
+            QUIZ_FALLBACKS.inc(reason=type(e).__name__)
+            delta, fallback = deterministic_extract(req.user_prompt), True
+        result = build_quiz_response({"quiz_completed": False, "final_params": delta}, pre_params, req.user_prompt,
+                                     session_params)
+        data = QuizResponseModel(**save_quiz_session(req.session_id, result)).model_dump()
+        yield json.dumps({"event": "result", "fallback": fallback, "data": data}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
 # --- API 2: RAG Search ---
-@app.post("/rag-search", response_model=List[SearchResult])
-async def rag_search(req: SearchRequest):
-    if not vectorstore:
-        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo")
-        
+def infer_num_guests(companion_val: Optional[str]) -> Optional[int]:
+    if not companion_val:
+        return None
+    tc = str(companion_val).strip().lower()
+    mapping = {"single": 1, "couple": 2, "family": 4, "friends": 3}
+    if tc in mapping:
+        return mapping[tc]
+    try:
+        return int(float(tc))
+    except Exception:
+        return None
+
+
+def prepare_search(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Chuẩn hoá tham số tìm kiếm: câu truy vấn vector + các điều kiện hậu kiểm."""
     # Lấy các tham số đã thu thập
-    companion = req.params.get("travel_companion")
-    city = req.params.get("city")  # có thể None
-    amenities = req.params.get("amenities_priority", "tiện ích cơ bản")
-    est_type = req.params.get("establishment_type") or req.params.get("type")
-    check_in_date = req.params.get("check_in_date")
-    check_out_date = req.params.get("check_out_date")
-    duration = req.params.get("duration")
-    
+    companion = params.get("travel_companion")
+    city = params.get("city")  # có thể None
+    amenities = params.get("amenities_priority", "tiện ích cơ bản")
+    est_type = params.get("establishment_type") or params.get("type")
+    check_in_date = params.get("check_in_date")
+    check_out_date = params.get("check_out_date")
+    duration = params.get("duration")
+
     # Tạo Query mô tả chi tiết
     city_text = city or "địa điểm bất kỳ"
     # Chuẩn hoá amenities: chấp nhận cả mảng hoặc chuỗi
@@ -637,35 +1275,84 @@ async def rag_search(req: SearchRequest):
         f"Ưu tiên các tiện ích: {amenities_text}. "
         f"Mô tả không gian và trải nghiệm."
     )
-    
-    # Tăng k để có nhiều ứng viên hơn trước khi hậu kiểm
-    search_kwargs = {"k": 100}
-    results = vectorstore.similarity_search_with_score(query=query_text, **search_kwargs)
-    
-    # Chuẩn hoá so sánh không dấu
-    def strip_accents(s: Optional[str]) -> str:
-        if not s:
-            return ""
-        return ''.join(c for c in unicodedata.normalize('NFD', str(s).strip()) if unicodedata.category(c) != 'Mn').lower()
-
-    city_norm = strip_accents(city)
-    # Chuẩn hoá tiện ích để so khớp: hỗ trợ mảng -> match bất kỳ tiện ích nào
-    amen_norm_list: List[str] = []
+
+    # Chuẩn hoá tiện ích để so khớp: mảng hoặc chuỗi "a, b" -> match bất kỳ tiện ích nào.
+    # Tiện ích chuẩn → mask bit; mục không có trong từ điển vẫn so khớp chuỗi con như trước
     if isinstance(amenities, list):
+        amen_terms = [str(a) for a in amenities if a is not None]
+    else:
+        amen_terms = str(amenities).split(",") if amenities else []
+    amen_mask, amen_unknown = AMENITY_VOCAB.parse(amen_terms)
+    amen_free = [t for t in (strip_accents(u) for u in amen_unknown) if t]
+
+    # Chuẩn hoá ngày nếu có
+    start_dt = None
+    end_dt = None
+    try:
+        if check_in_date:
+            start_dt = datetime.strptime(str(check_in_date), "%Y-%m-%d")
+            if check_out_date:
+                end_dt = datetime.strptime(str(check_out_date), "%Y-%m-%d")
+            elif duration:
+                try:
+                    dur = int(str(duration))
+                    end_dt = start_dt + timedelta(days=max(1, dur))
+                except Exception:
+                    end_dt = None
+    except Exception:
+        start_dt = None
+        end_dt = None
+
+    # Ngày linh hoạt: khoảng ngày nhận phòng [date_from, date_to] + số đêm, chỉ khi chưa có ngày cố định
+    flex = None
+    if start_dt is None and params.get("date_from"):
         try:
-            amen_norm_list = [strip_accents(a) for a in amenities if a is not None]
+            weekend = str(params.get("weekend_only") or "").strip().lower() in ("1", "true", "yes")
+            flex_from = datetime.strptime(str(params["date_from"]), "%Y-%m-%d").date()
+            flex_to = datetime.strptime(str(params.get("date_to") or params["date_from"]), "%Y-%m-%d").date()
+            nights = max(1, int(str(duration or (2 if weekend else 1))))
+            if flex_to >= flex_from:
+                flex = {"from": flex_from, "to": min(flex_to, flex_from + timedelta(days=FLEX_MAX_RANGE_DAYS - 1)),
+                        "nights": nights, "weekend": weekend}
         except Exception:
-            amen_norm_list = []
-    else:
-        amen_norm_single = strip_accents(amenities)
-        if amen_norm_single:
-            amen_norm_list = [amen_norm_single]
+            flex = None
+
+    return {
+        "query_text": query_text,
+        "city": city,
+        "city_norm": strip_accents(city),
+        "amenities": amenities,
+        "amen_mask": amen_mask,
+        "amen_free": amen_free,
+        "est_type": est_type,
+        "num_guests": infer_num_guests(companion),
+        "start_dt": start_dt,
+        "end_dt": end_dt,
+        "flex": flex,
+    }
 
-    # Khử trùng lặp theo establishment_id và hậu kiểm city/amenities
+
+def post_filter_candidates(results: List[Any], plan: Dict[str, Any]) -> tuple[Dict[str, float], Dict[str, Dict[str, Any]]]:
+    """Khử trùng lặp theo establishment_id và hậu kiểm city/amenities/type.
+
+    `results` là danh sách (metadata, score) theo thứ tự score tăng dần. Nhiều chunk của cùng một cơ sở
+    được gộp: "max" lấy chunk gần nhất, "sum" cộng độ tương đồng 1/(1+d) các chunk (score = 1/tổng).
+    """
+    city_norm = plan["city_norm"]
+    amenities = plan["amenities"]
+    amen_mask = plan["amen_mask"]
+    amen_free = plan["amen_free"]
+    est_type = plan["est_type"]
+    amen_ok: Optional[np.ndarray] = None
+    if amenities and (amen_mask or amen_free):
+        # Một phép AND bit trên toàn bộ ứng viên
+        masks = np.fromiter((meta_amenity_mask(m or {}) for m, _ in results), dtype=np.int64, count=len(results))
+        amen_ok = (masks & amen_mask) != 0
     best_by_id: Dict[str, float] = {}
     metas_by_id: Dict[str, Dict[str, Any]] = {}
-    for doc, score in results:
-        meta = doc.metadata or {}
+    sim_sum: Dict[str, float] = {}
+    for pos, (meta, score) in enumerate(results):
+        meta = meta or {}
         est_id = meta.get('id')
         if not est_id:
             continue
@@ -674,13 +1361,13 @@ async def rag_search(req: SearchRequest):
             meta_city = strip_accents(meta.get('city'))
             if meta_city != city_norm:
                 continue
-        # Hậu kiểm amenities nếu có
-        if amenities:
+        # Hậu kiểm amenities nếu có: match nếu BẤT KỲ tiện ích nào trong danh sách có ở cơ sở
+        if amen_ok is not None and not amen_ok[pos]:
+            if not amen_free:
+                continue
             am_list = strip_accents(meta.get('amenities_list') or meta.get('amenities'))
-            if amen_norm_list:
-                # match nếu BẤT KỲ tiện ích nào trong danh sách xuất hiện trong metadata
-                if not any(an in am_list for an in amen_norm_list):
-                    continue
+            if not any(an in am_list for an in amen_free):
+                continue
         # Hậu kiểm type nếu có
         if est_type:
             try:
@@ -690,151 +1377,910 @@ async def rag_search(req: SearchRequest):
                     continue
             except Exception:
                 continue
+        if CHUNK_SCORE_AGG == "sum":
+            sim_sum[est_id] = sim_sum.get(est_id, 0.0) + 1.0 / (1.0 + max(0.0, float(score)))
         # Lấy điểm tốt hơn (score nhỏ hơn coi là tốt hơn)
         prev = best_by_id.get(est_id)
         if prev is None or score < prev:
             best_by_id[est_id] = score
             metas_by_id[est_id] = meta
+    if sim_sum:
+        ranked = sorted(sim_sum.items(), key=lambda kv: kv[1], reverse=True)
+        best_by_id = {eid: 1.0 / total for eid, total in ranked}
+    return best_by_id, metas_by_id
 
+
+def check_capacity_availability(checks: set) -> Dict[tuple, bool]:
+    """Kiểm tra sức chứa/khả dụng cho nhiều (est_id, num_guests, start_dt, end_dt) trên MỘT kết nối DB.
+
+    Cùng một điều kiện (InventoryCalendar.stay_available) cho kế hoạch vector trước lẫn SQL trước.
+    Trả về {key: bool}; khi lỗi DB thì mọi key được coi là hợp lệ (giữ nguyên danh sách).
+    """
+    out: Dict[tuple, bool] = {key: True for key in checks}
+    if not checks:
+        return out
+    stays = [stay_nights(start_dt, end_dt) for _, _, start_dt, end_dt in checks]
+    dated = [stay for stay in stays if stay[0] is not None]
+    # Không có ngày: chỉ cần loại phòng (khoảng rỗng, không đọc unit_availability)
+    first = min(stay[0] for stay in dated) if dated else date.today()
+    last = max(stay[1] for stay in dated) if dated else first
+    inventory = fetch_inventory(sorted({key[0] for key in checks}), first, last)
+    if inventory is None:
+        return out
+    for key in checks:
+        est_id, num_guests, start_dt, end_dt = key
+        out[key] = inventory.stay_available(est_id, num_guests, start_dt, end_dt)
+    return out
+
+
+def capacity_checks_for(plan: Dict[str, Any], candidate_ids: List[str]) -> set:
+    if plan["num_guests"] is None:
+        return set()
+    return {(eid, plan["num_guests"], plan["start_dt"], plan["end_dt"]) for eid in candidate_ids}
+
+
+# --- NGÀY LINH HOẠT: lịch phòng (ngày × loại phòng) của ứng viên → mọi khoảng N đêm liên tiếp còn trống ---
+FLEX_MAX_RANGE_DAYS = int(os.getenv("FLEX_MAX_RANGE_DAYS", "62"))
+FLEX_CANDIDATES = int(os.getenv("FLEX_CANDIDATES", "20"))
+FLEX_DATE_OPTIONS = int(os.getenv("FLEX_DATE_OPTIONS", "3"))
+
+
+def feasible_date_windows(inventory: InventoryCalendar, flex: Dict[str, Any],
+                          num_guests: Optional[int]) -> Dict[str, List[DateOption]]:
+    """Các ngày nhận phòng tốt nhất (rẻ nhất, rồi sớm nhất) cho từng cơ sở có ít nhất một khoảng khả thi.
+
+    Ngày không có dòng unit_availability dùng total_units/base_price của loại phòng (InventoryCalendar).
+    """
+    nights = flex["nights"]
+    out: Dict[str, List[DateOption]] = {}
+    for est_id, windows in inventory.date_windows(num_guests, nights, flex["weekend"], FLEX_DATE_OPTIONS).items():
+        out[est_id] = [DateOption(
+            check_in_date=check_in.strftime("%Y-%m-%d"),
+            check_out_date=(check_in + timedelta(days=nights)).strftime("%Y-%m-%d"),
+            min_total_price=total,
+            units_left=left,
+        ) for check_in, total, left in windows]
+    return out
+
+
+def flexible_date_options(plan: Dict[str, Any],
+                          est_ids: List[str]) -> Optional[Dict[str, Optional[List[DateOption]]]]:
+    """{est_id: các khoảng khả thi} cho cơ sở còn khoảng trống; None (giá trị) nếu cơ sở không có loại phòng nào
+    để kiểm tra; cơ sở có loại phòng nhưng không còn khoảng nào bị bỏ. None nếu lỗi DB."""
+    flex = plan["flex"]
+    inventory = fetch_inventory(est_ids, flex["from"], flex["to"] + timedelta(days=flex["nights"]))
+    if inventory is None:
+        return None
+    options: Dict[str, Optional[List[DateOption]]] = {
+        est_id: None for est_id in est_ids if not inventory.has_inventory(est_id)}
+    options.update(feasible_date_windows(inventory, flex, plan["num_guests"]))
+    return options
+
+
+def finalize_search(plan: Dict[str, Any], expand: bool, best_by_id: Dict[str, float],
+                    metas_by_id: Dict[str, Dict[str, Any]], capacity_ok: Dict[tuple, bool]) -> List[SearchResult]:
     suggestions = [SearchResult(establishment_id=eid, name=str((metas_by_id.get(eid) or {}).get('name') or '')) for eid in best_by_id.keys()]
 
     # Hậu kiểm thêm: lọc theo khả dụng dựa trên travel_companion (số khách) và ngày, nếu cung cấp
-    def infer_num_guests(companion_val: Optional[str]) -> Optional[int]:
-        if not companion_val:
-            return None
-        try:
-            tc = str(companion_val).strip().lower()
-            mapping = {"single": 1, "couple": 2, "family": 4, "friends": 3}
-            return mapping.get(tc, int(float(tc)))
-        except Exception:
+    if plan["num_guests"] is not None:
+        suggestions = [
+            s for s in suggestions
+            if capacity_ok.get((s.establishment_id, plan["num_guests"], plan["start_dt"], plan["end_dt"]), True)
+        ]
+
+    # Ngày linh hoạt: chỉ giữ cơ sở có ít nhất một khoảng N đêm còn trống (lỗi DB/hết ngân sách → giữ nguyên;
+    # cơ sở chưa có dữ liệu phòng được giữ nhưng không có date_options)
+    if plan["flex"] and suggestions:
+        candidates = suggestions[:FLEX_CANDIDATES]
+        options = optional_stage("rag_search", "flex_dates", lambda: flexible_date_options(
+            plan, [s.establishment_id for s in candidates]), None)
+        if options is not None:
+            suggestions = [s for s in candidates if s.establishment_id in options]
+            for s in suggestions:
+                s.date_options = options[s.establishment_id]
+
+    # Không dùng fallback nới lỏng; trả đúng những gì VectorStore tìm thấy sau hậu kiểm
+
+    # Trả về đúng 3 cơ sở điểm tốt nhất (score nhỏ hơn là tốt hơn)
+    # Giữ nguyên thứ tự tốt nhất dựa trên score đã chọn trước đó; cắt còn 3
+    suggestions = suggestions[:3]
+
+    # Kết quả mở rộng (opt-in): dùng lại metadata Chroma đã có + 1 truy vấn giá cho cả top 3
+    if expand and suggestions:
+        cheapest = optional_stage("rag_search", "prices", lambda: fetch_cheapest_prices(
+            [s.establishment_id for s in suggestions], plan["start_dt"], plan["end_dt"], plan["num_guests"]), {})
+        for s in suggestions:
+            meta = metas_by_id.get(s.establishment_id) or {}
+            s.image_url_main = meta.get('image_url_main') or meta.get('imageUrlMain') or None
+            s.city = meta.get('city') or None
+            s.type = meta.get('type') or None
+            s.price_range_vnd = as_int(meta.get('price_range_vnd'))
+            s.star_rating = as_int(meta.get('star_rating'))
+            s.score = float(best_by_id[s.establishment_id])
+            s.min_available_price = cheapest.get(s.establishment_id)
+    return suggestions
+
+
+# --- PHÂN MẢNH THEO THÀNH PHỐ (tuỳ chọn): mỗi city chuẩn hoá một collection Chroma ---
+def city_shard(city: Optional[str]) -> Optional[str]:
+    """Tên canonical (khóa của CITY_DISPLAY) cho city; None nếu không nhận ra."""
+    if not city:
+        return None
+    folded = alias_key(city)
+    canonical = CITY_ALIASES.get(folded) or CITY_ALIASES.get(folded.replace(" ", ""))
+    if canonical:
+        return canonical
+    if folded.replace(" ", "") in CITY_DISPLAY:
+        return folded.replace(" ", "")
+    guessed = infer_city_from_text(city)
+    return next((k for k, v in CITY_DISPLAY.items() if v == guessed), None) if guessed else None
+
+
+def _where_city(where: Optional[Dict[str, Any]]) -> Optional[str]:
+    # {"city": X} hoặc {"$and": [{"city": X}, ...]} → X
+    if not where:
+        return None
+    if isinstance(where.get("city"), str):
+        return where["city"]
+    for cond in where.get("$and") or []:
+        if isinstance(cond, dict) and isinstance(cond.get("city"), str):
+            return cond["city"]
+    return None
+
+
+class ShardedCollection:
+    """Mặt tiền cùng API với chromadb Collection (get/update/delete/count/query) trên nhiều collection theo city.
+
+    Cơ sở không nhận ra city nằm ở shard "other". Truy vấn biết city chỉ chạm một shard; không biết city thì
+    fan-out song song rồi gộp theo distance.
+    """
+
+    OTHER = "other"
+
+    def __init__(self, client: Any, base_name: str):
+        self.client = client
+        self.base_name = base_name
+        self._shards: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        prefix = f"{base_name}__"
+        for col in client.list_collections():
+            name = col if isinstance(col, str) else col.name
+            if name.startswith(prefix):
+                self._shards[name[len(prefix):]] = client.get_collection(name, embedding_function=None)
+
+    def shard_name(self, city: Optional[str]) -> str:
+        return city_shard(city) or self.OTHER
+
+    def collection(self, shard: str, create: bool = False) -> Optional[Any]:
+        with self._lock:
+            col = self._shards.get(shard)
+            if col is None and create:
+                col = self._shards[shard] = self.client.get_or_create_collection(
+                    f"{self.base_name}__{shard}", embedding_function=None)
+            return col
+
+    def _targets(self, where: Optional[Dict[str, Any]] = None) -> List[Any]:
+        city = _where_city(where)
+        if city is not None:
+            col = self.collection(self.shard_name(city))
+            return [col] if col is not None else []
+        with self._lock:
+            return list(self._shards.values())
+
+    def add(self, ids: List[str], embeddings: List[List[float]], metadatas: List[Dict[str, Any]],
+            documents: List[str]) -> None:
+        groups: Dict[str, List[int]] = {}
+        for i, meta in enumerate(metadatas):
+            groups.setdefault(self.shard_name((meta or {}).get("city")), []).append(i)
+        for shard, idx in groups.items():
+            self.collection(shard, create=True).add(
+                ids=[ids[i] for i in idx], embeddings=[embeddings[i] for i in idx],
+                metadatas=[metadatas[i] for i in idx], documents=[documents[i] for i in idx])
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None,
+            include: Optional[List[str]] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        include = include or ["metadatas", "documents"]
+        out: Dict[str, Any] = {"ids": [], **{k: [] for k in include}}
+        for col in self._targets(where):
+            remaining = None if limit is None else limit - len(out["ids"])
+            if remaining is not None and remaining <= 0:
+                break
+            kwargs: Dict[str, Any] = {"include": include}
+            if ids is not None:
+                kwargs["ids"] = ids
+            if where:
+                kwargs["where"] = where
+            if remaining is not None:
+                kwargs["limit"] = remaining
+            part = col.get(**kwargs)
+            out["ids"] += list(part.get("ids") or [])
+            for k in include:
+                values = part.get(k)
+                out[k] += list(values) if values is not None else []
+        return out
+
+    def update(self, ids: List[str], metadatas: List[Dict[str, Any]]) -> None:
+        # Đổi city là đổi trường văn bản → đi đường embed lại (xoá + thêm), nên update luôn ở shard cũ
+        wanted = dict(zip(ids, metadatas))
+        for col in self._targets():
+            present = col.get(ids=list(wanted), include=[]).get("ids") or []
+            if present:
+                col.update(ids=present, metadatas=[wanted[i] for i in present])
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None) -> None:
+        for col in self._targets(where):
+            if ids is not None:
+                col.delete(ids=ids)
+            else:
+                col.delete(where=where)
+
+    def count(self) -> int:
+        return sum(col.count() for col in self._targets())
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            shards = list(self._shards.items())
+        return {name: col.count() for name, col in shards}
+
+    def query(self, query_embeddings: List[List[float]], n_results: int, include: List[str],
+              cities: Optional[List[Optional[str]]] = None) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"ids": [], "metadatas": [], "distances": []}
+        for i, vec in enumerate(query_embeddings):
+            city = (cities or [None] * len(query_embeddings))[i]
+            if city and city_shard(city):
+                col = self.collection(self.shard_name(city))
+                targets = [col] if col is not None else []
+            else:
+                targets = self._targets()
+            parts = list(_shard_pool.map(
+                lambda col: col.query(query_embeddings=[vec], n_results=n_results,
+                                      include=["metadatas", "distances"]), targets)) if targets else []
+            hits = sorted(
+                ((d, m, doc_id) for p in parts
+                 for doc_id, m, d in zip(p["ids"][0], p["metadatas"][0], p["distances"][0])),
+                key=lambda h: h[0]
+            )[:n_results]
+            out["ids"].append([h[2] for h in hits])
+            out["metadatas"].append([h[1] for h in hits])
+            out["distances"].append([h[0] for h in hits])
+        return out
+
+
+class ShardedVectorStore:
+    """Thay cho langchain Chroma khi INDEX_SHARD_MODE=city: add_texts định tuyến theo metadata city."""
+
+    def __init__(self, client: Any, base_name: str, embedding_function: Any):
+        self._collection = ShardedCollection(client, base_name)
+        self.embeddings = embedding_function
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        ids = [str(uuid.uuid4()) for _ in texts]
+        vectors = self.embeddings.embed_documents(list(texts))
+        self._collection.add(ids=ids, embeddings=vectors, metadatas=metadatas or [{} for _ in texts],
+                             documents=list(texts))
+        return ids
+
+
+_shard_pool = ThreadPoolExecutor(max_workers=SHARD_FANOUT_WORKERS, thread_name_prefix="shard-query")
+if INDEX_SHARD_MODE == "city" and vectorstore is not None and embeddings is not None:
+    try:
+        vectorstore = ShardedVectorStore(chroma_client, collection_name, embeddings)
+        logger.info("City-sharded vector store: %s", vectorstore._collection.counts())
+    except Exception as e:
+        logging.warning("City sharding init failed, using single collection: %s", getattr(e, "message", str(e)))
+
+
+# --- CHỈ MỤC VECTOR NÉN (quantized_index.py): giảm chiều + lượng tử hoá, xếp hạng lại bằng float32 ---
+def load_index_vectors() -> tuple:
+    """Nguồn dữ liệu của QuantizedIndex: (ids, embeddings, metadatas) đang lưu trong Chroma."""
+    if vectorstore is None:
+        raise RuntimeError("Vector Store chưa được khởi tạo")
+    data = vectorstore._collection.get(include=["embeddings", "metadatas"])  # type: ignore
+    embs = data.get("embeddings")
+    return data.get("ids") or [], embs if embs is not None else [], data.get("metadatas") or []
+
+
+quantized_index: Optional[QuantizedIndex] = None
+if VECTOR_STORAGE_MODE in ("int8", "binary") or VECTOR_DIMS > 0:
+    quantized_index = QuantizedIndex(VECTOR_STORAGE_MODE, VECTOR_DIMS, VECTOR_REDUCTION,
+                                     VECTOR_RERANK_POOL, VECTOR_FLOAT_PATH, loader=load_index_vectors)
+
+
+# --- EPOCH INDEX: tăng sau mỗi lần ghi/xoá Chroma → ETag của /rag-search; caller gửi If-None-Match nhận 304 ---
+INDEX_EPOCH_HEADER = "X-Index-Epoch"
+# Epoch đếm trong RAM: mỗi lần khởi động có boot id riêng để ETag cũ không trùng epoch mới
+INDEX_BOOT_ID = uuid.uuid4().hex[:8]
+# Kết quả phụ thuộc phòng trống/giá (có số khách, ngày linh hoạt, expand) đổi theo đặt phòng chứ không theo
+# index → ETag của chúng còn gắn với cửa sổ thời gian này (0 = không cấp ETag cho các tìm kiếm đó)
+RAG_INVENTORY_TTL_S = float(os.getenv("RAG_INVENTORY_TTL_S", "60"))
+
+_index_epoch = {"value": 0}
+_index_epoch_lock = threading.Lock()
+
+
+def bump_index_epoch() -> int:
+    with _index_epoch_lock:
+        _index_epoch["value"] += 1
+        return _index_epoch["value"]
+
+
+def search_etag(plan: Dict[str, Any], expand: bool, epoch: int) -> Optional[str]:
+    """ETag của một lần tìm kiếm: boot id + epoch index + kế hoạch đã chuẩn hoá; None nếu không nên cache."""
+    parts = [search_plan_key(plan), "expand" if expand else ""]
+    if plan["num_guests"] is not None or plan["flex"] or expand:
+        if RAG_INVENTORY_TTL_S <= 0:
             return None
+        parts.append(str(int(time.time() // RAG_INVENTORY_TTL_S)))
+    digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+    return f'"{INDEX_BOOT_ID}-{epoch}-{digest}"'
 
-    num_guests = infer_num_guests(companion)
 
-    # Chuẩn hoá ngày nếu có
-    start_dt = None
-    end_dt = None
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    if not if_none_match or not etag:
+        return False
+    # "*" khớp mọi phiên bản đang có (RFC 9110 §13.1.2)
+    if if_none_match.strip() == "*":
+        return True
+    # Danh sách "a", W/"b": so khớp yếu (bỏ tiền tố W/)
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+
+def on_index_changed(upserted: Optional[List[Dict[str, Any]]] = None, removed: Optional[List[str]] = None) -> None:
+    """Gọi sau mỗi lần ghi/xoá document trong Chroma.
+
+    `upserted` (metadata vừa ghi) / `removed` (id cơ sở vừa xoá) cho phép cập nhật facet tăng dần;
+    không truyền gì thì facet được dựng lại ở lần dùng sau.
+    """
+    bump_index_epoch()
+    if quantized_index is not None:
+        quantized_index.invalidate()
+    catalog_stats.invalidate()
+    if upserted is None and removed is None:
+        facet_index.invalidate()
+    else:
+        facet_index.upsert(upserted or [])
+        facet_index.remove(removed or [])
+    # Kết quả prefetch có thể chứa cơ sở vừa bị xoá/đổi
+    clear_prefetched_searches()
+
+
+@CHROMA_BULKHEAD.guard
+def vector_search_many(vectors: List[List[float]], k: int,
+                       cities: Optional[List[Optional[str]]] = None) -> List[List[tuple]]:
+    """Tìm k láng giềng gần nhất cho nhiều vector; trả về [(metadata, distance)] cho từng vector.
+
+    `cities` (nếu có) chỉ dùng để định tuyến shard khi INDEX_SHARD_MODE=city.
+    """
+    if quantized_index is not None:
+        return quantized_index.search_many(vectors, k)
+    kwargs: Dict[str, Any] = {}
+    if isinstance(vectorstore, ShardedVectorStore):
+        kwargs["cities"] = cities
+    raw = vectorstore._collection.query(  # type: ignore
+        query_embeddings=vectors,
+        n_results=k,
+        include=["metadatas", "distances"],
+        **kwargs
+    )
+    out: List[List[tuple]] = []
+    for i in range(len(vectors)):
+        metas = (raw.get("metadatas") or [[]])[i] or []
+        dists = (raw.get("distances") or [[]])[i] or []
+        out.append(list(zip(metas, dists)))
+    return out
+
+
+# --- KẾ HOẠCH TRUY VẤN (search_planner.py): vector trước hay SQL trước ---
+def load_index_metadatas() -> List[Dict[str, Any]]:
+    """Nguồn dữ liệu của CatalogStats và FacetIndex: chỉ metadata, không đọc embeddings."""
+    return vectorstore._collection.get(include=["metadatas"]).get("metadatas") or []  # type: ignore
+
+
+catalog_stats = CatalogStats(
+    PLANNER_STATS_TTL_S, PLANNER_SQL_COOLDOWN_S, load_index_metadatas, strip_accents,
+    city_sharded=lambda city_norm: isinstance(vectorstore, ShardedVectorStore) and bool(city_shard(city_norm)))
+
+
+@POSTGRES_BULKHEAD.guard
+def fetch_eligible_establishment_ids(cities: List[str], est_type: Optional[str], limit: int) -> Optional[List[str]]:
+    """ID cơ sở đang mở thoả city/type trong MỘT truy vấn; None nếu lỗi DB.
+
+    Sức chứa/ngày không lọc ở đây: execute_search áp cùng check_capacity_availability cho cả hai kế hoạch.
+    """
     try:
-        if check_in_date:
-            from datetime import datetime, timedelta
-            start_dt = datetime.strptime(str(check_in_date), "%Y-%m-%d")
-            if check_out_date:
-                end_dt = datetime.strptime(str(check_out_date), "%Y-%m-%d")
-            elif duration:
-                try:
-                    dur = int(str(duration))
-                    end_dt = start_dt + timedelta(days=max(1, dur))
-                except Exception:
-                    end_dt = None
-    except Exception:
-        start_dt = None
-        end_dt = None
+        with connect() as conn:
+            cur = conn.cursor()
+            conds = ["COALESCE(e.is_available, TRUE)"]
+            args: List[Any] = []
+            if cities:
+                conds.append("e.city = ANY(%s)")
+                args.append(cities)
+            if est_type:
+                conds.append("UPPER(e.type::text) = %s")
+                args.append(str(est_type).strip().upper())
+            cur.execute(f"SELECT e.id FROM establishment e WHERE {' AND '.join(conds)} LIMIT %s", (*args, limit))
+            return [str(r[0]) for r in cur.fetchall()]
+    except Exception as error:
+        logging.error("DB error in fetch_eligible_establishment_ids: %s", error)
+        return None
 
-    if num_guests is not None:
+
+@CHROMA_BULKHEAD.guard
+def vector_rank_ids(vector: List[float], establishment_ids: List[str]) -> List[tuple]:
+    """Xếp hạng chính xác mọi chunk của các cơ sở cho trước: [(metadata, L2²)] tăng dần, cùng thang với Chroma."""
+    got = vectorstore._collection.get(  # type: ignore
+        where={"id": {"$in": list(establishment_ids)}}, include=["embeddings", "metadatas"])
+    metas = got.get("metadatas") or []
+    if not metas:
+        return []
+    X = np.asarray(got["embeddings"], dtype=np.float32)
+    dist = ((X - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+    return [(metas[j], float(dist[j])) for j in np.argsort(dist)]
+
+
+def sql_first_search(plan: Dict[str, Any], query_vector: List[float], operation: str) -> Optional[tuple]:
+    """ID hợp lệ từ Postgres → xếp hạng vector chỉ trên các ID đó; (best_by_id, metas_by_id) hoặc None nếu phải
+    quay về vector trước."""
+    cities = catalog_stats.spellings(plan["city_norm"]) if plan["city_norm"] else []
+    if plan["city"] and plan["city"] not in cities:
+        cities.append(plan["city"])
+    check_budget(operation, "sql_candidates")
+    with stage_timer(operation, "sql_candidates"):
         try:
-            conn = psycopg2.connect(
-                host=DB_CONFIG['host'],
-                port=DB_CONFIG['port'],
-                database=DB_CONFIG['database'],
-                user=DB_CONFIG['user'],
-                password=DB_CONFIG['password']
+            ids = fetch_eligible_establishment_ids(cities, plan["est_type"], PLANNER_SQL_MAX_IDS + 1)
+            if ids is None:
+                catalog_stats.mark_sql_failed()
+        except Overloaded:
+            ids = None
+    if ids is None or len(ids) > PLANNER_SQL_MAX_IDS:
+        return None
+    check_budget(operation, "id_rank")
+    with stage_timer(operation, "id_rank"):
+        results = vector_rank_ids(query_vector, ids) if ids else []
+    check_budget(operation, "post_filter")
+    with stage_timer(operation, "post_filter"):
+        return post_filter_candidates(results, plan)
+
+
+# --- FACET (facets.py): số cơ sở theo (city, type) cho từng tiện ích / khoảng giá / hạng sao / sức chứa ---
+facet_index = FacetIndex(FACET_PRICE_BUCKETS, AMENITY_VOCAB, load_index_metadatas, strip_accents, meta_amenity_mask)
+
+# Tiện ích có sẵn nhãn trong FALLBACK_OPTIONS giữ nguyên cách viết đó trong lựa chọn quiz
+_AMENITY_OPTION_LABELS: Dict[str, str] = {}
+for _label in FALLBACK_OPTIONS.get("amenities_priority", []):
+    for _amenity_id in AMENITY_VOCAB.ids:
+        if AMENITY_VOCAB.mask(_label) & AMENITY_VOCAB.bit[_amenity_id]:
+            _AMENITY_OPTION_LABELS.setdefault(_amenity_id, _label)
+
+
+def facet_options(missing_key: str, params: Dict[str, Any]) -> Optional[List[str]]:
+    """Lựa chọn quiz cho `missing_key` mà mỗi lựa chọn đều có cơ sở khớp city/type đã chọn.
+
+    Không có dữ liệu cho city/type (hoặc lỗi đọc index) → FALLBACK_OPTIONS như trước.
+    """
+    fallback = FALLBACK_OPTIONS.get(missing_key)
+    if vectorstore is None or missing_key not in ("establishment_type", "amenities_priority",
+                                                  "travel_companion", "max_price"):
+        return fallback
+    try:
+        with stage_timer("generate_quiz", "facet_options"):
+            agg = facet_index.aggregate(params.get("city"), params.get("establishment_type") or params.get("type"))
+    except Exception as e:
+        logger.warning("Facet index unavailable: %s", getattr(e, 'message', str(e)))
+        return fallback
+    if missing_key == "establishment_type":
+        return [t for t in fallback or [] if agg["types"].get(t)] or fallback
+    if agg["count"] == 0:
+        return fallback
+    if missing_key == "amenities_priority":
+        amenities = params.get("amenities_priority")
+        chosen, _ = AMENITY_VOCAB.parse(amenities if isinstance(amenities, list) else str(amenities or "").split(","))
+        options = []
+        for i in np.argsort(-agg["amenities"], kind="stable"):
+            amenity_id = AMENITY_VOCAB.ids[i]
+            if agg["amenities"][i] <= 0 or len(options) >= FACET_AMENITY_OPTIONS:
+                break
+            if not chosen & AMENITY_VOCAB.bit[amenity_id]:
+                options.append(_AMENITY_OPTION_LABELS.get(amenity_id, AMENITY_VOCAB.display[amenity_id]))
+        return options or None
+    if missing_key == "travel_companion":
+        # Có cơ sở chưa rõ sức chứa thì không loại lựa chọn nào
+        if not agg["capacity"] or None in agg["capacity"]:
+            return fallback
+        max_capacity = max(agg["capacity"])
+        return [o for o in fallback or [] if (infer_num_guests(o) or 0) <= max_capacity] or fallback
+    # max_price: mốc giá mà ít nhất một cơ sở có giá không vượt quá
+    cumulative = np.cumsum(agg["prices"][:len(FACET_PRICE_BUCKETS)])
+    return [str(edge) for edge, n in zip(FACET_PRICE_BUCKETS, cumulative) if n > 0] or fallback
+
+
+@app.get("/facets")
+async def facets(city: Optional[str] = None, type: Optional[str] = None):
+    if vectorstore is None:
+        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo")
+    return await asyncio.to_thread(facet_index.summary, city, type)
+
+
+@app.post("/rag-search", response_model=List[SearchResult], response_model_exclude_none=True)
+@timed_operation("rag_search")
+async def rag_search(req: SearchRequest, request: Request, response: Response):
+    if not vectorstore:
+        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo")
+
+    plan = prepare_search(req.params)
+    # Epoch đọc TRƯỚC khi tìm: index đổi giữa chừng thì ETag đã cũ, lần sau tính lại
+    epoch = _index_epoch["value"]
+    etag = search_etag(plan, req.expand, epoch)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, INDEX_EPOCH_HEADER: str(epoch)})
+    found = await get_prefetched_search(plan)
+
+    def search_and_finalize() -> List[SearchResult]:
+        # Một lần chuyển sang thread cho cả tìm kiếm lẫn hậu xử lý: ít task/watcher hơn trên event loop
+        best_by_id, metas_by_id, capacity_ok = found or execute_search(plan, "rag_search")
+        with stage_timer("rag_search", "finalize"):
+            return finalize_search(plan, req.expand, best_by_id, metas_by_id, capacity_ok)
+
+    results = await await_within_budget(asyncio.to_thread(search_and_finalize), request)
+    mark_partial(response)
+    response.headers[INDEX_EPOCH_HEADER] = str(epoch)
+    # Kết quả một phần (bỏ bước vì hết hạn) không được cache
+    if etag and PARTIAL_RESULT_HEADER not in response.headers:
+        response.headers["ETag"] = etag
+    return results
+
+
+embedding_flight = SingleFlight("query_embedding")
+
+
+def embed_query_guarded(text: str) -> List[float]:
+    if isinstance(embeddings, BatchingEmbeddings):
+        # Bulkhead áp dụng cho từng lô gửi provider, không giữ slot khi chỉ chờ lô
+        return embeddings.embed_query(text)
+    with EMBEDDINGS_BULKHEAD.slot():
+        return embeddings.embed_query(text)
+
+
+def execute_search(plan: Dict[str, Any], operation: str) -> tuple:
+    """Embed + truy vấn vector + hậu kiểm + kiểm tra DB; trả (best_by_id, metas_by_id, capacity_ok)."""
+    # Tăng k để có nhiều ứng viên hơn trước khi hậu kiểm
+    search_kwargs = {"k": SEARCH_K}
+    if embeddings is not None:
+        # Tách embed và truy vấn Chroma để đo riêng từng bước
+        check_budget(operation, "embedding")
+        with stage_timer(operation, "embedding"):
+            query_vector = embedding_flight.do(plan["query_text"], lambda: embed_query_guarded(plan["query_text"]))
+        route, reason = choose_search_plan(plan, catalog_stats, SEARCH_K, SEARCH_PLANNER_MODE)
+        found = sql_first_search(plan, query_vector, operation) if route == "sql" else None
+        if route == "sql" and found is None:
+            route, reason = "vector", "sql_fallback"
+        SEARCH_PLANS.inc(plan=route, reason=reason)
+        logger.debug("Search plan=%s reason=%s city=%s type=%s", route, reason, plan["city"], plan["est_type"])
+        if found is None:
+            check_budget(operation, "chroma_query")
+            with stage_timer(operation, "chroma_query"):
+                results = vector_search_many([query_vector], SEARCH_K, cities=[plan["city"]])[0]
+    else:
+        found = None
+        with stage_timer(operation, "chroma_query"):
+            docs = vectorstore.similarity_search_with_score(query=plan["query_text"], **search_kwargs)
+        results = [(doc.metadata, score) for doc, score in docs]
+
+    if found is not None:
+        best_by_id, metas_by_id = found
+    else:
+        check_budget(operation, "post_filter")
+        with stage_timer(operation, "post_filter"):
+            best_by_id, metas_by_id = post_filter_candidates(results, plan)
+    # Cùng một bước lọc khả dụng cho cả hai kế hoạch; không bắt buộc: hết ngân sách thì giữ nguyên danh sách
+    # (như khi lỗi DB)
+    with stage_timer(operation, "db_capacity"):
+        checks = capacity_checks_for(plan, list(best_by_id.keys()))
+        capacity_ok = optional_stage(operation, "availability", lambda: check_capacity_availability(checks), {})
+    return best_by_id, metas_by_id, capacity_ok
+
+
+# --- PREFETCH: quiz sắp xong (chỉ còn tiện ích) → chạy trước tìm kiếm và giữ kết quả cho /rag-search ---
+RAG_PREFETCH_ENABLED = os.getenv("RAG_PREFETCH_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+RAG_PREFETCH_TTL_S = float(os.getenv("RAG_PREFETCH_TTL_S", "120"))
+RAG_PREFETCH_MAX = int(os.getenv("RAG_PREFETCH_MAX", "256"))
+RAG_PREFETCH_WAIT_S = float(os.getenv("RAG_PREFETCH_WAIT_S", "5"))
+PREFETCH_KEYS = ("amenities_priority", "_amenities_confirmed")
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_PREFETCH_WORKERS", "2")),
+                                        thread_name_prefix="rag-prefetch")
+_prefetched: Dict[str, tuple[float, Future]] = {}
+_prefetch_lock = threading.Lock()
+
+
+def search_plan_key(plan: Dict[str, Any]) -> str:
+    """Khóa theo kế hoạch tìm kiếm đã chuẩn hoá: các khóa không ảnh hưởng (vd. _amenities_confirmed) bị bỏ qua."""
+    return hashlib.sha1(json.dumps(plan, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def schedule_search_prefetch(params: Dict[str, Any]) -> bool:
+    """Chạy nền tìm kiếm cho params hiện tại; trả False nếu đã có/không khả dụng."""
+    if not RAG_PREFETCH_ENABLED or vectorstore is None:
+        return False
+    plan = prepare_search(params)
+    key = search_plan_key(plan)
+    now = time.time()
+    with _prefetch_lock:
+        entry = _prefetched.get(key)
+        if entry is not None and now - entry[0] <= RAG_PREFETCH_TTL_S:
+            return False
+        for k in [k for k, (ts, _) in _prefetched.items() if now - ts > RAG_PREFETCH_TTL_S]:
+            del _prefetched[k]
+        while len(_prefetched) >= RAG_PREFETCH_MAX:
+            _prefetched.pop(next(iter(_prefetched)))
+        _prefetched[key] = (now, _prefetch_executor.submit(execute_search, plan, "rag_prefetch"))
+    return True
+
+
+async def get_prefetched_search(plan: Dict[str, Any]) -> Optional[tuple]:
+    """Kết quả prefetch khớp kế hoạch (chờ nếu đang chạy); None nếu không có, hết hạn hoặc lỗi."""
+    if not RAG_PREFETCH_ENABLED:
+        return None
+    key = search_plan_key(plan)
+    with _prefetch_lock:
+        entry = _prefetched.get(key)
+    if entry is None or time.time() - entry[0] > RAG_PREFETCH_TTL_S:
+        record_cache("rag_prefetch", False)
+        return None
+    try:
+        with stage_timer("rag_search", "prefetch_wait"):
+            # shield: hết thời gian chờ chỉ bỏ lượt chờ này, không huỷ Future prefetch mà request khác đang dùng chung
+            found = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(entry[1])), timeout=RAG_PREFETCH_WAIT_S)
+    except asyncio.CancelledError:
+        if not entry[1].cancelled():
+            raise
+        # Prefetch đã bị huỷ (không phải request này) → tìm trực tiếp
+        logger.warning("Prefetched search was cancelled, searching inline")
+        record_cache("rag_prefetch", False)
+        return None
+    except Exception as e:
+        logger.warning("Prefetched search unusable, searching inline: %s", getattr(e, 'message', str(e)))
+        record_cache("rag_prefetch", False)
+        return None
+    record_cache("rag_prefetch", True)
+    return found
+
+
+def clear_prefetched_searches() -> None:
+    with _prefetch_lock:
+        _prefetched.clear()
+
+
+class BatchSearchRequest(BaseModel):
+    requests: List[SearchRequest]
+
+
+@app.post("/rag-search/batch", response_model=List[List[SearchResult]], response_model_exclude_none=True)
+@timed_operation("rag_search_batch")
+async def rag_search_batch(req: BatchSearchRequest):
+    """Nhiều bộ tham số trong một lần gọi: 1 lần embed, 1 lần truy vấn Chroma, 1 lượt kiểm tra DB."""
+    if not vectorstore or embeddings is None:
+        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo")
+    if not req.requests:
+        return []
+
+    plans = [prepare_search(r.params) for r in req.requests]
+    # Khử trùng lặp câu truy vấn: các biến thể chỉ khác ngày/số khách dùng chung một vector
+    unique_texts = list(dict.fromkeys(p["query_text"] for p in plans))
+    # Câu truy vấn chứa city nên mỗi câu ứng với đúng một city (dùng để định tuyến shard)
+    city_by_text = {p["query_text"]: p["city"] for p in plans}
+    try:
+        with stage_timer("rag_search_batch", "embedding"):
+            if isinstance(embeddings, BatchingEmbeddings):
+                vectors = await asyncio.to_thread(embeddings.embed_queries, unique_texts)
+            else:
+                async with EMBEDDINGS_BULKHEAD.async_slot():
+                    vectors = await asyncio.to_thread(embed_query_batch, embeddings, unique_texts)
+        with stage_timer("rag_search_batch", "chroma_query"):
+            raw = await asyncio.to_thread(vector_search_many, vectors, SEARCH_K,
+                                          [city_by_text[t] for t in unique_texts])
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error("Batch vector lookup failed: %s", getattr(e, 'message', str(e)))
+        raise HTTPException(status_code=502, detail=f"Lỗi truy vấn Vector Store: {e}")
+
+    results_by_text: Dict[str, List[Any]] = dict(zip(unique_texts, raw))
+
+    with stage_timer("rag_search_batch", "post_filter"):
+        filtered = [post_filter_candidates(results_by_text[p["query_text"]], p) for p in plans]
+
+    # Hợp tất cả ứng viên để kiểm tra sức chứa/khả dụng trên một kết nối DB
+    checks: set = set()
+    for p, (best_by_id, _) in zip(plans, filtered):
+        checks |= capacity_checks_for(p, list(best_by_id.keys()))
+    with stage_timer("rag_search_batch", "db_capacity"):
+        capacity_ok = await asyncio.to_thread(check_capacity_availability, checks)
+
+    def finalize_all():
+        return [
+            finalize_search(p, r.expand, best_by_id, metas_by_id, capacity_ok)
+            for p, r, (best_by_id, metas_by_id) in zip(plans, req.requests, filtered)
+        ]
+    return await asyncio.to_thread(finalize_all)
+
+
+# --- HÀNG ĐỢI INDEX (SQLite, bền vững qua restart; xem index_queue.py) ---
+def process_index_jobs(queue: IndexQueue, jobs: List[tuple]) -> None:
+    """Callback của worker hàng đợi: xoá/embed theo lô rồi đánh dấu job xong (job lỗi do IndexQueue thử lại)."""
+    if vectorstore is None or embeddings is None:
+        raise RuntimeError("Vector Store chưa được khởi tạo")
+    removes = [j for j in jobs if j[1] == "remove"]
+    adds = [j for j in jobs if j[1] == "add"]
+    if removes:
+        with stage_timer("index_worker", "chroma_delete"):
+            vectorstore._collection.delete(where={"id": {"$in": [j[0] for j in removes]}})  # type: ignore
+        on_index_changed(removed=[j[0] for j in removes])
+        queue.complete(removes)
+    if adds:
+        with stage_timer("index_worker", "db_fetch"):
+            rows = fetch_establishments_batch([j[0] for j in adds])
+        missing = [j for j in adds if j[0] not in rows]
+        if missing:
+            # Không còn trong DB (đã xoá) → xoá luôn document cũ khỏi Chroma
+            missing_ids = [j[0] for j in missing]
+            logger.warning("Index jobs for establishments not found in DB, removing from Chroma: %s", missing_ids)
+            with stage_timer("index_worker", "chroma_delete"):
+                vectorstore._collection.delete(where={"id": {"$in": missing_ids}})  # type: ignore
+            on_index_changed(removed=missing_ids)
+            queue.complete(missing, result="not_found")
+        found = [j for j in adds if j[0] in rows]
+        if not found:
+            return
+        outcome = upsert_index_documents({j[0]: rows[j[0]] for j in found})
+        logger.info("Indexed %s establishments in one batch: %s", len(found), outcome)
+        for result in ("reembedded", "metadata_only"):
+            done = [j for j in found if outcome.get(j[0]) == result]
+            if done:
+                queue.complete(done, result=result)
+
+
+# Các trường nằm trong source_text: đổi các trường này mới cần embed lại
+TEXT_FIELDS = ("name", "city", "type", "price_range_vnd", "star_rating", "amenities_list", "description_long")
+
+
+def upsert_index_documents(rows: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """Đồng bộ các cơ sở vào Chroma; chỉ embed lại khi trường văn bản đổi.
+
+    Trả về {id: "reembedded" | "metadata_only"}.
+    """
+    if not rows:
+        return {}
+    ids = list(rows.keys())
+    existing = vectorstore._collection.get(where={"id": {"$in": ids}}, include=["metadatas"])  # type: ignore
+    docs_by_est: Dict[str, List[tuple[str, Dict[str, Any]]]] = {}
+    for doc_id, meta in zip(existing.get("ids") or [], existing.get("metadatas") or []):
+        est_id = str((meta or {}).get("id") or "")
+        docs_by_est.setdefault(est_id, []).append((doc_id, meta or {}))
+
+    outcome: Dict[str, str] = {}
+    reembed: List[str] = []
+    for est_id, row in rows.items():
+        docs = docs_by_est.get(est_id, [])
+        old = docs[0][1] if docs else None
+        chunked = INDEX_CHUNK_MODE == "chunked"
+        # Không trùng lặp document, cùng chế độ chunk và văn bản không đổi → chỉ cập nhật metadata
+        reusable = (
+            old is not None
+            and len({m.get("chunk_index") for _, m in docs}) == len(docs)
+            and all(bool(m.get("chunk_type")) == chunked for _, m in docs)
+            and all(
+                str(row.get(f) if row.get(f) is not None else '') == str(old.get(f) if old.get(f) is not None else '')
+                for f in TEXT_FIELDS
             )
-            cur = conn.cursor()
-            try:
-                cur.execute("SET search_path TO public;")
-            except Exception:
-                pass
+        )
+        if reusable:
+            if any(row.get(k) != old.get(k) for k in row):
+                # amenities_list là trường văn bản (không đổi ở nhánh này) → giữ nguyên amenity_mask cũ
+                kept_keys = ("parent_id", "chunk_type", "chunk_index", "amenity_mask")
+                updated = [{**row, **{k: m[k] for k in kept_keys if k in m}} for _, m in docs]
+                with stage_timer("index_worker", "chroma_metadata_update"):
+                    vectorstore._collection.update(  # type: ignore
+                        ids=[d for d, _ in docs],
+                        metadatas=updated
+                    )
+                on_index_changed(upserted=updated)
+            outcome[est_id] = "metadata_only"
+        else:
+            reembed.append(est_id)
+
+    if reembed:
+        # Thay thế bản cũ thay vì thêm bản trùng cho mỗi lần cập nhật
+        stale = [d for i in reembed for d, _ in docs_by_est.get(i, [])]
+        if stale:
+            with stage_timer("index_worker", "chroma_delete"):
+                vectorstore._collection.delete(ids=stale)  # type: ignore
+        texts: List[str] = []
+        metadatas: List[Dict[str, Any]] = []
+        for i in reembed:
+            t, m = build_index_documents(rows[i])
+            texts += t
+            metadatas += m
+        with stage_timer("index_worker", "embed_and_write"):
+            vectorstore.add_texts(texts=texts, metadatas=metadatas)
+        on_index_changed(upserted=metadatas)
+        for i in reembed:
+            outcome[i] = "reembedded"
+    return outcome
+
+
+index_queue: Optional[IndexQueue] = None
+if INDEX_QUEUE_ENABLED:
+    try:
+        index_queue = IndexQueue(INDEX_QUEUE_PATH, process_index_jobs)
+    except Exception as e:
+        logging.warning("Index queue init failed, falling back to inline indexing: %s", e)
+        index_queue = None
+
+
+# --- ĐỒNG BỘ THAY ĐỔI TỪ POSTGRES (CDC, tuỳ chọn; xem change_sync.py) ---
+def sync_changed_establishments(ids: List[str], deleted: List[str]) -> None:
+    """Callback của ChangeSync: ids được thêm/sửa, deleted đã xoá khỏi Postgres."""
+    if index_queue is not None:
+        for est_id in ids:
+            # Worker tự phân biệt đổi text (embed lại) với đổi metadata (không embed)
+            index_queue.enqueue(est_id, "add")
+        for est_id in deleted:
+            index_queue.enqueue(est_id, "remove")
+    else:
+        rows = fetch_establishments_batch(ids)
+        missing = list(deleted) + [i for i in ids if i not in rows]
+        if missing and vectorstore is not None:
+            vectorstore._collection.delete(where={"id": {"$in": missing}})  # type: ignore
+            on_index_changed(removed=missing)
+        upsert_index_documents(rows)
 
-            def establishment_has_capacity(est_id: str) -> bool:
-                # Cố gắng kiểm tra theo nhiều tên cột khả dĩ để tránh phụ thuộc schema cứng
-                candidate_cols = [
-                    "max_guests", "maxGuests", "capacity", "base_capacity", "baseCapacity"
-                ]
-                for col in candidate_cols:
-                    try:
-                        cur.execute(f"SELECT id FROM unit_type WHERE establishment_id = %s AND {col} >= %s LIMIT 1", (est_id, num_guests))
-                        if cur.fetchone():
-                            return True
-                    except Exception:
-                        continue
-                # Nếu không dò được theo cột, coi như không lọc
-                return True
-
-            def establishment_has_availability(est_id: str) -> bool:
-                if start_dt is None or end_dt is None:
-                    return True
-                # Thử các tên cột phổ biến
-                date_col = "date"
-                avail_col_candidates = ["available", "available_count", "available_units", "availableRooms"]
-                try:
-                    # Lấy các unit_type đủ sức chứa
-                    cur.execute("SELECT id FROM unit_type WHERE establishment_id = %s", (est_id,))
-                    unit_ids = [r[0] for r in cur.fetchall()]
-                    if not unit_ids:
-                        return False
-                    for avail_col in avail_col_candidates:
-                        try:
-                            cur.execute(
-                                f"SELECT COUNT(*) FROM unit_availability WHERE unit_type_id = ANY(%s) AND {date_col} >= %s AND {date_col} < %s AND {avail_col} > 0",
-                                (unit_ids, start_dt, end_dt)
-                            )
-                            cnt = cur.fetchone()[0]
-                            if cnt and cnt > 0:
-                                return True
-                        except Exception:
-                            continue
-                    # Nếu không query được cột nào, không chặn kết quả
-                    return True
-                except Exception:
-                    return True
 
-            filtered = []
-            for s in suggestions:
-                try:
-                    if establishment_has_capacity(s.establishment_id) and establishment_has_availability(s.establishment_id):
-                        filtered.append(s)
-                except Exception:
-                    filtered.append(s)
-            suggestions = filtered
-        except Exception:
-            # Nếu lỗi DB, giữ nguyên danh sách
-            pass
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
+change_sync: Optional[ChangeSync] = None
+if CDC_SYNC_MODE in ("notify", "poll"):
+    change_sync = ChangeSync(CDC_SYNC_MODE, connect, sync_changed_establishments)
+
+
+def start_background_workers() -> None:
+    if index_queue is not None:
+        index_queue.start()
+    if change_sync is not None:
+        change_sync.start()
+
+
+def stop_background_workers() -> None:
+    if change_sync is not None:
+        change_sync.stop()
+    if index_queue is not None:
+        index_queue.stop()
 
-    # Không dùng fallback nới lỏng; trả đúng những gì VectorStore tìm thấy sau hậu kiểm
-            
-    # Trả về đúng 3 cơ sở điểm tốt nhất (score nhỏ hơn là tốt hơn)
-    # Giữ nguyên thứ tự tốt nhất dựa trên score đã chọn trước đó; cắt còn 3
-    suggestions = suggestions[:3]
-    return suggestions
 
 # --- API 3: Cập nhật Vector Store ---
 @app.post("/add-establishment")
-async def add_establishment(req: AddEstablishmentRequest):
+@timed_operation("add_establishment")
+async def add_establishment(req: AddEstablishmentRequest, response: Response):
     # 0. Kiểm tra readiness của Vector Store
     logger.info("/add-establishment called with id=%s", req.id)
     if vectorstore is None or embeddings is None:
         raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo (thiếu embeddings/API key).")
+
+    # Mặc định: xếp hàng rồi trả 202 ngay, worker nền sẽ index
+    if index_queue is not None:
+        coalesced = index_queue.enqueue(req.id, "add")
+        response.status_code = 202
+        return {"status": "queued", "id": req.id, "coalesced": coalesced}
     
     # 1. Lấy dữ liệu mới nhất từ PostgreSQL
-    new_data = fetch_single_establishment(req.id) 
+    with stage_timer("add_establishment", "db_fetch"):
+        new_data = await asyncio.to_thread(fetch_single_establishment, req.id)
 
     if not new_data:
         raise HTTPException(status_code=404, detail="Không tìm thấy dữ liệu trong DB để cập nhật RAG.")
 
     # 2. Chuẩn hóa thành source_text
     city = new_data.get('city', '')
-    amenities = new_data.get('amenities_list', '')
-    source_text = (
-        f"ID: {new_data['id']}, Tên: {new_data['name']}, Thành phố: {city}, Loại: {new_data['type']}, "
-        f"Giá: {new_data.get('price_range_vnd')}, Sao: {new_data.get('star_rating')}. "
-        f"Tiện ích: {amenities}. "
-        f"Mô tả chi tiết: {new_data['description_long']}"
-    )
+    source_text = build_source_text(new_data)
     long_desc = (new_data.get('description_long') or '')
     logger.info("Fetched establishment name=%s, city=%s, len(description)=%s", new_data.get('name'), city, len(long_desc))
     logger.info("Description snippet: %s", long_desc[:300].replace("\n", " "))
@@ -845,40 +2291,49 @@ async def add_establishment(req: AddEstablishmentRequest):
         before = None
     logger.info("Chroma count before add: %s", before)
 
-    # 3. Tạo Embeddings và thêm vào Vector Store
+    # 3. Upsert theo ID (như worker): thay document cũ thay vì thêm bản trùng mỗi lần gọi;
+    #    văn bản không đổi thì chỉ cập nhật metadata, không embed lại
     try:
-        vectorstore.add_texts(
-            texts=[source_text],
-            metadatas=[new_data]
-        )
+        with stage_timer("add_establishment", "embed_and_write"):
+            outcome = await asyncio.to_thread(upsert_index_documents, {str(new_data['id']): new_data})
         try:
-            after = vectorstore._collection.count()  # type: ignore
-            detail_after = vectorstore._collection.get(  # type: ignore
-                where={"id": req.id},
-                include=["documents","metadatas"]
-            )
+            with stage_timer("add_establishment", "chroma_readback"):
+                after = vectorstore._collection.count()  # type: ignore
+                detail_after = vectorstore._collection.get(  # type: ignore
+                    where={"id": req.id},
+                    include=["documents","metadatas"]
+                )
             logger.info("Chroma detail after add: %s", detail_after)
         except Exception:
-            after = None
+            after, detail_after = None, None
         logger.info("Added to Chroma: id=%s, count after=%s", req.id, after)
-        return {"status": "success", "message": f"Đã thêm {new_data['name']} vào Vector Store (Gemini).", "chroma_count": after, "chroma_detail": detail_after }
+        return {"status": "success", "message": f"Đã thêm {new_data['name']} vào Vector Store (Gemini).", "chroma_count": after,
+                "chroma_detail": detail_after, "index_result": outcome.get(str(new_data['id']))}
     except Exception as e:
         logger.error("Error adding to ChromaDB: %s", getattr(e, 'message', str(e)))
         raise HTTPException(status_code=500, detail=f"Lỗi khi thêm vào ChromaDB: {e}")
 
 # --- API 4: Xóa khỏi Vector Store ---
 @app.post("/remove-establishment")
-async def remove_establishment(req: AddEstablishmentRequest):
+@timed_operation("remove_establishment")
+async def remove_establishment(req: AddEstablishmentRequest, response: Response):
     logger.info("/remove-establishment called with id=%s", req.id)
     if vectorstore is None:
         raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo.")
+
+    if index_queue is not None:
+        coalesced = index_queue.enqueue(req.id, "remove")
+        response.status_code = 202
+        return {"status": "queued", "id": req.id, "coalesced": coalesced}
     
     try:
         # Lấy thông tin trước khi xóa để log
         before_count = vectorstore._collection.count()  # type: ignore
         
         # Xóa document khỏi ChromaDB
-        vectorstore._collection.delete(where={"id": req.id})  # type: ignore
+        with stage_timer("remove_establishment", "chroma_delete"):
+            vectorstore._collection.delete(where={"id": req.id})  # type: ignore
+        on_index_changed(removed=[req.id])
         
         after_count = vectorstore._collection.count()  # type: ignore
         
@@ -896,6 +2351,39 @@ async def remove_establishment(req: AddEstablishmentRequest):
         logger.error("Error removing from ChromaDB: %s", getattr(e, 'message', str(e)))
         raise HTTPException(status_code=500, detail=f"Lỗi khi xóa khỏi ChromaDB: {e}")
 
+# --- API 5: Index lại toàn bộ (ví dụ sau khi đổi INDEX_CHUNK_MODE) ---
+def fetch_all_establishment_ids() -> List[str]:
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM establishment ORDER BY id")
+        return [str(r[0]) for r in cur.fetchall()]
+
+
+def reindex_inline(ids: List[str]) -> Dict[str, str]:
+    """Index lại đồng bộ theo lô khi tắt hàng đợi (chạy trong thread, không chặn event loop)."""
+    outcome: Dict[str, str] = {}
+    for start in range(0, len(ids), INDEX_BATCH_SIZE):
+        outcome.update(upsert_index_documents(fetch_establishments_batch(ids[start:start + INDEX_BATCH_SIZE])))
+    return outcome
+
+
+@app.post("/reindex")
+@timed_operation("reindex")
+async def reindex_all(response: Response):
+    if vectorstore is None or embeddings is None:
+        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo (thiếu embeddings/API key).")
+    try:
+        ids = await asyncio.to_thread(fetch_all_establishment_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi đọc danh sách cơ sở từ DB: {e}")
+    if index_queue is not None:
+        # Mỗi enqueue là một transaction SQLite → cũng chạy trong thread
+        await asyncio.to_thread(lambda: [index_queue.enqueue(est_id, "add") for est_id in ids])
+        response.status_code = 202
+        return {"status": "queued", "count": len(ids)}
+    outcome = await asyncio.to_thread(reindex_inline, ids)
+    return {"status": "success", "count": len(ids), "reembedded": sum(1 for v in outcome.values() if v == "reembedded")}
+
 # DEBUG: Truy vấn document đã lưu trong Chroma theo establishment id
 @app.get("/debug/vector/{establishment_id}")
 async def debug_vector(establishment_id: str):
@@ -918,34 +2406,18 @@ async def debug_vector(establishment_id: str):
 @app.get("/debug/db/{establishment_id}")
 async def debug_db(establishment_id: str):
     try:
-        conn = psycopg2.connect(
-            host=DB_CONFIG['host'],
-            port=DB_CONFIG['port'],
-            database=DB_CONFIG['database'],
-            user=DB_CONFIG['user'],
-            password=DB_CONFIG['password']
-        )
-        cur = conn.cursor()
-        try:
-            cur.execute("SET search_path TO public;")
-        except Exception:
-            pass
-        cur.execute("SELECT COUNT(*) FROM establishment WHERE id = %s", (establishment_id,))
-        cnt = cur.fetchone()[0]
-        sample = None
-        if cnt:
-            cur.execute("SELECT id, name, city FROM establishment WHERE id = %s", (establishment_id,))
-            r = cur.fetchone()
-            sample = {"id": r[0], "name": r[1], "city": r[2]}
-        return {"db_host": DB_CONFIG['host'], "db": DB_CONFIG['database'], "row_count": cnt, "sample": sample}
+        with connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM establishment WHERE id = %s", (establishment_id,))
+            cnt = cur.fetchone()[0]
+            sample = None
+            if cnt:
+                cur.execute("SELECT id, name, city FROM establishment WHERE id = %s", (establishment_id,))
+                r = cur.fetchone()
+                sample = {"id": r[0], "name": r[1], "city": r[2]}
+            return {"db_host": DB_CONFIG['host'], "db": DB_CONFIG['database'], "row_count": cnt, "sample": sample}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Debug DB error: {e}")
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
-
 
 
 @app.get("/health")
@@ -953,6 +2425,7 @@ async def health():
     ready = {
         "llm_initialized": llm is not None,
         "embeddings_initialized": embeddings is not None,
+        "embedding_provider": EMBEDDING_PROVIDER,
         "vectorstore_initialized": vectorstore is not None,
     }
     # Thử đếm số lượng bản ghi nếu có vectorstore
@@ -963,7 +2436,32 @@ async def health():
         ready["chroma_count"] = count
     except Exception as e:
         ready["chroma_count_error"] = getattr(e, "message", str(e))
+    # Độ sâu/độ trễ hàng đợi index
+    if index_queue is not None:
+        try:
+            ready["index_queue"] = index_queue.stats()
+        except Exception as e:
+            ready["index_queue_error"] = getattr(e, "message", str(e))
+    if change_sync is not None:
+        ready["cdc_sync"] = change_sync.stats()
+    if isinstance(vectorstore, ShardedVectorStore):
+        try:
+            ready["shards"] = vectorstore._collection.counts()
+        except Exception as e:
+            ready["shards_error"] = getattr(e, "message", str(e))
+    if quantized_index is not None:
+        ready["vector_index"] = quantized_index.stats()
+    ready["index_epoch"] = {"boot_id": INDEX_BOOT_ID, "epoch": _index_epoch["value"]}
+    ready["facets"] = facet_index.stats()
+    ready["planner"] = {"mode": SEARCH_PLANNER_MODE, "catalog": catalog_stats.stats(),
+                        "plans": {"/".join(k): v for k, v in SEARCH_PLANS.values.items()}}
+    ready["quiz_sessions"] = quiz_sessions.stats()
+    ready["load"] = load_stats()
     return ready
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # CHẠY SERVER (đúng module):
 #   uvicorn ai_service_gemini:app --reload --port 8000
\ No newline at end of file
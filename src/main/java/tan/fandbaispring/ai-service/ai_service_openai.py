@@ -5,6 +5,7 @@ from langchain_chroma import Chroma
 from chromadb import PersistentClient
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from local_embeddings import LOCAL_PROVIDERS, local_embeddings_from_env
 import json
 import os
 import psycopg2 
@@ -46,6 +47,11 @@ DB_CONFIG = {
 
 CHROMA_PATH = "./chroma_db_openai"
 
+# Embedding: "openai" (API, mặc định) | "hashing" (tất định, không cần mạng) | "local" (sentence-transformers CPU).
+# Mỗi provider cục bộ dùng collection riêng (hậu tố theo model) → gọi POST /reindex sau khi đổi
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai").strip().lower()
+CHROMA_COLLECTION = "fast_planner_establishments"
+
 # Khởi tạo LLM và Vector Store (có fallback)
 llm = None
 embeddings = None
@@ -63,10 +69,15 @@ except Exception as e1:
         llm = None
 
 try:
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+    if EMBEDDING_PROVIDER in LOCAL_PROVIDERS:
+        embeddings = local_embeddings_from_env(EMBEDDING_PROVIDER)
+        collection_name = f"{CHROMA_COLLECTION}_{embeddings.collection_tag}"
+    else:
+        embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+        collection_name = CHROMA_COLLECTION
     chroma_client = PersistentClient(path=CHROMA_PATH)
     vectorstore = Chroma(
-        collection_name="fast_planner_establishments",
+        collection_name=collection_name,
         embedding_function=embeddings,
         client=chroma_client
     )
@@ -371,6 +382,37 @@ def fetch_single_establishment(establishment_id: str) -> Optional[Dict[str, Any]
         if conn is not None:
             conn.close()
 
+
+def fetch_all_establishment_ids() -> List[str]:
+    conn = None
+    try:
+        conn = psycopg2.connect(
+            host=DB_CONFIG['host'],
+            port=DB_CONFIG['port'],
+            database=DB_CONFIG['database'],
+            user=DB_CONFIG['user'],
+            password=DB_CONFIG['password']
+        )
+        cur = conn.cursor()
+        try:
+            cur.execute("SET search_path TO public;")
+        except Exception:
+            pass
+        cur.execute("SELECT id FROM establishment ORDER BY id")
+        return [str(r[0]) for r in cur.fetchall()]
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def build_source_text(data: Dict[str, Any]) -> str:
+    return (
+        f"ID: {data['id']}, Tên: {data['name']}, Thành phố: {data.get('city', '')}, Loại: {data['type']}, "
+        f"Giá: {data.get('price_range_vnd')}, Sao: {data.get('star_rating')}. "
+        f"Tiện ích: {data.get('amenities_list', '')}. "
+        f"Mô tả chi tiết: {data['description_long']}"
+    )
+
 # --- API 1: Conditional Quiz Generation (Sử dụng LLM Suy luận) ---
 @app.post("/generate-quiz", response_model=QuizResponseModel)
 async def generate_quiz(req: QuizRequest):
@@ -703,13 +745,7 @@ async def add_establishment(req: AddEstablishmentRequest):
 
     # 2. Chuẩn hóa thành source_text
     city = new_data.get('city', '')
-    amenities = new_data.get('amenities_list', '')
-    source_text = (
-        f"ID: {new_data['id']}, Tên: {new_data['name']}, Thành phố: {city}, Loại: {new_data['type']}, "
-        f"Giá: {new_data.get('price_range_vnd')}, Sao: {new_data.get('star_rating')}. "
-        f"Tiện ích: {amenities}. "
-        f"Mô tả chi tiết: {new_data['description_long']}"
-    )
+    source_text = build_source_text(new_data)
     long_desc = (new_data.get('description_long') or '')
     logger.info("Fetched establishment name=%s, city=%s, len(description)=%s", new_data.get('name'), city, len(long_desc))
     logger.info("Description snippet: %s", long_desc[:300].replace("\n", " "))
@@ -771,6 +807,29 @@ async def remove_establishment(req: AddEstablishmentRequest):
         logger.error("Error removing from ChromaDB: %s", getattr(e, 'message', str(e)))
         raise HTTPException(status_code=500, detail=f"Lỗi khi xóa khỏi ChromaDB: {e}")
 
+# --- API 5: Dựng lại toàn bộ Vector Store từ PostgreSQL ---
+# Dùng sau khi đổi EMBEDDING_PROVIDER/model: collection mới đang rỗng, không trộn vector khác không gian
+@app.post("/reindex")
+async def reindex_all():
+    if vectorstore is None or embeddings is None:
+        raise HTTPException(status_code=503, detail="Vector Store chưa được khởi tạo (thiếu embeddings/API key).")
+    try:
+        ids = fetch_all_establishment_ids()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi đọc danh sách cơ sở từ DB: {e}")
+    rows = [r for r in (fetch_single_establishment(i) for i in ids) if r]
+    try:
+        # Xoá document cũ của các ID này trước để không bị trùng
+        if ids:
+            vectorstore._collection.delete(where={"id": {"$in": ids}})  # type: ignore
+        if rows:
+            vectorstore.add_texts(texts=[build_source_text(r) for r in rows], metadatas=rows)
+    except Exception as e:
+        logger.error("Error reindexing ChromaDB: %s", getattr(e, 'message', str(e)))
+        raise HTTPException(status_code=500, detail=f"Lỗi khi dựng lại ChromaDB: {e}")
+    logger.info("Reindexed %s/%s establishments into %s", len(rows), len(ids), collection_name)
+    return {"status": "success", "count": len(rows), "skipped": len(ids) - len(rows)}
+
 # DEBUG: Truy vấn document đã lưu trong Chroma theo establishment id
 @app.get("/debug/vector/{establishment_id}")
 async def debug_vector(establishment_id: str):
@@ -827,6 +886,7 @@ async def health():
     ready = {
         "llm_initialized": llm is not None,
         "embeddings_initialized": embeddings is not None,
+        "embedding_provider": EMBEDDING_PROVIDER,
         "vectorstore_initialized": vectorstore is not None,
     }
     # Thử đếm số lượng bản ghi nếu có vectorstore
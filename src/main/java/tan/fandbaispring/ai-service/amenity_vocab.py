@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Canonical amenity vocabulary used for amenity filtering in ai_service_gemini.py.
+
+AMENITIES mirrors frontend/partner-portal/src/constants/amenities.ts plus the
+quiz FALLBACK_OPTIONS ("Buffet sáng"), each with the synonyms people actually
+type ("bể bơi", "pool", "điều hoà", ...). Synonyms are accent-folded into the
+same trie as the city gazetteer (vn_gazetteer.PlaceMatcher), so free text maps
+to amenity IDs in one pass, and a set of amenities is an int bitmask: bit i
+is AMENITIES[i]. Masks are stored in Chroma metadata (amenity_mask) at index
+time, which turns the per-search amenity check into a bitwise AND.
+
+Bits are persisted, so only ever APPEND to AMENITIES — never reorder.
+
+Quick check:
+    python amenity_vocab.py "có bể bơi, điều hoà và đưa đón sân bay"
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from vn_gazetteer import PlaceMatcher, alias_key
+
+# (id, tên hiển thị, các cách viết khác)
+AMENITIES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ("wifi", "Wifi", ("wi-fi", "wifi mien phi", "internet")),
+    ("parking", "Bãi đỗ xe", ("bai giu xe", "cho do xe", "do xe", "dau xe", "parking")),
+    ("air_conditioning", "Máy lạnh", ("dieu hoa", "may dieu hoa", "air conditioning", "aircon")),
+    ("elevator", "Thang máy", ("elevator", "lift")),
+    ("reception_24h", "Lễ tân 24/7", ("le tan 24h", "le tan 24 7", "24/7", "front desk")),
+    ("restaurant", "Nhà hàng", ("restaurant",)),
+    ("bar", "Bar", ("quay bar", "lounge", "pub")),
+    ("meeting_room", "Phòng họp", ("phong hoi nghi", "hoi nghi", "hoi truong", "meeting room")),
+    ("spa", "Spa", ("massage", "xong hoi", "sauna")),
+    ("gym", "Gym", ("phong gym", "phong tap", "the hinh", "fitness")),
+    ("pool", "Hồ bơi", ("be boi", "ho boi vo cuc", "pool", "swimming pool", "infinity pool")),
+    ("beach", "Gần biển", ("sat bien", "view bien", "huong bien", "bai bien rieng", "beach", "beachfront")),
+    ("garden", "Sân vườn", ("khu vuon", "vuon", "garden")),
+    ("balcony", "Ban công", ("lo gia", "balcony")),
+    ("view", "Tầm nhìn đẹp", ("tam nhin", "view dep", "canh dep", "view")),
+    ("non_smoking", "Phòng không hút thuốc", ("khong hut thuoc", "non smoking")),
+    ("laundry", "Giặt ủi", ("giat la", "giat", "laundry")),
+    ("airport_shuttle", "Đưa đón sân bay", ("xe dua don", "airport shuttle", "airport transfer")),
+    ("breakfast", "Buffet sáng", ("an sang", "bua sang", "buffet", "breakfast")),
+]
+
+
+class AmenityVocabulary:
+    """Ánh xạ văn bản tự do ↔ mask bit của tiện ích chuẩn."""
+
+    def __init__(self, amenities: List[Tuple[str, str, Tuple[str, ...]]] = AMENITIES):
+        self.ids = [a[0] for a in amenities]
+        self.display = {a[0]: a[1] for a in amenities}
+        self.bit = {a[0]: 1 << i for i, a in enumerate(amenities)}
+        aliases: Dict[str, str] = {}
+        for amenity_id, name, synonyms in amenities:
+            for alias in (name,) + synonyms:
+                aliases.setdefault(alias_key(alias), amenity_id)
+        self._matcher = PlaceMatcher(aliases)
+
+    def mask(self, text: Optional[str]) -> int:
+        """Mask của mọi tiện ích nhắc tới trong văn bản (0 nếu không nhận ra tiện ích nào)."""
+        out = 0
+        for _, _, amenity_id in self._matcher.find_all(text):
+            out |= self.bit[amenity_id]
+        return out
+
+    def parse(self, terms: List[str]) -> Tuple[int, List[str]]:
+        """(mask các tiện ích nhận ra, các mục không khớp tiện ích chuẩn nào)."""
+        mask, unknown = 0, []
+        for term in terms:
+            term_mask = self.mask(term)
+            if term_mask:
+                mask |= term_mask
+            elif term and term.strip():
+                unknown.append(term.strip())
+        return mask, unknown
+
+    def names(self, mask: int) -> List[str]:
+        return [self.display[i] for i in self.ids if mask & self.bit[i]]
+
+
+if __name__ == "__main__":
+    import sys
+
+    vocab = AmenityVocabulary()
+    print(f"🏷️  {len(vocab.ids)} amenities")
+    for arg in sys.argv[1:]:
+        m = vocab.mask(arg)
+        print(f"   {arg!r} → {m:#x} {vocab.names(m)}")
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Reproducible load test / benchmark for the Gemini AI service.
+
+Runs the FastAPI app in-process (no uvicorn, no API keys) with stub LLM and
+embedding providers, a Chroma collection seeded from
+sample_establishments_data.json and, optionally, a local Postgres seeded with
+the same data. Drives /generate-quiz, /rag-search and /add-establishment at a
+configurable concurrency and reports throughput and p50/p95/p99 latency.
+With --repeat N every figure is the median of N runs, which keeps baselines
+comparable on noisy machines.
+
+Examples:
+    python benchmark_service.py --requests 200 --concurrency 8
+    python benchmark_service.py --repeat 5 --save-baseline bench_baseline.json
+    python benchmark_service.py --repeat 5 --compare bench_baseline.json --tolerance 0.2
+    python benchmark_service.py --seed-db --llm-latency-ms 300 --embed-latency-ms 40
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SERVICE_DIR = Path(__file__).resolve().parent
+DEFAULT_DATA = SERVICE_DIR.parents[5] / "sample_establishments_data.json"
+SCENARIOS = ("generate-quiz", "rag-search", "add-establishment")
+
+QUIZ_PROMPTS = [
+    "Tôi muốn đi Đà Nẵng ngày 2025-10-10 2 đêm, có phòng gym",
+    "khach san Ha Noi cho cap doi, ngan sach 2tr",
+    "Nhà hàng ở Hồ Chí Minh cho gia đình",
+    "Đi Nha Trang 3 đêm từ 2025-12-20, cần hồ bơi",
+]
+
+
+def load_service(llm_latency_ms: float, embed_latency_ms: float):
+    """Import ai_service_gemini with stub providers; return (module, stub embeddings)."""
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from langchain_core.output_parsers import JsonOutputParser
+    from langchain_core.runnables import RunnableLambda
+
+    class StubLLM(FakeListChatModel):
+        latency_s: float = 0.0
+
+        def _call(self, *args, **kwargs):
+            if self.latency_s:
+                time.sleep(self.latency_s)
+            return super()._call(*args, **kwargs)
+
+        def with_structured_output(self, schema, *, include_raw=False, **kwargs):
+            # FakeListChatModel không có structured output: parse JSON như json_mode của provider thật,
+            # để QUIZ_EXTRACTION_MODE=structured (mặc định) đo đường LLM chứ không phải fallback tất định
+            parser = JsonOutputParser()
+            if not include_raw:
+                return self | parser
+            return self | RunnableLambda(lambda msg: {"raw": msg, "parsed": parser.invoke(msg), "parsing_error": None})
+
+    class StubEmbeddings(DeterministicFakeEmbedding):
+        latency_s: float = 0.0
+
+        def embed_documents(self, texts, **kwargs):
+            if self.latency_s:
+                time.sleep(self.latency_s)
+            return super().embed_documents(texts)
+
+        def embed_query(self, text):
+            if self.latency_s:
+                time.sleep(self.latency_s)
+            return super().embed_query(text)
+
+    # Không dùng API key thật; thư mục làm việc tạm để không đụng chroma_db_gemini/
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark-dummy-key")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    os.environ.setdefault("TRACE_JSONL_PATH", "")
+    # Đo đường ghi Chroma của /add-establishment, không phải việc xếp hàng vào index queue
+    os.environ.setdefault("INDEX_QUEUE_ENABLED", "false")
+    sys.path.insert(0, str(SERVICE_DIR))
+    os.chdir(tempfile.mkdtemp(prefix="ai_bench_"))
+    import ai_service_gemini as svc
+
+    svc.llm = StubLLM(
+        responses=['{"travel_companion": "couple"}'],
+        latency_s=llm_latency_ms / 1000.0,
+    )
+    emb = StubEmbeddings(size=256, latency_s=embed_latency_ms / 1000.0)
+    return svc, emb
+
+
+def load_sample_data(path: Path):
+    raw = json.loads(path.read_text(encoding="utf-8"))
+    rows = []
+    for i, e in enumerate(raw.get("establishments", raw if isinstance(raw, list) else [])):
+        rows.append({
+            "id": f"BENCH-{i:03d}",
+            "name": e.get("name"),
+            "type": e.get("type"),
+            "price_range_vnd": e.get("priceRangeVnd"),
+            "star_rating": e.get("starRating"),
+            "owner_id": "benchmark",
+            "description_long": e.get("descriptionLong") or "",
+            "city": e.get("city"),
+            "image_url_main": e.get("imageUrlMain") or "",
+            "amenities_list": ", ".join(e.get("amenitiesList") or []),
+        })
+    return rows
+
+
+def seed_vectorstore(svc, emb, rows):
+    import chromadb
+    from langchain_chroma import Chroma
+
+    client = chromadb.EphemeralClient()
+    vs = Chroma(collection_name="fast_planner_establishments", embedding_function=emb, client=client)
+    texts = [
+        f"ID: {r['id']}, Tên: {r['name']}, Thành phố: {r['city']}, Loại: {r['type']}, "
+        f"Giá: {r['price_range_vnd']}, Sao: {r['star_rating']}. Tiện ích: {r['amenities_list']}. "
+        f"Mô tả chi tiết: {r['description_long']}"
+        for r in rows
+    ]
+    vs.add_texts(texts=texts, metadatas=rows)
+    svc.embeddings = emb
+    svc.vectorstore = vs
+    svc.chroma_client = client
+
+
+def seed_postgres(svc, rows) -> bool:
+    """Ghi dữ liệu mẫu vào Postgres cục bộ (DB_CONFIG). Trả False nếu không kết nối được."""
+    import psycopg2
+
+    try:
+        conn = psycopg2.connect(**svc.DB_CONFIG)
+    except Exception as e:
+        print(f"⚠️  Postgres not reachable ({e}); DB-backed stages will be stubbed")
+        return False
+    try:
+        cur = conn.cursor()
+        for r in rows:
+            cur.execute("""
+                INSERT INTO establishment (id, name, type, price_range_vnd, star_rating, owner_id,
+                                           description_long, city, image_url_main, is_available, has_inventory)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, TRUE, TRUE)
+                ON CONFLICT (id) DO NOTHING
+            """, (r["id"], r["name"], r["type"], r["price_range_vnd"], r["star_rating"], r["owner_id"],
+                  r["description_long"], r["city"], r["image_url_main"]))
+            cur.execute("DELETE FROM establishment_amenities_list WHERE establishment_id = %s", (r["id"],))
+            for a in filter(None, (x.strip() for x in r["amenities_list"].split(","))):
+                cur.execute("INSERT INTO establishment_amenities_list (establishment_id, amenities_list) VALUES (%s, %s)",
+                            (r["id"], a))
+        conn.commit()
+        print(f"✅ Seeded {len(rows)} establishments into Postgres")
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️  Postgres seeding failed ({e}); DB-backed stages will be stubbed")
+        return False
+    finally:
+        conn.close()
+
+
+def build_payload(scenario: str, i: int, rows):
+    if scenario == "generate-quiz":
+        return {"userPrompt": QUIZ_PROMPTS[i % len(QUIZ_PROMPTS)], "currentParams": {}}
+    if scenario == "rag-search":
+        r = rows[i % len(rows)]
+        return {"params": {
+            "city": r["city"],
+            "establishment_type": r["type"],
+            "amenities_priority": (r["amenities_list"].split(",")[0] or "").strip(),
+            "travel_companion": "couple",
+        }}
+    return {"id": rows[i % len(rows)]["id"]}
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+async def run_scenario(app, scenario: str, total: int, concurrency: int, rows):
+    import httpx
+
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                t0 = time.perf_counter()
+                resp = await client.post(f"/{scenario}", json=build_payload(scenario, i, rows))
+                latencies.append((time.perf_counter() - t0) * 1000.0)
+                if resp.status_code >= 400:
+                    errors += 1
+
+        t_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - t_start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(total / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def median_result(runs):
+    # Trung vị từng chỉ số qua các lần chạy: một lần chạy bị nhiễu không làm lệch baseline/so sánh
+    return {k: round(statistics.median(r[k] for r in runs), 2) if isinstance(v, float) else v
+            for k, v in runs[0].items()} | {"errors": sum(r["errors"] for r in runs)}
+
+
+def compare(report, baseline, tolerance: float) -> bool:
+    ok = True
+    print(f"\n📉 Comparison with baseline (tolerance {tolerance:.0%})")
+    for name, cur in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            print(f"   {name}: no baseline")
+            continue
+        p95_delta = (cur["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        rps_delta = (cur["throughput_rps"] - base["throughput_rps"]) / base["throughput_rps"] if base["throughput_rps"] else 0.0
+        regressed = p95_delta > tolerance or rps_delta < -tolerance
+        ok = ok and not regressed
+        mark = "❌" if regressed else "✅"
+        print(f"   {mark} {name}: p95 {base['p95_ms']} → {cur['p95_ms']} ms ({p95_delta:+.0%}), "
+              f"throughput {base['throughput_rps']} → {cur['throughput_rps']} rps ({rps_delta:+.0%})")
+    return ok
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--data", type=Path, default=DEFAULT_DATA, help="sample establishments JSON")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated endpoints to drive")
+    ap.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated LLM provider latency")
+    ap.add_argument("--embed-latency-ms", type=float, default=0.0, help="simulated embedding provider latency")
+    ap.add_argument("--seed-db", action="store_true", help="seed the local Postgres from DB_CONFIG")
+    ap.add_argument("--save-baseline", type=Path, help="write the report as a baseline JSON")
+    ap.add_argument("--compare", type=Path, help="compare with a saved baseline JSON")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    ap.add_argument("--repeat", type=int, default=1, help="runs per scenario; report the median of each figure")
+    args = ap.parse_args()
+    # load_service() đổi thư mục làm việc → chuẩn hoá đường dẫn trước
+    for name in ("data", "save_baseline", "compare"):
+        if getattr(args, name):
+            setattr(args, name, getattr(args, name).resolve())
+
+    print("🏁 AI Service Benchmark")
+    print("=" * 40)
+    rows = load_sample_data(args.data)
+    svc, emb = load_service(args.llm_latency_ms, args.embed_latency_ms)
+    seed_vectorstore(svc, emb, rows)
+    db_ok = seed_postgres(svc, rows) if args.seed_db else False
+    if not db_ok:
+        # Không có Postgres: đọc cơ sở từ dữ liệu mẫu thay cho truy vấn DB
+        by_id = {r["id"]: r for r in rows}
+        svc.fetch_single_establishment = lambda est_id: dict(by_id[est_id]) if est_id in by_id else None
+
+    report = {
+        "config": {k: (v.name if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "db_seeded": db_ok,
+        "scenarios": {},
+    }
+    for scenario in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        runs = [asyncio.run(run_scenario(svc.app, scenario, args.requests, args.concurrency, rows))
+                for _ in range(max(1, args.repeat))]
+        result = median_result(runs)
+        report["scenarios"][scenario] = result
+        print(f"\n🔍 /{scenario}")
+        print(f"   throughput: {result['throughput_rps']} rps  errors: {result['errors']}/{result['requests'] * len(runs)}")
+        print(f"   p50: {result['p50_ms']} ms  p95: {result['p95_ms']} ms  p99: {result['p99_ms']} ms")
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        if not compare(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
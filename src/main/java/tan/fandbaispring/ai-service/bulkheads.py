@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Admission control and per-dependency bulkheads for ai_service_gemini.py.
+
+Each dependency (LLM, embeddings, Chroma, Postgres) gets a Bulkhead: a
+semaphore with a bounded, priority-ordered wait queue, so one slow provider
+cannot take every worker thread. A full queue or a wait longer than
+BULKHEAD_WAIT_S raises Overloaded (503 + Retry-After) instead of piling more
+load onto the dependency; AdmissionMiddleware answers 429 at the door when
+too many requests are already in flight, and tags each request with its
+priority (/rag-search before /generate-quiz) and its deadline budget.
+"""
+
+import asyncio
+import contextvars
+import functools
+import heapq
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, List
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+from deadlines import DEADLINE_HEADER, budget_from_header, request_budget
+from metrics import METRICS, Counter, Histogram
+
+# Mỗi dependency có giới hạn số lời gọi đồng thời và hàng chờ có giới hạn; /rag-search được ưu tiên hơn
+# /generate-quiz trong hàng chờ. Hàng chờ đầy hoặc chờ quá lâu → trả ngay 503 + Retry-After thay vì dồn
+# thêm tải lên provider/DB; quá nhiều request đang xử lý → 429 ngay từ cửa vào.
+BULKHEAD_QUEUE_MAX = int(os.getenv("BULKHEAD_QUEUE_MAX", "32"))
+BULKHEAD_WAIT_S = float(os.getenv("BULKHEAD_WAIT_S", "2"))
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "64"))
+LOAD_SHED_RETRY_AFTER_S = int(os.getenv("LOAD_SHED_RETRY_AFTER_S", "2"))
+# Số nhỏ hơn = ưu tiên cao hơn; thread nền (prefetch) không có request nên nhận mức thấp nhất
+REQUEST_PRIORITY = {"/rag-search": 0, "/generate-quiz": 1}
+PRIORITY_DEFAULT, PRIORITY_BACKGROUND = 1, 2
+
+LOAD_SHED = Counter("ai_load_shed_total", "Request bị từ chối do quá tải", ("dependency", "reason"))
+BULKHEAD_WAIT = Histogram("ai_bulkhead_wait_seconds", "Thời gian chờ slot của dependency", ("dependency",))
+METRICS += [LOAD_SHED, BULKHEAD_WAIT]
+
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar("request_priority", default=PRIORITY_BACKGROUND)
+
+
+class Overloaded(Exception):
+    """Dependency/dịch vụ quá tải: trả về status_code kèm Retry-After."""
+
+    def __init__(self, dependency: str, reason: str, status_code: int = 503):
+        super().__init__(f"{dependency} quá tải ({reason})")
+        self.dependency, self.reason, self.status_code = dependency, reason, status_code
+
+
+class Bulkhead:
+    """Semaphore có hàng chờ ưu tiên, giới hạn độ dài và thời gian chờ."""
+
+    def __init__(self, name: str, limit: int, queue_max: int = BULKHEAD_QUEUE_MAX, wait_s: float = BULKHEAD_WAIT_S):
+        self.name, self.limit, self.queue_max, self.wait_s = name, limit, queue_max, wait_s
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting: List[tuple] = []  # heap (priority, seq)
+        self._seq = 0
+
+    def _shed(self, reason: str) -> Overloaded:
+        LOAD_SHED.inc(dependency=self.name, reason=reason)
+        return Overloaded(self.name, reason)
+
+    def acquire(self) -> None:
+        if self.limit <= 0:
+            return
+        t0 = time.perf_counter()
+        with self._cond:
+            if self._active < self.limit and not self._waiting:
+                self._active += 1
+                BULKHEAD_WAIT.observe(0.0, dependency=self.name)
+                return
+            if len(self._waiting) >= self.queue_max:
+                raise self._shed("queue_full")
+            self._seq += 1
+            entry = (request_priority.get(), self._seq)
+            heapq.heappush(self._waiting, entry)
+            deadline = t0 + self.wait_s
+            while not (self._active < self.limit and self._waiting[0] == entry):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    raise self._shed("wait_timeout")
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._cond.notify_all()
+        BULKHEAD_WAIT.observe(time.perf_counter() - t0, dependency=self.name)
+
+    def release(self) -> None:
+        if self.limit <= 0:
+            return
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        # Chờ slot trong thread để không chặn event loop
+        await asyncio.to_thread(self.acquire)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def guard(self, fn):
+        """Decorator: mỗi lời gọi fn giữ một slot."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.slot():
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"limit": self.limit, "active": self._active, "waiting": len(self._waiting),
+                    "queue_max": self.queue_max}
+
+
+BULKHEADS = {
+    name: Bulkhead(name, int(os.getenv(f"BULKHEAD_{name.upper()}_LIMIT", default)))
+    for name, default in (("llm", "4"), ("embeddings", "8"), ("chroma", "8"), ("postgres", "8"))
+}
+LLM_BULKHEAD, EMBEDDINGS_BULKHEAD = BULKHEADS["llm"], BULKHEADS["embeddings"]
+CHROMA_BULKHEAD, POSTGRES_BULKHEAD = BULKHEADS["chroma"], BULKHEADS["postgres"]
+_inflight = {"count": 0}
+_inflight_lock = threading.Lock()
+
+
+class AdmissionMiddleware:
+    """Giới hạn số request đang xử lý + gán ưu tiên/ngân sách cho request.
+
+    ASGI thuần thay vì @app.middleware (BaseHTTPMiddleware): không thêm task/stream cho mỗi request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in ("/health", "/metrics"):
+            await self.app(scope, receive, send)
+            return
+        with _inflight_lock:
+            admitted = ADMISSION_MAX_INFLIGHT <= 0 or _inflight["count"] < ADMISSION_MAX_INFLIGHT
+            if admitted:
+                _inflight["count"] += 1
+        if not admitted:
+            LOAD_SHED.inc(dependency="admission", reason="max_inflight")
+            response = JSONResponse(status_code=429, content={"detail": "Dịch vụ đang quá tải, vui lòng thử lại sau"},
+                                    headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER_S)})
+            await response(scope, receive, send)
+            return
+        token = request_priority.set(next((p for prefix, p in REQUEST_PRIORITY.items()
+                                            if scope["path"].startswith(prefix)), PRIORITY_DEFAULT))
+        headers = Headers(scope=scope)
+        budget_token = request_budget.set(budget_from_header(headers.get(DEADLINE_HEADER)))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_budget.reset(budget_token)
+            request_priority.reset(token)
+            with _inflight_lock:
+                _inflight["count"] -= 1
+
+
+def load_stats() -> Dict[str, Any]:
+    """Tải hiện tại cho /health: request đang xử lý, trạng thái từng bulkhead, số lần từ chối."""
+    return {
+        "inflight": _inflight["count"],
+        "max_inflight": ADMISSION_MAX_INFLIGHT,
+        "bulkheads": {name: b.stats() for name, b in BULKHEADS.items()},
+        "shed": {"/".join(k): v for k, v in LOAD_SHED.values.items()},
+    }
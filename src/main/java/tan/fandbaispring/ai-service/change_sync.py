@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Change data capture from Postgres into the search index for ai_service_gemini.py.
+
+The Spring backend writes establishments without calling /add-establishment
+on every edit, so ChangeSync watches Postgres itself:
+
+- notify: LISTEN on a channel fed by row triggers (CDC_INSTALL_TRIGGERS=true
+  installs them), debouncing bursts such as JPA rewriting an amenity list;
+- poll: the establishment table has no updated_at, so a per-row md5
+  fingerprint is diffed every CDC_POLL_INTERVAL_S.
+
+Changed and deleted ids are handed to the service's on_changes callback.
+"""
+
+import logging
+import os
+import select
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# CDC_SYNC_MODE=notify: LISTEN kênh do trigger phát (CDC_INSTALL_TRIGGERS=true để tự cài trigger)
+# CDC_SYNC_MODE=poll: bảng establishment không có updated_at → so fingerprint md5 từng dòng theo chu kỳ
+CDC_SYNC_MODE = os.getenv("CDC_SYNC_MODE", "off").strip().lower()
+CDC_CHANNEL = os.getenv("CDC_CHANNEL", "establishment_changes")
+# Payload khi xoá hẳn một establishment: "<tiền tố><id>" → job "remove" thay vì "add"
+CDC_DELETED_PREFIX = "deleted:"
+CDC_INSTALL_TRIGGERS = os.getenv("CDC_INSTALL_TRIGGERS", "false").strip().lower() in ("1", "true", "yes")
+CDC_POLL_INTERVAL_S = float(os.getenv("CDC_POLL_INTERVAL_S", "30"))
+CDC_DEBOUNCE_MS = float(os.getenv("CDC_DEBOUNCE_MS", "500"))
+
+CDC_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION fast_planner_notify_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'establishment' AND TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{CDC_CHANNEL}', '{CDC_DELETED_PREFIX}' || OLD.id);
+    ELSIF TG_TABLE_NAME = 'establishment' THEN
+        PERFORM pg_notify('{CDC_CHANNEL}', NEW.id);
+    ELSE
+        PERFORM pg_notify('{CDC_CHANNEL}', COALESCE(NEW.establishment_id, OLD.establishment_id));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS fast_planner_establishment_cdc ON establishment;
+CREATE TRIGGER fast_planner_establishment_cdc AFTER INSERT OR UPDATE OR DELETE ON establishment
+    FOR EACH ROW EXECUTE FUNCTION fast_planner_notify_change();
+DROP TRIGGER IF EXISTS fast_planner_amenities_cdc ON establishment_amenities_list;
+CREATE TRIGGER fast_planner_amenities_cdc AFTER INSERT OR UPDATE OR DELETE ON establishment_amenities_list
+    FOR EACH ROW EXECUTE FUNCTION fast_planner_notify_change();
+"""
+
+CDC_FINGERPRINT_SQL = """
+SELECT e.id, md5(concat_ws('|', e.name, e.type, e.city, e.price_range_vnd, e.star_rating, e.owner_id,
+                           e.description_long, e.image_url_main, e.is_available,
+                           (SELECT string_agg(a.amenities_list, ',' ORDER BY a.amenities_list)
+                              FROM establishment_amenities_list a WHERE a.establishment_id = e.id)))
+FROM establishment e
+"""
+
+
+def split_payloads(payloads: List[str]) -> Tuple[List[str], List[str]]:
+    """Payload NOTIFY → (ids thêm/sửa, ids đã xoá); notify sau cùng của một id thắng (xoá rồi tạo lại = thay đổi)."""
+    gone: Dict[str, bool] = {}
+    for payload in payloads:
+        if payload.startswith(CDC_DELETED_PREFIX):
+            gone[payload[len(CDC_DELETED_PREFIX):]] = True
+        else:
+            gone[payload] = False
+    return sorted(i for i, g in gone.items() if not g), sorted(i for i, g in gone.items() if g)
+
+
+class ChangeSync:
+    """Theo dõi thay đổi catalogue trong Postgres và báo on_changes(ids, deleted).
+
+    connect(autocommit=...) là context manager trả kết nối psycopg2 (db.connect); on_changes do service cung cấp
+    (ghi job vào hàng đợi index hoặc index trực tiếp).
+    """
+
+    def __init__(self, mode: str, connect: Callable[..., Any], on_changes: Callable[[List[str], List[str]], None],
+                 poll_interval_s: float = CDC_POLL_INTERVAL_S, debounce_ms: float = CDC_DEBOUNCE_MS):
+        self.mode = mode
+        self._connect = connect
+        self._on_changes = on_changes
+        self.poll_interval_s = poll_interval_s
+        self.debounce_ms = debounce_ms
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._fingerprints: Optional[Dict[str, str]] = None
+        self.last_sync_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"cdc-{self.mode}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "alive": bool(self._thread and self._thread.is_alive()),
+            "last_sync_at": self.last_sync_at,
+            "last_error": self.last_error,
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.mode == "notify":
+                    self._listen_loop()
+                else:
+                    self._poll_loop()
+            except Exception as e:
+                self.last_error = getattr(e, 'message', str(e))
+                logger.error("CDC sync error (%s), reconnecting: %s", self.mode, self.last_error)
+                self._stop.wait(5.0)
+
+    def _listen_loop(self) -> None:
+        with self._connect(autocommit=True) as conn:
+            cur = conn.cursor()
+            if CDC_INSTALL_TRIGGERS:
+                cur.execute(CDC_TRIGGER_SQL)
+            cur.execute(f"LISTEN {CDC_CHANNEL};")
+            logger.info("CDC listening on channel %s", CDC_CHANNEL)
+            while not self._stop.is_set():
+                if not select.select([conn], [], [], 1.0)[0]:
+                    continue
+                # Gom các notify trong một khoảng ngắn (JPA xoá/ghi lại toàn bộ amenities → nhiều notify)
+                deadline = time.monotonic() + self.debounce_ms / 1000.0
+                payloads: List[str] = []
+                while True:
+                    conn.poll()
+                    while conn.notifies:
+                        payloads.append(conn.notifies.pop(0).payload)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._stop.is_set():
+                        break
+                    select.select([conn], [], [], remaining)
+                ids, deleted = split_payloads(payloads)
+                if ids or deleted:
+                    self.sync_ids(ids, deleted)
+
+    def _poll_loop(self) -> None:
+        while not self._stop.is_set():
+            self.poll_once()
+            self._stop.wait(self.poll_interval_s)
+
+    def poll_once(self) -> None:
+        """So fingerprint hiện tại với lần trước; lần đầu chỉ ghi mốc, không đồng bộ lại toàn bộ catalogue."""
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(CDC_FINGERPRINT_SQL)
+            current = {str(r[0]): r[1] for r in cur.fetchall()}
+        if self._fingerprints is not None:
+            changed = [i for i, fp in current.items() if self._fingerprints.get(i) != fp]
+            deleted = [i for i in self._fingerprints if i not in current]
+            if changed or deleted:
+                self.sync_ids(changed, deleted)
+        self._fingerprints = current
+        self.last_sync_at = time.time()
+
+    def sync_ids(self, ids: List[str], deleted: Optional[List[str]] = None) -> None:
+        """ids: cơ sở được thêm/sửa; deleted: cơ sở đã xoá khỏi Postgres."""
+        deleted = deleted or []
+        logger.info("CDC detected changes for %s establishments (%s deleted)", len(ids) + len(deleted), len(deleted))
+        self._on_changes(ids, deleted)
+        self.last_sync_at = time.time()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Postgres connection helper for ai_service_gemini.py.
+
+Every read from the Spring backend's database goes through connect(), so the
+connection settings, the search_path and cancellation by optional stages
+(deadlines.track_stage_connection) are handled in one place.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Iterator
+
+import psycopg2
+
+from deadlines import track_stage_connection
+
+logger = logging.getLogger(__name__)
+
+# *** SỬA LỖI DB_CONFIG: Tách host và port để khớp với psycopg2 ***
+db_host, db_port = "localhost", 5432 # Mặc định
+if ":" in "localhost:5432":
+    db_host, db_port_str = "localhost:5432".split(":")
+    db_port = int(db_port_str)
+
+DB_CONFIG = {
+    "host": db_host,
+    "port": db_port, # Thêm port
+    "database": "fast_planner_db",
+    "user": "postgres",
+    "password": "root"
+}
+
+
+@contextmanager
+def connect(autocommit: bool = False) -> Iterator["psycopg2.extensions.connection"]:
+    """Kết nối tới DB_CONFIG, đóng khi ra khỏi khối with.
+
+    Kết nối được đăng ký với bước không bắt buộc đang chạy (nếu có) để bị huỷ khi bước hết hạn.
+    autocommit=True cho LISTEN/NOTIFY.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        track_stage_connection(conn)
+        if autocommit:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET search_path TO public;")
+        except Exception as e:
+            logger.debug("Cannot set search_path: %s", e)
+            if not autocommit:
+                conn.rollback()
+        yield conn
+    finally:
+        conn.close()
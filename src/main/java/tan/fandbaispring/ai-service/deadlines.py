@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Per-request deadlines and cancellation for ai_service_gemini.py.
+
+Spring sends the time budget it has left (ms) in DEADLINE_HEADER; the
+admission middleware turns it into a RequestBudget in the request_budget
+context variable. Every step calls check_budget() at its boundary, so a
+request that ran out of time or whose client disconnected stops before the
+next step instead of finishing work nobody will read. Optional steps run
+through optional_stage(): when they cannot finish within the remaining
+budget they return a fallback, their Postgres query is cancelled and the
+response is flagged as partial (X-Partial-Result).
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, List, Optional
+
+from fastapi import Request, Response
+
+from metrics import METRICS, Counter
+
+logger = logging.getLogger(__name__)
+
+# Spring gửi ngân sách thời gian còn lại (ms) qua header; mỗi bước kiểm tra trước khi chạy. Hết hạn hoặc client
+# ngắt kết nối → dừng các bước còn lại (thread đang chạy dừng ở ranh giới bước kế tiếp, kết quả bị bỏ).
+# Bước không bắt buộc (lọc khả dụng, giá rẻ nhất) không kịp thì bị bỏ qua → kết quả một phần (X-Partial-Result).
+DEADLINE_HEADER = os.getenv("DEADLINE_HEADER", "X-Request-Timeout-Ms")
+DEFAULT_REQUEST_BUDGET_MS = float(os.getenv("DEFAULT_REQUEST_BUDGET_MS", "0"))
+# Phần ngân sách giữ lại để kịp trả lời (serialize + mạng) trước khi phía gọi bỏ cuộc
+DEADLINE_RESERVE_MS = float(os.getenv("DEADLINE_RESERVE_MS", "100"))
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.1"))
+PARTIAL_RESULT_HEADER = "X-Partial-Result"
+
+DEADLINE_EVENTS = Counter("ai_deadline_events_total", "Bước bị huỷ hoặc bỏ qua do hết hạn/client ngắt kết nối",
+                          ("operation", "stage", "event"))
+METRICS.append(DEADLINE_EVENTS)
+
+
+class DeadlineExceeded(Exception):
+    """reason: "deadline" (hết ngân sách) hoặc "client_disconnected"."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RequestBudget:
+    """Hạn chót (monotonic) + cờ huỷ của một request, dùng chung giữa event loop và các thread xử lý."""
+
+    def __init__(self, budget_ms: Optional[float]):
+        self.deadline = time.monotonic() + budget_ms / 1000.0 if budget_ms and budget_ms > 0 else None
+        self.reason: Optional[str] = None
+        self.skipped: List[str] = []
+        self._cancelled = threading.Event()
+
+    def remaining(self, reserve_ms: float = 0.0) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic() - reserve_ms / 1000.0
+
+    def cancel(self, reason: str) -> None:
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    def check(self) -> None:
+        if not self._cancelled.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        if self._cancelled.is_set():
+            raise DeadlineExceeded(self.reason or "deadline")
+
+
+request_budget: contextvars.ContextVar[Optional[RequestBudget]] = contextvars.ContextVar("request_budget", default=None)
+
+
+def budget_from_header(value: Optional[str]) -> RequestBudget:
+    try:
+        budget_ms = float(value) if value else DEFAULT_REQUEST_BUDGET_MS
+    except ValueError:
+        budget_ms = DEFAULT_REQUEST_BUDGET_MS
+    return RequestBudget(budget_ms)
+
+
+def check_budget(operation: str, stage: str) -> None:
+    """Gọi ở ranh giới mỗi bước: raise DeadlineExceeded nếu request đã hết hạn/bị huỷ (thread nền: không làm gì)."""
+    budget = request_budget.get()
+    if budget is None:
+        return
+    try:
+        budget.check()
+    except DeadlineExceeded as e:
+        DEADLINE_EVENTS.inc(operation=operation, stage=stage, event=e.reason)
+        raise
+
+
+_optional_stage_executor = ThreadPoolExecutor(max_workers=int(os.getenv("OPTIONAL_STAGE_WORKERS", "4")),
+                                              thread_name_prefix="optional-stage")
+
+
+class StageConnections:
+    """Kết nối Postgres mà một bước không bắt buộc đang dùng; bước bị bỏ vì hết hạn → huỷ truy vấn đang chạy.
+
+    connection.cancel() của psycopg2 gửi yêu cầu huỷ từ thread khác; truy vấn bị huỷ raise QueryCanceled trong
+    thread của bước (các hàm DB đã bắt lỗi và trả giá trị mặc định).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conns: List[Any] = []
+        self.cancelled = False
+
+    def add(self, conn: Any) -> None:
+        with self._lock:
+            if self.cancelled:
+                # Bước đã bị bỏ trước khi kịp kết nối: không chạy truy vấn nữa
+                raise DeadlineExceeded("deadline")
+            self._conns.append(conn)
+
+    def cancel_all(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.cancel()
+            except Exception as e:
+                logger.warning("Cannot cancel DB query of skipped stage: %s", e)
+
+
+_stage_connections: contextvars.ContextVar[Optional[StageConnections]] = contextvars.ContextVar("stage_connections",
+                                                                                               default=None)
+
+
+def track_stage_connection(conn: Any) -> None:
+    """Gọi ngay sau psycopg2.connect() trong hàm DB có thể chạy trong optional_stage (db.connect() đã gọi sẵn)."""
+    holder = _stage_connections.get()
+    if holder is not None:
+        holder.add(conn)
+
+
+def optional_stage(operation: str, stage: str, fn, fallback: Any) -> Any:
+    """Bước không bắt buộc: chạy trong phần ngân sách còn lại; không kịp → trả fallback và đánh dấu kết quả một phần.
+
+    Không kịp thì truy vấn Postgres của bước (nếu đã track_stage_connection) cũng bị huỷ, không chạy tiếp vô ích.
+    """
+    budget = request_budget.get()
+    if budget is None or budget.deadline is None:
+        return fn()
+    remaining = budget.remaining(DEADLINE_RESERVE_MS)
+    if remaining is not None and remaining > 0:
+        holder = StageConnections()
+        ctx = contextvars.copy_context()
+        ctx.run(_stage_connections.set, holder)
+        fut = _optional_stage_executor.submit(ctx.run, fn)
+        try:
+            return fut.result(timeout=remaining)
+        except FutureTimeoutError:
+            holder.cancel_all()
+    budget.skipped.append(stage)
+    DEADLINE_EVENTS.inc(operation=operation, stage=stage, event="skipped")
+    return fallback
+
+
+async def await_within_budget(awaitable, request: Optional[Request] = None, reserve_ms: float = 0.0) -> Any:
+    """Chờ awaitable trong ngân sách của request; hết hạn hoặc client ngắt kết nối → huỷ và raise DeadlineExceeded.
+
+    reserve_ms: thôi chờ sớm hơn hạn chót để còn kịp trả kết quả thay thế.
+    """
+    work = asyncio.ensure_future(awaitable)
+    budget = request_budget.get()
+    if budget is None:
+        return await work
+
+    async def watch_disconnect():
+        # Ngủ trước khi hỏi: request xong nhanh không tốn lần is_disconnected() nào
+        while True:
+            await asyncio.sleep(DISCONNECT_POLL_S)
+            if await request.is_disconnected():
+                return
+
+    watcher = asyncio.ensure_future(watch_disconnect()) if request is not None else None
+    remaining = budget.remaining(reserve_ms)
+    try:
+        done, _ = await asyncio.wait({work, watcher} - {None}, return_when=asyncio.FIRST_COMPLETED,
+                                     timeout=None if remaining is None else max(0.0, remaining))
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+    if work in done:
+        return work.result()
+    # Thread đang chạy sẽ thấy cờ huỷ ở ranh giới bước kế tiếp
+    budget.cancel("client_disconnected" if watcher is not None and watcher in done else "deadline")
+    work.cancel()
+    raise DeadlineExceeded(budget.reason or "deadline")
+
+
+def mark_partial(response: Response) -> None:
+    budget = request_budget.get()
+    if budget is not None and budget.skipped:
+        response.headers[PARTIAL_RESULT_HEADER] = ",".join(budget.skipped)
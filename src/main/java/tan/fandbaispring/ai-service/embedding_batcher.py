@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Micro-batching of embedding calls for ai_service_gemini.py.
+
+BatchingEmbeddings wraps the real embedder. Concurrent small calls (query
+embeddings of /rag-search, document embeddings of /add-establishment) go
+into a queue; a dispatcher thread collects them for EMBED_BATCH_WINDOW_MS
+and sends each kind to the provider as one batch of at most EMBED_BATCH_MAX
+texts, so provider round trips grow with time instead of with the number
+of requests. The "embeddings" bulkhead applies per provider batch.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from bulkheads import EMBEDDINGS_BULKHEAD
+from metrics import METRICS, Histogram
+
+# Các lời gọi embed đồng thời (query của /rag-search, document của /add-establishment) được gom trong
+# EMBED_BATCH_WINDOW_MS rồi gửi provider thành MỘT lô (tối đa EMBED_BATCH_MAX văn bản/lô) → số round trip tăng
+# theo thời gian thay vì theo số request. EMBED_BATCH_WINDOW_MS=0 → gọi thẳng provider như trước.
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+# text-embedding-004 (batchEmbedContents) nhận tối đa 100 văn bản/lô
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "100"))
+EMBED_BATCH_CONCURRENCY = int(os.getenv("EMBED_BATCH_CONCURRENCY", "2"))
+
+EMBED_BATCH_SIZE = Histogram("ai_embedding_batch_size", "Số văn bản mỗi lô gửi provider embedding", ("kind",),
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 100, 250))
+METRICS.append(EMBED_BATCH_SIZE)
+
+
+def embed_query_batch(inner: Any, texts: List[str]) -> List[List[float]]:
+    """Embed nhiều câu truy vấn (task retrieval_query) với ít lời gọi provider nhất có thể."""
+    if hasattr(inner, "embed_queries"):
+        return inner.embed_queries(texts)
+    try:
+        return inner.embed_documents(texts, task_type="retrieval_query")
+    except TypeError:
+        # Provider không phân biệt được query/document theo lô → từng câu một
+        return [inner.embed_query(t) for t in texts]
+
+
+class BatchingEmbeddings(Embeddings):
+    """Bọc một embedder: lời gọi nhỏ vào hàng đợi, thread điều phối gom lô theo cửa sổ thời gian và kích thước.
+
+    Bulkhead "embeddings" áp dụng cho từng lô gửi provider. Các thuộc tính khác (vd. collection_tag) lấy từ embedder gốc.
+    """
+
+    def __init__(self, inner: Any, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_BATCH_MAX,
+                 concurrency: int = EMBED_BATCH_CONCURRENCY):
+        self.inner = inner
+        self.window_s = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue[tuple[str, List[str], Future]]" = queue.Queue()
+        self._flush_pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="embed-batch")
+        self._dispatcher: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def _call_provider(self, kind: str, texts: List[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for start in range(0, len(texts), self.max_batch):
+            chunk = texts[start:start + self.max_batch]
+            EMBED_BATCH_SIZE.observe(len(chunk), kind=kind)
+            with EMBEDDINGS_BULKHEAD.slot():
+                out += embed_query_batch(self.inner, chunk) if kind == "query" else self.inner.embed_documents(chunk)
+        return out
+
+    def _submit(self, kind: str, texts: List[str]) -> List[List[float]]:
+        if self.window_s <= 0 or len(texts) >= self.max_batch:
+            return self._call_provider(kind, texts)
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="embed-dispatcher", daemon=True)
+                self._dispatcher.start()
+        fut: Future = Future()
+        self._queue.put((kind, texts, fut))
+        return fut.result()
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][1])
+            deadline = time.monotonic() + self.window_s
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[1])
+            for kind in ("query", "document"):
+                items = [p for p in pending if p[0] == kind]
+                if items:
+                    self._flush_pool.submit(self._flush, kind, items)
+
+    def _flush(self, kind: str, items: List[tuple]) -> None:
+        # Văn bản trùng trong cùng lô chỉ gửi một lần
+        unique = list(dict.fromkeys(t for _, texts, _ in items for t in texts))
+        try:
+            by_text = dict(zip(unique, self._call_provider(kind, unique)))
+        except BaseException as e:
+            for _, _, fut in items:
+                fut.set_exception(e)
+            return
+        for _, texts, fut in items:
+            fut.set_result([by_text[t] for t in texts])
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._submit("document", list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit("query", [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self._submit("query", list(texts))
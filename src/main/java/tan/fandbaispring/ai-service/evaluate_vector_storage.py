@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Compare compressed vector storage configurations against the current setup.
+
+Embeds sample_establishments_data.json (optionally tiled with --scale to get a
+larger catalogue), stores it in an in-memory Chroma collection exactly like
+the service does, then builds one QuantizedIndex per configuration and runs
+the /rag-search query texts against each. For every configuration it reports
+bytes per vector, resident index size, query latency (p50/p95) and recall@3
+against exact float32 search, with and without the float re-rank step. The
+"chroma" row is the current setup (float32 HNSW).
+
+Configurations are written as mode[@dims[/reduction]], e.g. int8, binary,
+int8@256, binary@512/truncate, int8@64/pca.
+
+Examples:
+    python evaluate_vector_storage.py
+    python evaluate_vector_storage.py --scale 200 --rerank-pool 50
+    python evaluate_vector_storage.py --provider gemini --configs int8,int8@256,binary@768
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from benchmark_service import DEFAULT_DATA, load_sample_data, load_service, percentile
+
+DEFAULT_CONFIGS = "float@256,int8,int8@256,int8@128/pca,binary,binary@256"
+
+
+def tile_rows(rows, scale: int):
+    """Nhân bản catalogue mẫu (đổi id/tên) để đo với số lượng vector lớn hơn."""
+    if scale <= 1:
+        return rows
+    out = []
+    for r in range(scale):
+        for row in rows:
+            out.append({**row, "id": f"{row['id']}-{r:04d}", "name": f"{row['name']} {r}" if r else row["name"]})
+    return out
+
+
+def build_queries(svc, rows):
+    """Câu truy vấn đúng như /rag-search tạo ra từ các bộ tham số quiz điển hình."""
+    texts = []
+    for row in rows:
+        amenity = (row["amenities_list"].split(",")[0] or "").strip()
+        for params in (
+            {"city": row["city"], "establishment_type": row["type"], "amenities_priority": amenity},
+            {"city": row["city"], "travel_companion": "family"},
+            {"establishment_type": row["type"], "amenities_priority": amenity, "budget": row["price_range_vnd"]},
+        ):
+            texts.append(svc.prepare_search(params)["query_text"])
+    return list(dict.fromkeys(texts))
+
+
+def parse_config(spec: str):
+    mode, _, rest = spec.partition("@")
+    dims, _, reduction = rest.partition("/")
+    return mode.strip(), int(dims or 0), (reduction or "truncate").strip()
+
+
+def recall_at(results, truth, k: int = 3) -> float:
+    hits = [len({m["id"] for m, _ in res[:k]} & set(t[:k])) / float(min(k, len(t)) or 1)
+            for res, t in zip(results, truth)]
+    return sum(hits) / len(hits) if hits else 0.0
+
+
+def timed_search(search, query_vectors, k: int):
+    latencies, results = [], []
+    for qv in query_vectors:
+        t0 = time.perf_counter()
+        results.append(search(qv, k))
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+    latencies.sort()
+    return results, round(percentile(latencies, 50), 3), round(percentile(latencies, 95), 3)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--data", type=Path, default=DEFAULT_DATA, help="sample establishments JSON")
+    ap.add_argument("--provider", choices=("stub", "gemini"), default="stub",
+                    help="stub = deterministic fake embeddings, gemini = text-embedding-004 (needs GOOGLE_API_KEY)")
+    ap.add_argument("--stub-dims", type=int, default=768, help="dimensionality of the stub embeddings")
+    ap.add_argument("--scale", type=int, default=1, help="tile the sample catalogue N times")
+    ap.add_argument("--configs", default=DEFAULT_CONFIGS, help="comma separated mode[@dims[/reduction]]")
+    ap.add_argument("--rerank-pool", type=int, default=50, help="candidates re-ranked with float32 vectors")
+    ap.add_argument("--k", type=int, default=3, help="recall cut-off")
+    ap.add_argument("--output", type=Path, help="write the report as JSON")
+    args = ap.parse_args()
+    for name in ("data", "output"):
+        if getattr(args, name):
+            setattr(args, name, getattr(args, name).resolve())
+
+    import chromadb
+    import numpy as np
+    from langchain_chroma import Chroma
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    print("🧮 Vector storage evaluation")
+    print("=" * 40)
+    svc, _ = load_service(0.0, 0.0)
+    if args.provider == "gemini":
+        emb = svc.GoogleGenerativeAIEmbeddings(model="text-embedding-004")
+    else:
+        emb = DeterministicFakeEmbedding(size=args.stub_dims)
+
+    rows = tile_rows(load_sample_data(args.data), args.scale)
+    client = chromadb.EphemeralClient()
+    vs = Chroma(collection_name="vector_storage_eval", embedding_function=emb, client=client)
+    for start in range(0, len(rows), 500):
+        batch = rows[start:start + 500]
+        vs.add_texts(texts=[svc.build_source_text(r) for r in batch], metadatas=batch)
+    svc.vectorstore = vs
+    stored = vs._collection.get(include=["embeddings", "metadatas"])
+    ids, metas = stored["ids"], stored["metadatas"]
+    X = np.asarray(stored["embeddings"], dtype=np.float32)
+
+    queries = build_queries(svc, rows[:len(rows) // max(args.scale, 1)])
+    query_vectors = [list(map(float, v)) for v in emb.embed_documents(queries)]
+    Q = np.asarray(query_vectors, dtype=np.float32)
+    # Chuẩn: tìm kiếm chính xác trên float32 (brute force)
+    exact = ((Q[:, None, :] - X[None, :, :]) ** 2).sum(axis=2)
+    truth = [[metas[j]["id"] for j in np.argsort(row)[:args.k]] for row in exact]
+    print(f"   {len(ids)} vectors × {X.shape[1]} dims, {len(queries)} queries ({args.provider} embeddings)")
+
+    report = {
+        "config": {k: (v.name if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "vectors": len(ids),
+        "dims": int(X.shape[1]),
+        "queries": len(queries),
+        "results": {},
+    }
+
+    def chroma_search(qv, k):
+        return svc.vector_search_many([qv], k)[0]
+
+    svc.quantized_index = None
+    res, p50, p95 = timed_search(chroma_search, query_vectors, args.k)
+    report["results"]["chroma"] = {
+        "bytes_per_vector": int(X.shape[1] * 4),
+        "resident_bytes": int(X.nbytes),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "recall": round(recall_at(res, truth, args.k), 4),
+        "recall_no_rerank": None,
+    }
+
+    for spec in [c.strip() for c in args.configs.split(",") if c.strip()]:
+        mode, dims, reduction = parse_config(spec)
+        index = svc.QuantizedIndex(mode, dims, reduction, args.rerank_pool, float_path="eval_float32.npy")
+        index.build(ids, X, metas)
+        res, p50, p95 = timed_search(lambda qv, k: index.search_many([qv], k)[0], query_vectors, args.k)
+        # rerank_pool = k: thứ tự chỉ dựa trên mã nén (tập top-k không đổi khi xếp lại)
+        index.rerank_pool = args.k
+        raw = [index.search_many([qv], args.k)[0] for qv in query_vectors]
+        stats = index.stats()
+        report["results"][spec] = {
+            "bytes_per_vector": stats["bytes_per_vector"],
+            "resident_bytes": stats["resident_bytes"],
+            "p50_ms": p50,
+            "p95_ms": p95,
+            "recall": round(recall_at(res, truth, args.k), 4),
+            "recall_no_rerank": round(recall_at(raw, truth, args.k), 4),
+        }
+
+    base = report["results"]["chroma"]["resident_bytes"] or 1
+    print(f"\n{'config':<18}{'B/vec':>8}{'index KB':>11}{'vs f32':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{f'R@{args.k}':>8}{f'R@{args.k} raw':>11}")
+    for name, r in report["results"].items():
+        raw_recall = "-" if r["recall_no_rerank"] is None else f"{r['recall_no_rerank']:.3f}"
+        print(f"{name:<18}{r['bytes_per_vector']:>8}{r['resident_bytes'] / 1024:>11.1f}"
+              f"{r['resident_bytes'] / base:>8.1%}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+              f"{r['recall']:>8.3f}{raw_recall:>11}")
+    print("\nresident = compressed codes + quantizer/PCA parameters; float32 vectors for re-rank stay memory-mapped on disk")
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\n💾 Report saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
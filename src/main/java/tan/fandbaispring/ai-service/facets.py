@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Quiz facets for ai_service_gemini.py.
+
+FacetIndex keeps, per (accent-stripped city, TYPE), how many establishments
+offer each amenity and fall into each price bucket, star rating and maximum
+capacity. Counts are built once from the index metadata and then updated
+incrementally as establishments are upserted or removed, so /generate-quiz
+can offer only choices that still match at least one establishment without
+scanning Chroma per request.
+"""
+
+import bisect
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from amenity_vocab import AmenityVocabulary
+
+# Dùng để quiz chỉ gợi ý lựa chọn chắc chắn có cơ sở khớp trong city/type đã chọn
+FACET_PRICE_BUCKETS = tuple(int(x) for x in os.getenv(
+    "FACET_PRICE_BUCKETS", "500000,1000000,2000000,3000000,5000000").split(",") if x.strip())
+FACET_AMENITY_OPTIONS = int(os.getenv("FACET_AMENITY_OPTIONS", "6"))
+
+
+def as_int(v: Any) -> Optional[int]:
+    try:
+        return int(float(v)) if v is not None and str(v).strip() != "" else None
+    except Exception:
+        return None
+
+
+class FacetIndex:
+    """Bộ đếm facet theo (city không dấu, TYPE), cập nhật tăng dần theo metadata được ghi/xoá khỏi Chroma.
+
+    Mỗi cơ sở đóng góp đúng một lần (các chunk cùng id gộp lại). Dựng toàn bộ từ metadata Chroma ở lần dùng
+    đầu tiên hoặc sau invalidate(); trước đó upsert/remove bỏ qua vì lần dựng sẽ đọc trạng thái mới nhất.
+    """
+
+    def __init__(self, price_buckets: tuple, vocab: AmenityVocabulary,
+                 load_metadatas: Callable[[], List[Dict[str, Any]]], city_key: Callable[[Optional[str]], str],
+                 amenity_mask: Callable[[Dict[str, Any]], int]):
+        self.price_buckets = price_buckets
+        self.vocab = vocab
+        # load_metadatas() → metadata mọi document trong index; city_key = chuẩn hoá city giống prepare_search;
+        # amenity_mask(meta) → mask tiện ích của document
+        self._load_metadatas = load_metadatas
+        self._city_key = city_key
+        self._amenity_mask = amenity_mask
+        self._lock = threading.Lock()
+        self._built = False
+        # id cơ sở → (key, amenity mask, bucket giá, số sao, sức chứa lớn nhất)
+        self._docs: Dict[str, tuple] = {}
+        self._facets: Dict[tuple, Dict[str, Any]] = {}
+        self._bit_shifts = np.arange(len(vocab.ids), dtype=np.int64)
+
+    def _record(self, meta: Dict[str, Any]) -> tuple:
+        price = as_int(meta.get("price_range_vnd"))
+        return (
+            (self._city_key(meta.get("city")), str(meta.get("type") or "").strip().upper()),
+            self._amenity_mask(meta),
+            None if price is None else bisect.bisect_left(self.price_buckets, price),
+            as_int(meta.get("star_rating")),
+            as_int(meta.get("max_capacity")),
+        )
+
+    def _apply(self, record: tuple, sign: int) -> None:
+        key, mask, bucket, stars, capacity = record
+        f = self._facets.get(key)
+        if f is None:
+            f = self._facets[key] = {
+                "count": 0,
+                "amenities": np.zeros(len(self._bit_shifts), dtype=np.int64),
+                "prices": np.zeros(len(self.price_buckets) + 1, dtype=np.int64),
+                "stars": {},
+                "capacity": {},
+            }
+        f["count"] += sign
+        f["amenities"] += sign * ((mask >> self._bit_shifts) & 1)
+        if bucket is not None:
+            f["prices"][bucket] += sign
+        for name, value in (("stars", stars), ("capacity", capacity)):
+            counts = f[name]
+            counts[value] = counts.get(value, 0) + sign
+            if counts[value] <= 0:
+                del counts[value]
+        if f["count"] <= 0:
+            del self._facets[key]
+
+    def _upsert_locked(self, metas: List[Dict[str, Any]]) -> None:
+        latest: Dict[str, Dict[str, Any]] = {}
+        for meta in metas:
+            est_id = str((meta or {}).get("id") or "")
+            if est_id:
+                latest[est_id] = meta
+        for est_id, meta in latest.items():
+            record = self._record(meta)
+            old = self._docs.get(est_id)
+            if old == record:
+                continue
+            if old is not None:
+                self._apply(old, -1)
+            self._apply(record, 1)
+            self._docs[est_id] = record
+
+    def upsert(self, metas: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            if self._built:
+                self._upsert_locked(metas)
+
+    def remove(self, establishment_ids: List[str]) -> None:
+        with self._lock:
+            if not self._built:
+                return
+            for est_id in establishment_ids:
+                old = self._docs.pop(str(est_id), None)
+                if old is not None:
+                    self._apply(old, -1)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built = False
+
+    def _ensure_built(self) -> None:
+        with self._lock:
+            if self._built:
+                return
+            metas = self._load_metadatas()
+            self._docs, self._facets = {}, {}
+            self._upsert_locked(metas)
+            self._built = True
+
+    def aggregate(self, city: Optional[str], est_type: Optional[str] = None) -> Dict[str, Any]:
+        """Gộp facet của mọi (city, type) khớp; city/type None = mọi giá trị."""
+        self._ensure_built()
+        city_norm = self._city_key(city)
+        want_type = str(est_type or "").strip().upper()
+        out: Dict[str, Any] = {
+            "count": 0,
+            "types": {},
+            "amenities": np.zeros(len(self._bit_shifts), dtype=np.int64),
+            "prices": np.zeros(len(self.price_buckets) + 1, dtype=np.int64),
+            "stars": {},
+            "capacity": {},
+        }
+        with self._lock:
+            for (key_city, key_type), f in self._facets.items():
+                if city_norm and key_city != city_norm:
+                    continue
+                # Phân bố loại cơ sở chỉ lọc theo city (để gợi ý establishment_type)
+                out["types"][key_type] = out["types"].get(key_type, 0) + f["count"]
+                if want_type and key_type != want_type:
+                    continue
+                out["count"] += f["count"]
+                out["amenities"] += f["amenities"]
+                out["prices"] += f["prices"]
+                for name in ("stars", "capacity"):
+                    for value, n in f[name].items():
+                        out[name][value] = out[name].get(value, 0) + n
+        return out
+
+    def summary(self, city: Optional[str], est_type: Optional[str] = None) -> Dict[str, Any]:
+        agg = self.aggregate(city, est_type)
+        known_caps = [c for c in agg["capacity"] if c is not None]
+        edges = list(self.price_buckets) + [None]
+        return {
+            "count": agg["count"],
+            "types": agg["types"],
+            "amenities": {self.vocab.display[self.vocab.ids[i]]: int(agg["amenities"][i])
+                          for i in np.argsort(-agg["amenities"], kind="stable") if agg["amenities"][i] > 0},
+            "price_buckets": [{"max": edge, "count": int(n)} for edge, n in zip(edges, agg["prices"])],
+            "stars": {str(k): v for k, v in sorted(agg["stars"].items(), key=lambda kv: (kv[0] is None, kv[0] or 0))},
+            "capacity": {"min": min(known_caps), "max": max(known_caps),
+                         "unknown": agg["capacity"].get(None, 0)} if known_caps else None,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"built": self._built, "establishments": len(self._docs), "keys": len(self._facets)}
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Durable index job queue for ai_service_gemini.py.
+
+/add-establishment, /remove-establishment, /reindex and change sync only
+write a job row to SQLite and return; a background worker claims due jobs in
+batches and hands them to the service's process callback. A newer job for
+the same establishment overwrites the pending one (coalescing) and bumps its
+version, so completing an older version never drops an update that arrived
+while the batch was being embedded. Failed jobs back off exponentially and
+stop after INDEX_MAX_ATTEMPTS; stats() feeds /health.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import METRICS, Counter
+
+logger = logging.getLogger(__name__)
+
+# /add-establishment và /remove-establishment chỉ ghi job rồi trả 202; worker nền gom các cập nhật
+# lặp lại cho cùng một ID (job mới ghi đè job cũ), embed theo lô và ghi Chroma.
+INDEX_QUEUE_ENABLED = os.getenv("INDEX_QUEUE_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+INDEX_QUEUE_PATH = os.getenv("INDEX_QUEUE_PATH", "./index_queue.sqlite3")
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "32"))
+INDEX_BATCH_WINDOW_MS = float(os.getenv("INDEX_BATCH_WINDOW_MS", "200"))
+INDEX_MAX_ATTEMPTS = int(os.getenv("INDEX_MAX_ATTEMPTS", "5"))
+
+INDEX_JOBS = Counter("ai_index_jobs_total", "Số job index theo kết quả", ("action", "result"))
+METRICS.append(INDEX_JOBS)
+
+
+class IndexQueue:
+    """Job index bền vững theo establishment_id: ghi đè job cũ cùng ID, worker nền xử lý theo lô.
+
+    process(queue, jobs) do service cung cấp: ghi Chroma rồi gọi queue.complete() cho các job đã xong;
+    lỗi cả lô → thử lại từng job, job vẫn lỗi bị lùi lịch (backoff mũ) tới max_attempts lần.
+    """
+
+    def __init__(self, path: str, process: Callable[["IndexQueue", List[tuple]], None],
+                 batch_size: int = INDEX_BATCH_SIZE, window_ms: float = INDEX_BATCH_WINDOW_MS,
+                 max_attempts: int = INDEX_MAX_ATTEMPTS):
+        self.path = path
+        self._process = process
+        self.batch_size = batch_size
+        self.window_ms = window_ms
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _init_db(self) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS index_jobs (
+                    establishment_id TEXT PRIMARY KEY,
+                    action TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 1,
+                    enqueued_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT
+                )
+            """)
+
+    def enqueue(self, est_id: str, action: str) -> bool:
+        """Ghi job; trả True nếu đã gộp vào một job đang chờ cho cùng ID."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            existed = conn.execute("SELECT 1 FROM index_jobs WHERE establishment_id = ?", (est_id,)).fetchone() is not None
+            conn.execute("""
+                INSERT INTO index_jobs (establishment_id, action, enqueued_at, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(establishment_id) DO UPDATE SET
+                    action = excluded.action, version = version + 1, updated_at = excluded.updated_at,
+                    not_before = 0, attempts = 0, last_error = NULL
+            """, (est_id, action, now, now))
+        INDEX_JOBS.inc(action=action, result="coalesced" if existed else "enqueued")
+        self._wake.set()
+        return existed
+
+    def claim(self, limit: int) -> List[tuple]:
+        with closing(self._connect()) as conn:
+            return conn.execute("""
+                SELECT establishment_id, action, version FROM index_jobs
+                WHERE not_before <= ? AND attempts < ?
+                ORDER BY enqueued_at LIMIT ?
+            """, (time.time(), self.max_attempts, limit)).fetchall()
+
+    def complete(self, jobs: List[tuple], result: str = "done") -> None:
+        # Chỉ xoá nếu version không đổi: cập nhật mới đến trong lúc xử lý sẽ được chạy lại
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM index_jobs WHERE establishment_id = ? AND version = ?",
+                             [(j[0], j[2]) for j in jobs])
+        for j in jobs:
+            INDEX_JOBS.inc(action=j[1], result=result)
+
+    def fail(self, jobs: List[tuple], error: str) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            for est_id, action, version in jobs:
+                conn.execute("""
+                    UPDATE index_jobs SET attempts = attempts + 1, last_error = ?,
+                        not_before = ? + MIN(300, 2 * (1 << attempts))
+                    WHERE establishment_id = ? AND version = ?
+                """, (error[:500], now, est_id, version))
+                INDEX_JOBS.inc(action=action, result="error")
+
+    def stats(self) -> Dict[str, Any]:
+        with closing(self._connect()) as conn:
+            depth, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(enqueued_at) FROM index_jobs WHERE attempts < ?", (self.max_attempts,)
+            ).fetchone()
+            failed = conn.execute(
+                "SELECT COUNT(*) FROM index_jobs WHERE attempts >= ?", (self.max_attempts,)
+            ).fetchone()[0]
+        return {
+            "depth": depth,
+            "lag_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "failed": failed,
+            "worker_alive": bool(self._thread and self._thread.is_alive()),
+        }
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="index-queue-worker", daemon=True)
+        self._thread.start()
+        self._wake.set()  # xử lý job còn tồn sau restart
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+            while not self._stop.is_set():
+                jobs = self.claim(self.batch_size)
+                if not jobs:
+                    break
+                if len(jobs) < self.batch_size and self.window_ms > 0:
+                    # Chờ thêm một chút để gom burst chỉnh sửa vào cùng một lô embed
+                    self._stop.wait(self.window_ms / 1000.0)
+                    jobs = self.claim(self.batch_size)
+                try:
+                    self.process(jobs)
+                except Exception as e:
+                    logger.error("Index batch failed, retrying per job: %s", getattr(e, 'message', str(e)))
+                    for job in jobs:
+                        try:
+                            self.process([job])
+                        except Exception as e1:
+                            logger.error("Index job %s failed: %s", job[0], getattr(e1, 'message', str(e1)))
+                            self.fail([job], str(e1))
+
+    def process(self, jobs: List[tuple]) -> None:
+        self._process(self, jobs)
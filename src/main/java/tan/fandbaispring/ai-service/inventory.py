@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Room inventory for ai_service_gemini.py: one availability predicate for every
+search path.
+
+The Spring backend keeps a unit_type per bookable room type (capacity,
+base_price, total_units; totalUnits null or <= 0 means unlimited) and an
+optional unit_availability row per (type, date) with its own total_units,
+units_booked and override_price. Most days have no row — BookingController
+then falls back to UnitType.totalUnits — so a missing row means "the type's
+own stock at base price", never "sold out".
+
+fetch_inventory() reads the active types and the sparse rows of a date range
+in one connection and InventoryCalendar densifies them into (day x type)
+matrices. Stay availability (vector-first and SQL-first plans), cheapest
+prices and flexible-date windows are all answered from those matrices, so
+the plans cannot disagree about which establishment is bookable.
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from bulkheads import POSTGRES_BULKHEAD
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+# Loại phòng không giới hạn số lượng (total_units null hoặc <= 0)
+UNLIMITED = 1_000_000
+
+
+def units_left(free: Any) -> Optional[int]:
+    """Số phòng còn để hiển thị; None với loại phòng không giới hạn (kể cả sau khi trừ phòng đã đặt)."""
+    return int(free) if free < UNLIMITED // 2 else None
+
+
+def as_date(value: Any) -> Optional[date]:
+    if value is None:
+        return None
+    return value.date() if isinstance(value, datetime) else value
+
+
+def stay_nights(start: Any, end: Any) -> Tuple[Optional[date], Optional[date]]:
+    """[ngày nhận, ngày trả) của kỳ nghỉ; trả phòng cùng ngày hoặc trước ngày nhận được tính là một đêm."""
+    start, end = as_date(start), as_date(end)
+    if start is None or end is None:
+        return None, None
+    return start, max(end, start + timedelta(days=1))
+
+
+class InventoryCalendar:
+    """Tồn phòng (ngày × loại phòng) của một nhóm cơ sở trong [first, last).
+
+    types: (establishment_id, type_id, capacity, total_units, base_price) của các loại phòng đang hoạt động.
+    rows: (type_id, date, total_units, units_booked, override_price) — dòng unit_availability nếu có.
+    Ngày không có dòng dùng tồn và giá mặc định của loại phòng.
+    """
+
+    def __init__(self, types: Sequence[tuple], rows: Sequence[tuple], first: date, last: date):
+        self.first = first
+        self.days = max(0, (last - first).days)
+        self.type_ids: List[Any] = []
+        self.capacity: List[Optional[int]] = []
+        self.base_price: List[Optional[float]] = []
+        self.columns: Dict[str, List[int]] = {}
+        defaults: List[int] = []
+        for est_id, type_id, capacity, total_units, base_price in types:
+            self.columns.setdefault(str(est_id), []).append(len(self.type_ids))
+            self.type_ids.append(type_id)
+            self.capacity.append(capacity)
+            self.base_price.append(None if base_price is None else float(base_price))
+            defaults.append(int(total_units) if total_units is not None and total_units > 0 else UNLIMITED)
+        col_of = {type_id: j for j, type_id in enumerate(self.type_ids)}
+        self.avail = np.tile(np.asarray(defaults, dtype=np.int64), (self.days, 1))
+        self.price = np.tile(np.asarray([np.nan if p is None else p for p in self.base_price], dtype=np.float64),
+                             (self.days, 1))
+        for type_id, day, total_units, units_booked, override_price in rows:
+            j = col_of.get(type_id)
+            d = (as_date(day) - first).days
+            if j is None or not 0 <= d < self.days:
+                continue
+            total = defaults[j] if total_units is None else int(total_units)
+            self.avail[d, j] = total - int(units_booked or 0)
+            if override_price is not None:
+                self.price[d, j] = float(override_price)
+
+    def has_inventory(self, est_id: str) -> bool:
+        """Cơ sở có loại phòng đang hoạt động nào không; không có thì không có dữ liệu để lọc."""
+        return bool(self.columns.get(str(est_id)))
+
+    def fitting(self, est_id: str, num_guests: Optional[int]) -> List[int]:
+        return [j for j in self.columns.get(str(est_id), ())
+                if num_guests is None or self.capacity[j] is None or self.capacity[j] >= num_guests]
+
+    def _span(self, start: date, end: date) -> slice:
+        lo = (start - self.first).days
+        hi = (end - self.first).days
+        if lo < 0 or hi > self.days:
+            raise ValueError(f"stay {start}..{end} outside inventory {self.first}+{self.days}d")
+        return slice(lo, hi)
+
+    def stay_available(self, est_id: str, num_guests: Optional[int], start: Any = None, end: Any = None) -> bool:
+        """Có loại phòng đủ sức chứa còn trống MỌI đêm của kỳ nghỉ (không có ngày: chỉ xét sức chứa)."""
+        if not self.has_inventory(est_id):
+            return True
+        cols = self.fitting(est_id, num_guests)
+        start, end = stay_nights(start, end)
+        if not cols or start is None:
+            return bool(cols)
+        return bool((self.avail[self._span(start, end)][:, cols] > 0).all(axis=0).any())
+
+    def cheapest_price(self, est_id: str, num_guests: Optional[int], start: Any = None,
+                       end: Any = None) -> Optional[int]:
+        """Giá đêm thấp nhất của loại phòng đủ sức chứa: trong các đêm còn trống của kỳ nghỉ, hoặc giá gốc."""
+        cols = self.fitting(est_id, num_guests)
+        start, end = stay_nights(start, end)
+        if not cols:
+            return None
+        if start is None:
+            prices = np.asarray([self.base_price[j] for j in cols], dtype=np.float64)
+        else:
+            span = self._span(start, end)
+            prices = np.where(self.avail[span][:, cols] > 0, self.price[span][:, cols], np.nan)
+        return None if np.isnan(prices).all() else int(np.nanmin(prices))
+
+    def date_windows(self, num_guests: Optional[int], nights: int, weekend: bool,
+                     limit: int) -> Dict[str, List[Tuple[date, Optional[int], Optional[int]]]]:
+        """Các ngày nhận phòng tốt nhất (rẻ nhất, rồi sớm nhất) cho từng cơ sở có ít nhất một khoảng N đêm khả thi.
+
+        Trả {est_id: [(ngày nhận, tổng giá | None, số phòng còn | None nếu không giới hạn)]}; cơ sở không có
+        khoảng nào bị bỏ.
+        Min trượt cửa sổ N đêm = số phòng trống ít nhất của cả kỳ nghỉ, tổng trượt = giá cả kỳ; mọi ngày nhận
+        phòng và loại phòng được tính trong một lượt numpy.
+        """
+        if self.days < nights or not self.type_ids:
+            return {}
+        # (ngày nhận phòng × loại phòng)
+        units = sliding_window_view(self.avail, nights, axis=0).min(axis=-1)
+        totals = sliding_window_view(self.price, nights, axis=0).sum(axis=-1)
+        feasible = units > 0
+        if weekend:
+            # Nhận phòng thứ Sáu/thứ Bảy
+            weekday = (self.first.weekday() + np.arange(units.shape[0])) % 7
+            feasible &= np.isin(weekday, (4, 5))[:, None]
+        # Khả thi nhưng thiếu giá xếp sau mọi lựa chọn có giá; không khả thi = inf
+        cost = np.where(feasible, np.nan_to_num(totals, nan=np.finfo(np.float64).max), np.inf)
+
+        out: Dict[str, List[Tuple[date, Optional[int], Optional[int]]]] = {}
+        for est_id in self.columns:
+            cols = np.asarray(self.fitting(est_id, num_guests), dtype=np.intp)
+            if cols.size == 0:
+                continue
+            best = cols[cost[:, cols].argmin(axis=1)]
+            rows = np.arange(cost.shape[0])
+            best_cost = cost[rows, best]
+            ok = np.flatnonzero(np.isfinite(best_cost))
+            if ok.size == 0:
+                continue
+            picked = ok[np.lexsort((ok, best_cost[ok]))][:limit]
+            out[est_id] = [(self.first + timedelta(days=int(d)),
+                            None if np.isnan(totals[d, best[d]]) else int(totals[d, best[d]]),
+                            units_left(units[d, best[d]])) for d in picked]
+        return out
+
+
+@POSTGRES_BULKHEAD.guard
+def fetch_inventory(est_ids: List[str], first: date, last: date) -> Optional[InventoryCalendar]:
+    """Loại phòng đang hoạt động + dòng unit_availability trong [first, last) của các cơ sở; None nếu lỗi DB."""
+    if not est_ids:
+        return InventoryCalendar([], [], first, last)
+    try:
+        with connect() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT ut.establishment_id, ut.id, ut.capacity, ut.total_units, ut.base_price
+                FROM unit_type ut
+                WHERE ut.establishment_id = ANY(%s) AND COALESCE(ut.active, TRUE)
+                ORDER BY ut.establishment_id, ut.id
+            """, (list(est_ids),))
+            types = cur.fetchall()
+            rows: List[tuple] = []
+            if types and first < last:
+                cur.execute("""
+                    SELECT ua.type_id, ua.date, ua.total_units, ua.units_booked, ua.override_price
+                    FROM unit_availability ua
+                    WHERE ua.type_id = ANY(%s) AND ua.date >= %s AND ua.date < %s
+                """, ([t[1] for t in types], first, last))
+                rows = cur.fetchall()
+            return InventoryCalendar(types, rows, first, last)
+    except Exception as error:
+        logger.error("DB error in fetch_inventory: %s", error)
+        return None
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Local (offline) embedding providers shared by ai_service_gemini.py and
+ai_service_openai.py.
+
+Selected with EMBEDDING_PROVIDER:
+    hashing  - deterministic feature-hashing embedder (no model, no network);
+               meant for tests, load tests and CI
+    local    - sentence-transformers model on CPU with batched inference
+               (LOCAL_EMBEDDING_MODEL, default a small multilingual MiniLM)
+
+Each provider writes to its own Chroma collection (see collection_tag) so
+vectors of different models/dimensions never mix; POST /reindex fills it
+without calling any paid API.
+
+Throughput on CPU:
+    python local_embeddings.py --provider hashing --texts 2000
+    python local_embeddings.py --provider local --batch-sizes 1,16,64
+"""
+
+import hashlib
+import math
+import os
+import re
+import unicodedata
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+LOCAL_PROVIDERS = ("hashing", "local")
+DEFAULT_LOCAL_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _fold(text: str) -> str:
+    # Bỏ dấu tiếng Việt để "Đà Nẵng" và "da nang" trùng đặc trưng
+    text = unicodedata.normalize("NFD", text or "")
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return text.replace("đ", "d").replace("Đ", "D").lower()
+
+
+def _tag(value: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_")[:30] or "local"
+
+
+class HashingEmbeddings(Embeddings):
+    """Feature hashing của từ, cặp từ liền kề và n-gram ký tự → vector chuẩn hoá L2.
+
+    Hoàn toàn tất định (md5, không phụ thuộc PYTHONHASHSEED) và không cần mạng; văn bản có nhiều từ chung
+    cho khoảng cách nhỏ hơn nên đủ để chạy thử RAG end-to-end.
+    """
+
+    def __init__(self, dims: int = 512, char_ngram: int = 3):
+        self.dims = dims
+        self.char_ngram = char_ngram
+        self.collection_tag = f"hashing{dims}"
+
+    def _features(self, text: str) -> List[str]:
+        words = _TOKEN_RE.findall(_fold(text))
+        feats = list(words)
+        feats += [f"{a} {b}" for a, b in zip(words, words[1:])]
+        n = self.char_ngram
+        if n > 0:
+            for w in words:
+                padded = f"#{w}#"
+                feats += [f"#{padded[i:i + n]}" for i in range(max(1, len(padded) - n + 1))]
+        return feats
+
+    def _embed(self, text: str) -> List[float]:
+        counts = {}
+        for f in self._features(text):
+            counts[f] = counts.get(f, 0) + 1
+        vec = [0.0] * self.dims
+        for f, tf in counts.items():
+            h = int.from_bytes(hashlib.md5(f.encode("utf-8")).digest()[:8], "little")
+            # Bit thấp chọn chiều, bit cao chọn dấu để va chạm hash triệt tiêu nhau thay vì cộng dồn
+            vec[h % self.dims] += (1.0 if (h >> 63) else -1.0) * (1.0 + math.log(tf))
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Model sentence-transformers chạy cục bộ (mặc định CPU), encode theo batch."""
+
+    def __init__(self, model_name: str = DEFAULT_LOCAL_MODEL, device: str = "cpu", batch_size: int = 32,
+                 query_prefix: str = "", document_prefix: str = ""):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError("EMBEDDING_PROVIDER=local cần gói sentence-transformers "
+                               "(pip install sentence-transformers)") from e
+        self.model = SentenceTransformer(model_name, device=device)
+        self.batch_size = batch_size
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self.collection_tag = _tag(model_name.rsplit("/", 1)[-1])
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True,
+                                    convert_to_numpy=True, show_progress_bar=False)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode([self.document_prefix + t for t in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([self.query_prefix + text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Nhiều câu truy vấn trong một lần encode (dùng cho gom lô embedding)."""
+        return self._encode([self.query_prefix + t for t in texts])
+
+
+def local_embeddings_from_env(provider: Optional[str] = None) -> Embeddings:
+    """Tạo embedder cục bộ theo biến môi trường (EMBEDDING_PROVIDER=hashing|local)."""
+    provider = (provider or os.getenv("EMBEDDING_PROVIDER", "hashing")).strip().lower()
+    if provider == "hashing":
+        return HashingEmbeddings(dims=int(os.getenv("HASHING_EMBEDDING_DIMS", "512")))
+    if provider == "local":
+        return SentenceTransformerEmbeddings(
+            model_name=os.getenv("LOCAL_EMBEDDING_MODEL", DEFAULT_LOCAL_MODEL),
+            device=os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu"),
+            batch_size=int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32")),
+            query_prefix=os.getenv("LOCAL_EMBEDDING_QUERY_PREFIX", ""),
+            document_prefix=os.getenv("LOCAL_EMBEDDING_DOCUMENT_PREFIX", ""),
+        )
+    raise ValueError(f"Unknown local embedding provider: {provider}")
+
+
+def main():
+    import argparse
+    import json
+    import time
+    from pathlib import Path
+
+    default_data = Path(__file__).resolve().parents[6] / "sample_establishments_data.json"
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--provider", choices=LOCAL_PROVIDERS, default="hashing")
+    ap.add_argument("--data", type=Path, default=default_data, help="sample establishments JSON")
+    ap.add_argument("--texts", type=int, default=1000, help="number of documents to embed")
+    ap.add_argument("--batch-sizes", default="1,8,32,64", help="comma separated batch sizes (local provider)")
+    args = ap.parse_args()
+
+    raw = json.loads(args.data.read_text(encoding="utf-8"))
+    rows = raw.get("establishments", raw if isinstance(raw, list) else [])
+    base = [
+        f"Tên: {e.get('name')}, Thành phố: {e.get('city')}, Loại: {e.get('type')}. "
+        f"Tiện ích: {', '.join(e.get('amenitiesList') or [])}. Mô tả chi tiết: {e.get('descriptionLong') or ''}"
+        for e in rows
+    ]
+    texts = [f"{base[i % len(base)]} #{i}" for i in range(args.texts)]
+
+    print(f"⚡ Local embedding throughput ({args.provider}, {len(texts)} documents, CPU)")
+    print("=" * 40)
+    t0 = time.perf_counter()
+    emb = local_embeddings_from_env(args.provider)
+    print(f"   load: {time.perf_counter() - t0:.1f}s")
+    emb.embed_documents(texts[:8])  # warm-up
+    sizes = [int(s) for s in args.batch_sizes.split(",") if s.strip()] if args.provider == "local" else [0]
+    for size in sizes:
+        if size:
+            emb.batch_size = size
+        t0 = time.perf_counter()
+        vectors = emb.embed_documents(texts)
+        docs_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for t in texts[:100]:
+            emb.embed_query(t)
+        query_ms = (time.perf_counter() - t0) * 1000.0 / min(100, len(texts))
+        label = f"batch {size}" if size else "hashing"
+        print(f"   {label:<10} dims={len(vectors[0])}  {len(texts) / docs_s:,.0f} docs/s  query {query_ms:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+In-process metrics registry for ai_service_gemini.py, rendered as Prometheus
+text at GET /metrics.
+
+Counter and Histogram keep their values in a dict under a lock, so recording
+is one addition and needs no client library. Every module that defines a
+metric appends it to METRICS; render_metrics() walks that list and adds the
+derived per-cache hit ratio.
+"""
+
+import bisect
+import threading
+from typing import Any, Dict, List
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self.values.items())
+        for key, v in items:
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {v}")
+        return lines
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        # key -> [counts theo bucket..., sum, count]
+        self.values: Dict[tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0.0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                row[idx] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        for key, row in items:
+            cumulative = 0.0
+            for b, c in zip(self.buckets, row):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), key + (repr(b),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), key + ('+Inf',))} {row[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {row[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {row[-1]}")
+        return lines
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{n}="{v}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+STAGE_SECONDS = Histogram("ai_stage_duration_seconds", "Thời gian từng bước xử lý", ("operation", "stage"))
+REQUESTS_TOTAL = Counter("ai_requests_total", "Số request theo endpoint và kết quả", ("operation", "status"))
+CACHE_LOOKUPS = Counter("ai_cache_lookups_total", "Số lần tra cache theo kết quả hit/miss", ("cache", "result"))
+METRICS: List[Any] = [STAGE_SECONDS, REQUESTS_TOTAL, CACHE_LOOKUPS]
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # Tỉ lệ hit theo từng cache (suy ra từ counter để tiện đọc trực tiếp)
+    lines += ["# HELP ai_cache_hit_ratio Tỉ lệ hit của cache", "# TYPE ai_cache_hit_ratio gauge"]
+    totals: Dict[str, List[float]] = {}
+    for (cache, result), v in list(CACHE_LOOKUPS.values.items()):
+        t = totals.setdefault(cache, [0.0, 0.0])
+        t[0 if result == "hit" else 1] += v
+    for cache, (hits, misses) in totals.items():
+        ratio = hits / (hits + misses) if (hits + misses) else 0.0
+        lines.append(f"ai_cache_hit_ratio{format_labels(('cache',), (cache,))} {ratio}")
+    return "\n".join(lines) + "\n"
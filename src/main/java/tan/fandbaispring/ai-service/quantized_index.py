@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Compressed in-memory vector index for ai_service_gemini.py.
+
+With VECTOR_STORAGE_MODE=int8|binary (and/or VECTOR_DIMS > 0) the service
+answers nearest-neighbour queries from this index instead of Chroma's HNSW:
+vectors are reduced (Matryoshka prefix or PCA), quantized to uint8 codes or
+sign bits and scanned brute-force; the best rerank_pool candidates are then
+re-scored with exact float32 L2² read from a memmap, so distances stay on
+Chroma's scale. The index is rebuilt lazily from loader() after every write
+(invalidate()). evaluate_vector_storage.py measures recall and latency per
+configuration.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from tracing import stage_timer
+
+logger = logging.getLogger(__name__)
+
+# Lưu vector nén trong RAM (tuỳ chọn): "float" (mặc định, truy vấn HNSW của Chroma) | "int8" | "binary".
+# VECTOR_DIMS > 0 giảm số chiều trước khi nén: "truncate" = cắt tiền tố (Matryoshka), "pca" = chiếu PCA fit trên
+# catalogue. Ứng viên từ vector nén được xếp hạng lại bằng vector float32 đầy đủ (memmap trên đĩa).
+VECTOR_STORAGE_MODE = os.getenv("VECTOR_STORAGE_MODE", "float").strip().lower()
+VECTOR_DIMS = int(os.getenv("VECTOR_DIMS", "0"))
+VECTOR_REDUCTION = os.getenv("VECTOR_REDUCTION", "truncate").strip().lower()
+VECTOR_RERANK_POOL = int(os.getenv("VECTOR_RERANK_POOL", "50"))
+VECTOR_FLOAT_PATH = os.getenv("VECTOR_FLOAT_PATH", "./vector_float32.npy")
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class QuantizedIndex:
+    """Chỉ mục brute-force trên vector nén, dựng lại từ loader() (embeddings đã lưu trong Chroma).
+
+    Bước 1 chấm điểm xấp xỉ trên mã nén trong không gian đã giảm chiều (int8: L2 trên vector tái dựng,
+    binary: Hamming của bit dấu). Bước 2 tính lại L2² chính xác bằng vector float32 gốc cho `rerank_pool`
+    ứng viên, nên score cùng thang với distance của Chroma và hậu kiểm phía sau không đổi.
+    """
+
+    def __init__(self, mode: str, dims: int = 0, reduction: str = "truncate", rerank_pool: int = 50,
+                 float_path: Optional[str] = None, loader: Optional[Callable[[], tuple]] = None):
+        self.mode = mode
+        # loader() → (ids, vectors, metadatas) của toàn bộ catalogue; None thì chỉ dùng build() trực tiếp
+        self.loader = loader
+        self.dims = dims
+        self.reduction = reduction
+        self.rerank_pool = rerank_pool
+        self.float_path = float_path
+        self._lock = threading.Lock()
+        self._state: Dict[str, Any] = {"ids": [], "metas": []}
+        # Mỗi lần ghi Chroma tăng generation; chỉ mục cũ được dựng lại ở truy vấn kế tiếp
+        self._generation = 0
+        self._built_generation = -1
+        self.built_at: Optional[float] = None
+
+    def invalidate(self) -> None:
+        self._generation += 1
+
+    @staticmethod
+    def _project(state: Dict[str, Any], X: Any) -> Any:
+        if state.get("components") is not None:
+            return (X - state["mean"]) @ state["components"].T
+        Z = X[:, :state["dims"]]
+        if state["dims"] < X.shape[1]:
+            # Cắt Matryoshka: chuẩn hoá lại tiền tố để khoảng cách vẫn tương đương cosine
+            Z = Z / np.maximum(np.linalg.norm(Z, axis=1, keepdims=True), 1e-12)
+        return Z
+
+    def build(self, ids: List[str], vectors: Any, metadatas: List[Dict[str, Any]],
+              generation: Optional[int] = None) -> None:
+        X = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        full_dims = X.shape[1]
+        state: Dict[str, Any] = {
+            "ids": list(ids),
+            "metas": [m or {} for m in metadatas],
+            "dims": self.dims if 0 < self.dims < full_dims else full_dims,
+            "mean": None,
+            "components": None,
+        }
+        if self.reduction == "pca" and state["dims"] < full_dims and len(ids) > 1:
+            mean = X.mean(axis=0)
+            _, _, vt = np.linalg.svd(X - mean, full_matrices=False)
+            # PCA không giữ được nhiều thành phần hơn số mẫu
+            state["components"] = vt[:state["dims"]].astype(np.float32)
+            state["mean"] = mean
+            state["dims"] = state["components"].shape[0]
+        Z = self._project(state, X).astype(np.float32)
+        if self.mode == "int8":
+            lo = Z.min(axis=0)
+            scale = (Z.max(axis=0) - lo) / 255.0
+            scale[scale == 0] = 1.0
+            codes = np.rint((Z - lo) / scale).astype(np.uint8)
+            approx = codes.astype(np.float32) * scale + lo
+            state.update(codes=codes, lo=lo, scale=scale, norms=(approx ** 2).sum(axis=1))
+        elif self.mode == "binary":
+            state["codes"] = np.packbits(Z > 0, axis=1)
+        else:
+            state.update(codes=Z, norms=(Z ** 2).sum(axis=1))
+        # Vector float32 gốc chỉ dùng để xếp hạng lại: ghi ra đĩa và memmap thay vì giữ trong RAM.
+        # Ghi file tạm rồi os.replace để memmap của bản dựng trước vẫn đọc được đến khi bị thay.
+        if self.float_path:
+            tmp_path = f"{self.float_path}.tmp.npy"
+            np.save(tmp_path, X)
+            os.replace(tmp_path, self.float_path)
+            state["floats"] = np.load(self.float_path, mmap_mode="r")
+        else:
+            state["floats"] = X
+        self._state = state
+        self._built_generation = self._generation if generation is None else generation
+        self.built_at = time.time()
+
+    def ensure_built(self) -> None:
+        if self._built_generation == self._generation:
+            return
+        with self._lock:
+            generation = self._generation
+            if self._built_generation == generation:
+                return
+            if self.loader is None:
+                raise RuntimeError("Chỉ mục vector nén chưa có nguồn dữ liệu")
+            with stage_timer("vector_index", "rebuild"):
+                ids, vectors, metadatas = self.loader()
+                self.build(ids, vectors, metadatas, generation=generation)
+            logger.info("Quantized vector index rebuilt: %s", self.stats())
+
+    def search_many(self, vectors: List[List[float]], k: int) -> List[List[tuple]]:
+        """Trả về cho mỗi vector truy vấn danh sách (metadata, L2²) tăng dần, tối đa k phần tử."""
+        self.ensure_built()
+        state = self._state
+        n = len(state["ids"])
+        if n == 0:
+            return [[] for _ in vectors]
+        Q = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        Zq = self._project(state, Q).astype(np.float32)
+        if self.mode == "int8":
+            # ||q - x̂||² bỏ hằng số ||q||²; x̂ = codes*scale + lo
+            approx = state["norms"][None, :] - 2.0 * ((Zq * state["scale"]) @ state["codes"].T.astype(np.float32)
+                                                      + (Zq @ state["lo"])[:, None])
+        elif self.mode == "binary":
+            bits = np.packbits(Zq > 0, axis=1)
+            approx = _POPCOUNT[np.bitwise_xor(bits[:, None, :], state["codes"][None, :, :])].sum(axis=2)
+        else:
+            approx = state["norms"][None, :] - 2.0 * (Zq @ state["codes"].T)
+        pool = min(n, max(k, self.rerank_pool))
+        out: List[List[tuple]] = []
+        for qi in range(len(Q)):
+            cand = np.argpartition(approx[qi], pool - 1)[:pool] if pool < n else np.arange(n)
+            cand.sort()  # đọc memmap theo thứ tự trên đĩa
+            dist = ((np.asarray(state["floats"][cand]) - Q[qi]) ** 2).sum(axis=1)
+            order = np.argsort(dist)[:k]
+            out.append([(state["metas"][cand[j]], float(dist[j])) for j in order])
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state
+        codes = state.get("codes")
+        n = len(state["ids"])
+        full_dims = state["floats"].shape[1] if state.get("floats") is not None else 0
+        resident = sum(a.nbytes for a in (codes, state.get("norms"), state.get("lo"), state.get("scale"),
+                                          state.get("mean"), state.get("components")) if a is not None)
+        return {
+            "mode": self.mode,
+            "dims": state.get("dims"),
+            "reduction": "pca" if state.get("components") is not None else (
+                "truncate" if state.get("dims") and state["dims"] < full_dims else "none"),
+            "count": n,
+            "bytes_per_vector": int(codes.nbytes / n) if codes is not None and n else 0,
+            "resident_bytes": int(resident),
+            "float32_bytes": int(n * full_dims * 4),
+            "stale": self._built_generation != self._generation,
+            "built_at": datetime.fromtimestamp(self.built_at, tz=timezone.utc).isoformat() if self.built_at else None,
+        }
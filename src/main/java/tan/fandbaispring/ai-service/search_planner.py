@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Query planner for /rag-search in ai_service_gemini.py.
+
+Two plans answer the same search. Vector-first asks the ANN index for the
+SEARCH_K nearest chunks and post-filters them by city/type; when the filter
+is selective that leaves too few hits. SQL-first asks Postgres for every
+establishment matching city/type and scores only their chunks exactly. Both
+then apply the same availability check, so they differ in cost, not in
+which establishments qualify.
+
+CatalogStats keeps per-(city, type) counts from the index metadata so
+choose_search_plan() can estimate selectivity without touching Postgres.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import METRICS, Counter
+
+logger = logging.getLogger(__name__)
+
+# "auto" ước lượng độ chọn lọc từ số cơ sở theo (city, type) trong index; "vector"/"sql" ép một kế hoạch
+SEARCH_PLANNER_MODE = os.getenv("SEARCH_PLANNER_MODE", "auto").strip().lower()
+# SQL trước chỉ khi số cơ sở hợp lệ không quá ngưỡng này (mỗi chunk của chúng được chấm điểm chính xác)
+PLANNER_SQL_MAX_IDS = int(os.getenv("PLANNER_SQL_MAX_IDS", "200"))
+PLANNER_STATS_TTL_S = float(os.getenv("PLANNER_STATS_TTL_S", "300"))
+# Truy vấn SQL trước lỗi (DB không kết nối được) → chỉ dùng vector trước trong khoảng này rồi mới thử lại
+PLANNER_SQL_COOLDOWN_S = float(os.getenv("PLANNER_SQL_COOLDOWN_S", "30"))
+# finalize_search trả 3 kết quả: vector trước dự kiến giữ lại ít hơn số này sau hậu kiểm → thiếu kết quả
+PLANNER_MIN_EXPECTED_HITS = 3
+
+SEARCH_PLANS = Counter("ai_search_plans_total", "Số lần tìm kiếm theo kế hoạch truy vấn đã chạy", ("plan", "reason"))
+METRICS.append(SEARCH_PLANS)
+
+
+class CatalogStats:
+    """Số cơ sở/chunk theo (city không dấu, TYPE) đọc từ metadata Chroma, cache theo TTL cho planner.
+
+    Dựng lại lười khi hết hạn hoặc sau on_index_changed(); chỉ đọc metadata, không đọc embeddings.
+    """
+
+    def __init__(self, ttl_s: float, sql_cooldown_s: float, load_metadatas: Callable[[], List[Dict[str, Any]]],
+                 city_key: Callable[[str], str], city_sharded: Callable[[str], bool] = lambda city_norm: False):
+        self.ttl_s = ttl_s
+        self.sql_cooldown_s = sql_cooldown_s
+        # load_metadatas() → metadata mọi document trong index; city_key = chuẩn hoá city giống prepare_search;
+        # city_sharded(city_norm) → vector trước chỉ tìm trong shard của city đó
+        self._load_metadatas = load_metadatas
+        self._city_key = city_key
+        self._city_sharded = city_sharded
+        self._lock = threading.Lock()
+        self._built_at = 0.0
+        self._sql_failed_at = 0.0
+        self._ids: Dict[tuple, int] = {}
+        self._chunks: Dict[tuple, int] = {}
+        # city không dấu → các cách viết gốc (để lọc cột establishment.city trong SQL)
+        self._spellings: Dict[str, set] = {}
+        self._total_chunks = 0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built_at = 0.0
+
+    def mark_sql_failed(self) -> None:
+        self._sql_failed_at = time.time()
+
+    def sql_available(self) -> bool:
+        return time.time() - self._sql_failed_at >= self.sql_cooldown_s
+
+    def _ensure_built(self) -> None:
+        with self._lock:
+            if self._built_at and time.time() - self._built_at <= self.ttl_s:
+                return
+            metas = self._load_metadatas()
+            ids: Dict[tuple, set] = {}
+            chunks: Dict[tuple, int] = {}
+            spellings: Dict[str, set] = {}
+            for meta in metas:
+                meta = meta or {}
+                city = str(meta.get("city") or "")
+                key = (self._city_key(city), str(meta.get("type") or "").strip().upper())
+                ids.setdefault(key, set()).add(meta.get("id"))
+                chunks[key] = chunks.get(key, 0) + 1
+                if city:
+                    spellings.setdefault(key[0], set()).add(city)
+            self._ids = {k: len(v) for k, v in ids.items()}
+            self._chunks = chunks
+            self._spellings = spellings
+            self._total_chunks = len(metas)
+            self._built_at = time.time()
+
+    def estimate(self, city_norm: Optional[str], est_type: Optional[str]) -> Dict[str, Any]:
+        """{"ids", "chunks": khớp city/type; "scope_chunks": số chunk vector trước phải tìm trong đó}."""
+        self._ensure_built()
+        want_type = str(est_type or "").strip().upper()
+        ids = chunks = city_chunks = 0
+        for key, n in self._chunks.items():
+            if city_norm and key[0] != city_norm:
+                continue
+            city_chunks += n
+            if want_type and key[1] != want_type:
+                continue
+            ids += self._ids[key]
+            chunks += n
+        sharded = bool(city_norm) and self._city_sharded(city_norm)
+        return {"ids": ids, "chunks": chunks, "scope_chunks": city_chunks if sharded else self._total_chunks}
+
+    def spellings(self, city_norm: str) -> List[str]:
+        self._ensure_built()
+        return sorted(self._spellings.get(city_norm, ()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._chunks),
+            "chunks": self._total_chunks,
+            "built_at": datetime.fromtimestamp(self._built_at, tz=timezone.utc).isoformat() if self._built_at else None,
+            "sql_available": self.sql_available(),
+        }
+
+
+def choose_search_plan(plan: Dict[str, Any], catalog_stats: CatalogStats, search_k: int,
+                       mode: str = SEARCH_PLANNER_MODE) -> Tuple[str, str]:
+    """("vector" | "sql", lý do) cho một kế hoạch tìm kiếm đã chuẩn hoá; search_k = số ứng viên của vector trước."""
+    if mode == "vector":
+        return "vector", "forced"
+    if not catalog_stats.sql_available():
+        # Lần SQL trước vừa lỗi: không trả giá kết nối hỏng cho mỗi request
+        return "vector", "sql_cooldown"
+    if mode == "sql":
+        return "sql", "forced"
+    if not plan["city_norm"] and not plan["est_type"]:
+        return "vector", "unconstrained"
+    try:
+        est = catalog_stats.estimate(plan["city_norm"], plan["est_type"])
+    except Exception as e:
+        logger.warning("Catalog stats unavailable: %s", getattr(e, 'message', str(e)))
+        return "vector", "no_stats"
+    if est["ids"] == 0:
+        # Thống kê chưa thấy city/type này: giữ đường cũ
+        return "vector", "no_estimate"
+    if est["ids"] > PLANNER_SQL_MAX_IDS:
+        return "vector", "broad"
+    if est["chunks"] <= search_k:
+        # Chấm điểm chính xác ít vector hơn k ứng viên ANN
+        return "sql", "cheaper"
+    # Số ứng viên của k láng giềng gần nhất dự kiến qua được hậu kiểm city/type
+    if search_k * est["chunks"] / max(1, est["scope_chunks"]) < PLANNER_MIN_EXPECTED_HITS:
+        return "sql", "low_recall"
+    return "vector", "selective_enough"
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Single-flight call coalescing for ai_service_gemini.py.
+
+Identical calls that are in flight at the same time (the same quiz turn sent
+twice, the same establishment fetched by several index paths, the same query
+embedded by concurrent searches) share one execution: the first caller runs
+it, the others wait for its result. It is not a cache: the key is released
+as soon as the call finishes.
+
+Quick check:
+    python single_flight.py
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict
+
+from deadlines import request_budget
+from metrics import METRICS, Counter
+
+COALESCED_CALLS = Counter("ai_coalesced_calls_total", "Lời gọi trùng khóa đang chạy: leader thực thi, follower dùng chung kết quả",
+                          ("flight", "role"))
+METRICS.append(COALESCED_CALLS)
+
+
+class SingleFlight:
+    """Gộp các lời gọi cùng khóa đang chạy đồng thời: lời gọi đầu (leader) thực thi, các lời gọi sau (follower)
+    chờ và nhận cùng kết quả/ngoại lệ. Không phải cache: xong là khóa được giải phóng.
+
+    copy_result=True: mỗi bên nhận một bản sao sâu (kết quả là dict mà caller sẽ sửa tiếp).
+
+    Cố ý không huỷ theo ngân sách: lời gọi dùng chung chạy tới khi xong (giới hạn bởi timeout của provider/DB)
+    kể cả khi leader đã hết hạn hay ngắt kết nối, vì huỷ theo deadline của một bên sẽ làm hỏng kết quả của các
+    bên còn chờ. Mỗi bên chỉ tự thôi chờ trong ngân sách của mình (await_within_budget).
+    """
+
+    def __init__(self, name: str, copy_result: bool = False):
+        self.name = name
+        self.copy_result = copy_result
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+        COALESCED_CALLS.inc(flight=self.name, role="leader" if leader else "follower")
+        return fut, leader
+
+    def _run(self, key: str, fut: Future, fn) -> None:
+        # Việc dùng chung không bị huỷ theo deadline của riêng leader; mỗi bên chỉ tự thôi chờ
+        token = request_budget.set(None)
+        try:
+            value, error = fn(), None
+        except BaseException as e:
+            value, error = None, e
+        finally:
+            request_budget.reset(token)
+        # Bỏ khóa trước khi trả kết quả: lời gọi đến sau đó sẽ chạy mới, không nhận kết quả đã xong
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(value)
+
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def _value(self, fut: Future) -> Any:
+        value = fut.result()
+        return copy.deepcopy(value) if self.copy_result else value
+
+    def do(self, key: str, fn) -> Any:
+        fut, leader = self._join(key)
+        if leader:
+            self._run(key, fut, fn)
+        return self._value(fut)
+
+    async def do_async(self, key: str, fn) -> Any:
+        """Như do() nhưng fn (đồng bộ, chặn) chạy trong thread để event loop phục vụ được các request khác."""
+        fut, leader = self._join(key)
+        if leader:
+            await asyncio.to_thread(self._run, key, fut, fn)
+        else:
+            # shield: follower bị huỷ không được huỷ Future dùng chung của các bên khác
+            await asyncio.shield(asyncio.wrap_future(fut))
+        return self._value(fut)
+
+
+def flight_key(*parts: Any) -> str:
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+    flight = SingleFlight("demo")
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: flight.do("key", work), range(8)))
+    print(f"✈️  8 callers → {len(calls)} execution(s), results={set(results)}")
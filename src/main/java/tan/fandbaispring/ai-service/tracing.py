@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Request tracing for ai_service_gemini.py.
+
+Every request gets a request id (taken from X-Request-ID when Spring sends
+one) and a RequestTrace; stage_timer() records one span per processing step
+next to the per-stage latency histogram in metrics.py. Requests slower than
+SLOW_REQUEST_MS are written as one JSON line to TRACE_JSONL_PATH and, when
+OTLP_TRACES_ENDPOINT is set, posted in the background as OTLP/HTTP JSON.
+"""
+
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import requests
+from fastapi.responses import StreamingResponse
+
+from metrics import REQUESTS_TOTAL, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = os.getenv("REQUEST_ID_HEADER", "X-Request-ID")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "./slow_requests.jsonl")
+# Ví dụ collector cục bộ: http://localhost:4318/v1/traces (OTLP/HTTP JSON); để trống thì không gửi
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "")
+
+current_trace: contextvars.ContextVar[Optional["RequestTrace"]] = contextvars.ContextVar("current_trace", default=None)
+_current_span_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_span_id", default=None)
+_trace_export_lock = threading.Lock()
+
+
+class RequestTrace:
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        # trace id 32-hex suy ra từ request id để dễ đối chiếu giữa Spring và collector
+        self.trace_id = hashlib.md5(request_id.encode("utf-8")).hexdigest()
+        self.root_span_id = uuid.uuid4().hex[:16]
+        self.method, self.path = method, path
+        self.start_ns = time.time_ns()
+        self.spans: List[Dict[str, Any]] = []
+
+    def to_record(self, status_code: int, duration_ms: float) -> Dict[str, Any]:
+        return {
+            "ts": datetime.fromtimestamp(self.start_ns / 1e9, tz=timezone.utc).isoformat(),
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "duration_ms": round(duration_ms, 2),
+            "spans": [
+                {k: v for k, v in sp.items() if k not in ("start_ns", "end_ns")}
+                for sp in self.spans
+            ],
+        }
+
+
+def begin_span(operation: str, stage: str) -> Optional[Dict[str, Any]]:
+    trace = current_trace.get()
+    if trace is None:
+        return None
+    span = {
+        "name": f"{operation}.{stage}",
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": _current_span_id.get() or trace.root_span_id,
+        "start_ns": time.time_ns(),
+    }
+    span["_token"] = _current_span_id.set(span["span_id"])
+    return span
+
+
+def end_span(span: Optional[Dict[str, Any]], elapsed: float, status: str) -> None:
+    if span is None:
+        return
+    try:
+        _current_span_id.reset(span.pop("_token"))
+    except Exception:
+        pass
+    span["end_ns"] = span["start_ns"] + int(elapsed * 1e9)
+    span["duration_ms"] = round(elapsed * 1000, 2)
+    span["status"] = status
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append(span)
+
+
+def _to_otlp(trace: RequestTrace, status_code: int, end_ns: int) -> Dict[str, Any]:
+    def attr(k: str, v: Any) -> Dict[str, Any]:
+        if isinstance(v, int):
+            return {"key": k, "value": {"intValue": str(v)}}
+        return {"key": k, "value": {"stringValue": str(v)}}
+    spans = [{
+        "traceId": trace.trace_id, "spanId": trace.root_span_id,
+        "name": f"{trace.method} {trace.path}", "kind": 2,
+        "startTimeUnixNano": str(trace.start_ns), "endTimeUnixNano": str(end_ns),
+        "attributes": [attr("request_id", trace.request_id), attr("http.status_code", status_code)],
+    }]
+    for sp in trace.spans:
+        spans.append({
+            "traceId": trace.trace_id, "spanId": sp["span_id"], "parentSpanId": sp["parent_id"],
+            "name": sp["name"], "kind": 1,
+            "startTimeUnixNano": str(sp["start_ns"]), "endTimeUnixNano": str(sp["end_ns"]),
+            "attributes": [attr("status", sp["status"])],
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [attr("service.name", "fast-planner-ai-gemini")]},
+        "scopeSpans": [{"scope": {"name": "ai_service_gemini"}, "spans": spans}],
+    }]}
+
+
+def export_slow_trace(trace: RequestTrace, status_code: int) -> None:
+    end_ns = time.time_ns()
+    duration_ms = (end_ns - trace.start_ns) / 1e6
+    if duration_ms < SLOW_REQUEST_MS:
+        return
+    record = trace.to_record(status_code, duration_ms)
+    logger.warning("Slow request %s %s %.0fms request_id=%s spans=%s", trace.method, trace.path,
+                   duration_ms, trace.request_id,
+                   ", ".join(f"{sp['name']}={sp['duration_ms']}ms" for sp in record["spans"]))
+    if TRACE_JSONL_PATH:
+        try:
+            with _trace_export_lock, open(TRACE_JSONL_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning("Cannot write slow-request log: %s", e)
+    if OTLP_TRACES_ENDPOINT:
+        payload = _to_otlp(trace, status_code, end_ns)
+
+        def _send():
+            try:
+                requests.post(OTLP_TRACES_ENDPOINT, json=payload, timeout=2)
+            except Exception as e:
+                logger.warning("OTLP export failed: %s", e)
+        # Gửi nền để không kéo dài thời gian phản hồi
+        threading.Thread(target=_send, daemon=True).start()
+
+
+@contextmanager
+def stage_timer(operation: str, stage: str):
+    """Đo thời gian một bước (metrics + span của request hiện tại); stage 'total' đồng thời đếm request ok/error."""
+    t0 = time.perf_counter()
+    span = begin_span(operation, stage)
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = str(getattr(e, "status_code", "error"))
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.observe(elapsed, operation=operation, stage=stage)
+        end_span(span, elapsed, status)
+        if stage == "total":
+            REQUESTS_TOTAL.inc(operation=operation, status=status)
+
+
+async def _timed_body(body, stack: ExitStack):
+    with stack:
+        async for chunk in body:
+            yield chunk
+
+
+def timed_operation(operation: str):
+    """Decorator cho endpoint async: đo tổng thời gian + đếm request (StreamingResponse: tới khi stream xong)."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with ExitStack() as stack:
+                stack.enter_context(stage_timer(operation, "total"))
+                response = await fn(*args, **kwargs)
+                if isinstance(response, StreamingResponse):
+                    response.body_iterator = _timed_body(response.body_iterator, stack.pop_all())
+            return response
+        return wrapper
+    return deco
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Vietnamese place gazetteer used for city inference in ai_service_gemini.py.
+
+PROVINCES mirrors frontend/partner-portal/src/constants/vnProvinces.ts;
+TOURIST_TOWNS adds the destinations travellers name directly (Phú Quốc,
+Hạ Long, Sa Pa, ...), which are what establishments store as their city.
+Every name and alias is accent-folded and compiled into one trie, so
+PlaceMatcher.find() resolves a prompt by walking the trie from each word
+start instead of testing every alias against the whole text.
+
+Quick check:
+    python vn_gazetteer.py "Đi Phú Quốc 3 đêm, cần hồ bơi"
+"""
+
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+# Tỉnh/thành (63) — giữ cùng thứ tự với vnProvinces.ts ("Bình Liêu" ở frontend là huyện, không đưa vào)
+PROVINCES = [
+    "An Giang", "Bà Rịa - Vũng Tàu", "Bắc Giang", "Bắc Kạn", "Bạc Liêu", "Bắc Ninh", "Bến Tre",
+    "Bình Định", "Bình Dương", "Bình Phước", "Bình Thuận", "Cà Mau", "Cần Thơ", "Cao Bằng", "Đà Nẵng",
+    "Đắk Lắk", "Đắk Nông", "Điện Biên", "Đồng Nai", "Đồng Tháp", "Gia Lai", "Hà Giang", "Hà Nam",
+    "Hà Nội", "Hà Tĩnh", "Hải Dương", "Hải Phòng", "Hậu Giang", "Hòa Bình", "Hưng Yên", "Khánh Hòa",
+    "Kiên Giang", "Kon Tum", "Lai Châu", "Lâm Đồng", "Lạng Sơn", "Lào Cai", "Long An", "Nam Định",
+    "Nghệ An", "Ninh Bình", "Ninh Thuận", "Phú Thọ", "Phú Yên", "Quảng Bình", "Quảng Nam", "Quảng Ngãi",
+    "Quảng Ninh", "Quảng Trị", "Sóc Trăng", "Sơn La", "Tây Ninh", "Thái Bình", "Thái Nguyên", "Thanh Hóa",
+    "Thừa Thiên Huế", "Tiền Giang", "Hồ Chí Minh", "Trà Vinh", "Tuyên Quang", "Vĩnh Long", "Vĩnh Phúc", "Yên Bái",
+]
+
+# Điểm du lịch cấp thành phố/thị xã/đảo
+TOURIST_TOWNS = [
+    "Nha Trang", "Đà Lạt", "Huế", "Hội An", "Phú Quốc", "Hạ Long", "Vũng Tàu", "Sa Pa", "Mũi Né",
+    "Phan Thiết", "Quy Nhơn", "Côn Đảo", "Cát Bà", "Tam Đảo", "Mộc Châu", "Mai Châu", "Phong Nha",
+    "Tuy Hòa", "Buôn Ma Thuột", "Pleiku", "Cam Ranh", "Châu Đốc", "Hà Tiên", "Tam Cốc", "Cửa Lò",
+    "Sầm Sơn", "Đồng Văn", "Lý Sơn",
+]
+
+# Cách viết khác (đã bỏ dấu) → tên hiển thị
+EXTRA_ALIASES = {
+    "dn": "Đà Nẵng",
+    "hn": "Hà Nội",
+    "tp ho chi minh": "Hồ Chí Minh",
+    "thanh pho ho chi minh": "Hồ Chí Minh",
+    "tphcm": "Hồ Chí Minh",
+    "hcm": "Hồ Chí Minh",
+    "sai gon": "Hồ Chí Minh",
+    "saigon": "Hồ Chí Minh",
+    "vinh ha long": "Hạ Long",
+    "phong nha ke bang": "Phong Nha",
+    "buon me thuot": "Buôn Ma Thuột",
+    "bmt": "Buôn Ma Thuột",
+    "dak lak": "Đắk Lắk",
+    "daklak": "Đắk Lắk",
+    "dak nong": "Đắk Nông",
+    "brvt": "Bà Rịa - Vũng Tàu",
+    "hue city": "Huế",
+}
+
+# Tên trùng với từ thông dụng khi bỏ dấu ("hai phòng" = 2 phòng, "lòng an...") → chỉ khớp khi viết đúng dấu,
+# trừ khi viết hẳn không dấu và đứng một mình hoặc ngay sau "đi"/"ở"/"tại" ("hoi an", "di hai phong")
+ACCENT_SENSITIVE = {"Hải Phòng", "Long An", "Hội An"}
+PLAIN_PLACE_LEADS = {"di", "o", "tai"}
+
+
+def fold(text: Optional[str]) -> str:
+    """Chữ thường, bỏ dấu (kể cả đ → d), giữ nguyên độ dài để vị trí khớp trỏ về văn bản gốc."""
+    out = []
+    for ch in unicodedata.normalize("NFC", text or "").lower():
+        base = unicodedata.normalize("NFD", ch)[0]
+        out.append("d" if base == "đ" else base)
+    return "".join(out)
+
+
+def slug(name: str) -> str:
+    """Khóa canonical: "Hồ Chí Minh" → "hochiminh"."""
+    return "".join(ch for ch in fold(name) if ch.isalnum())
+
+
+def alias_key(text: str) -> str:
+    # Gom mọi dấu câu/khoảng trắng liên tiếp thành một khoảng trắng
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in fold(text)).split())
+
+
+_END = "$"
+
+
+class PlaceMatcher:
+    """Trie ký tự trên tên/alias đã bỏ dấu; dấu câu và khoảng trắng liên tiếp khớp một cạnh " "."""
+
+    def __init__(self, aliases: Dict[str, str], accent_sensitive: Optional[Dict[str, str]] = None):
+        self._root: Dict[str, dict] = {}
+        # alias → tên có dấu (chữ thường) bắt buộc phải xuất hiện đúng trong văn bản gốc
+        self._accented = accent_sensitive or {}
+        for alias, canonical in aliases.items():
+            node = self._root
+            for ch in alias:
+                node = node.setdefault(ch, {})
+            node[_END] = (alias, canonical)
+
+    def _walk(self, folded: str, start: int) -> Optional[Tuple[int, str, str]]:
+        node, i, n, best = self._root, start, len(folded), None
+        while i < n:
+            ch = folded[i]
+            if not ch.isalnum():
+                node = node.get(" ")
+                if node is None:
+                    break
+                while i < n and not folded[i].isalnum():
+                    i += 1
+                continue
+            node = node.get(ch)
+            if node is None:
+                break
+            i += 1
+            if _END in node and (i == n or not folded[i].isalnum()):
+                best = (i,) + node[_END]
+        return best
+
+    @staticmethod
+    def _plain_place(original: str, folded: str, start: int, end: int) -> bool:
+        """Tên viết hoàn toàn không dấu: nhận khi là cả câu hỏi hoặc đứng ngay sau "đi"/"ở"/"tại"."""
+        if original[start:end] != folded[start:end]:
+            return False
+        before, after = alias_key(folded[:start]), alias_key(folded[end:])
+        if not before and not after:
+            return True
+        return bool(before) and before.split()[-1] in PLAIN_PLACE_LEADS
+
+    def find_all(self, text: Optional[str]) -> List[Tuple[int, int, str]]:
+        """Mọi địa danh khớp trọn từ: [(start, end, canonical)], mỗi vị trí bắt đầu lấy alias dài nhất."""
+        original = unicodedata.normalize("NFC", text or "").lower()
+        folded = fold(original)
+        found = []
+        for start, ch in enumerate(folded):
+            if not ch.isalnum() or (start > 0 and folded[start - 1].isalnum()):
+                continue
+            hit = self._walk(folded, start)
+            if hit is None:
+                continue
+            end, alias, canonical = hit
+            accented = self._accented.get(alias)
+            if accented is not None and original[start:end] != accented \
+                    and not self._plain_place(original, folded, start, end):
+                continue
+            found.append((start, end, canonical))
+        return found
+
+    def find(self, text: Optional[str]) -> Optional[str]:
+        """Địa danh dài nhất trong văn bản (bằng nhau thì lấy cái xuất hiện trước); None nếu không có."""
+        hits = self.find_all(text)
+        if not hits:
+            return None
+        return max(hits, key=lambda h: (h[1] - h[0], -h[0]))[2]
+
+
+def build_gazetteer() -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
+    """(canonical → tên hiển thị, alias bỏ dấu → canonical, alias → tên có dấu cần khớp đúng)."""
+    display: Dict[str, str] = {}
+    aliases: Dict[str, str] = {}
+    accented: Dict[str, str] = {}
+    for name in PROVINCES + TOURIST_TOWNS:
+        key = slug(name)
+        display.setdefault(key, name)
+        aliases[alias_key(name)] = key
+        aliases.setdefault(key, key)  # "danang", "phuquoc" viết liền
+        if name in ACCENT_SENSITIVE:
+            accented[alias_key(name)] = unicodedata.normalize("NFC", name).lower()
+    for alias, name in EXTRA_ALIASES.items():
+        aliases[alias_key(alias)] = slug(name)
+    return display, aliases, accented
+
+
+if __name__ == "__main__":
+    import sys
+
+    display, aliases, accented = build_gazetteer()
+    matcher = PlaceMatcher(aliases, accented)
+    print(f"📍 {len(display)} places, {len(aliases)} aliases")
+    for arg in sys.argv[1:]:
+        canonical = matcher.find(arg)
+        print(f"   {arg!r} → {display.get(canonical) if canonical else None}")
@@ -2,7 +2,10 @@ package tan.fandbaispring.service;
 
 import org.springframework.beans.factory.annotation.Value;
 import org.springframework.core.ParameterizedTypeReference;
+import org.springframework.http.HttpEntity;
+import org.springframework.http.HttpHeaders;
 import org.springframework.http.HttpMethod;
+import org.springframework.http.MediaType;
 import org.springframework.http.ResponseEntity;
 import org.springframework.stereotype.Service;
 import org.springframework.web.client.RestTemplate;
@@ -25,20 +28,40 @@ public class AiService {
 
     // RestTemplate với timeout để tránh chờ quá lâu nếu Python service treo
     private final RestTemplate restTemplate;
+    private static final int READ_TIMEOUT_MS = 3000;
+    // Báo cho Python ngân sách thời gian (trừ hao mạng) để nó dừng xử lý khi phía này đã bỏ cuộc
+    private static final String DEADLINE_HEADER = "X-Request-Timeout-Ms";
+    private static final int DEADLINE_MARGIN_MS = 200;
 
     public AiService() {
         org.springframework.http.client.SimpleClientHttpRequestFactory f = new org.springframework.http.client.SimpleClientHttpRequestFactory();
         f.setConnectTimeout(3000); // 3s
-        f.setReadTimeout(3000);    // 3s
+        f.setReadTimeout(READ_TIMEOUT_MS);    // 3s
         this.restTemplate = new RestTemplate(f);
     }
 
-    // --- Simple in-memory cache for RAG results (TTL 5 minutes) ---
+    private static <T> HttpEntity<T> withDeadline(T body) {
+        return withDeadline(body, null);
+    }
+
+    private static <T> HttpEntity<T> withDeadline(T body, String ifNoneMatch) {
+        HttpHeaders headers = new HttpHeaders();
+        headers.setContentType(MediaType.APPLICATION_JSON);
+        headers.set(DEADLINE_HEADER, String.valueOf(READ_TIMEOUT_MS - DEADLINE_MARGIN_MS));
+        if (ifNoneMatch != null) {
+            headers.setIfNoneMatch(ifNoneMatch);
+        }
+        return new HttpEntity<>(body, headers);
+    }
+
+    // --- In-memory cache for RAG results ---
+    // Có ETag (gắn với epoch index bên Python): luôn hỏi lại bằng If-None-Match, 304 → dùng bản cache.
+    // Không có ETag (kết quả một phần / Python cũ): TTL 5 phút như trước; TTL cũng là hạn dùng bản cache khi Python lỗi.
     private static final java.util.concurrent.ConcurrentHashMap<String, CacheEntry> RAG_CACHE = new java.util.concurrent.ConcurrentHashMap<>();
     private static final long RAG_TTL_MS = 5 * 60 * 1000L;
     private static class CacheEntry {
-        final List<SearchResultDTO> data; final long ts;
-        CacheEntry(List<SearchResultDTO> d, long t) { this.data = d; this.ts = t; }
+        final List<SearchResultDTO> data; final long ts; final String etag;
+        CacheEntry(List<SearchResultDTO> d, long t, String e) { this.data = d; this.ts = t; this.etag = e; }
     }
 
     /**
@@ -50,7 +73,7 @@ public class AiService {
         String url = pythonAiServiceUrl + "/generate-quiz";
         try {
             // Gọi Python service bình thường
-            return restTemplate.postForObject(url, request, QuizResponseDTO.class);
+            return restTemplate.postForObject(url, withDeadline(request), QuizResponseDTO.class);
         } catch (Exception ex) {
             // Fallback nội bộ khi Python trả 5xx hoặc không khả dụng
             QuizResponseDTO fallback = new QuizResponseDTO();
@@ -144,7 +167,7 @@ public class AiService {
         }
         long now = System.currentTimeMillis();
         CacheEntry ce = RAG_CACHE.get(key);
-        if (ce != null && (now - ce.ts) < RAG_TTL_MS) {
+        if (ce != null && ce.etag == null && (now - ce.ts) < RAG_TTL_MS) {
             return ce.data;
         }
 
@@ -153,15 +176,23 @@ public class AiService {
             ResponseEntity<List<SearchResultDTO>> response = restTemplate.exchange(
                     url,
                     HttpMethod.POST,
-                    new org.springframework.http.HttpEntity<>(request),
+                    withDeadline(request, ce != null ? ce.etag : null),
                     new ParameterizedTypeReference<List<SearchResultDTO>>() {}
             );
 
+            if (response.getStatusCode().value() == 304 && ce != null) {
+                // Index chưa đổi kể từ lần trước → dùng lại kết quả đã cache
+                RAG_CACHE.put(key, new CacheEntry(ce.data, System.currentTimeMillis(), ce.etag));
+                return ce.data;
+            }
             List<SearchResultDTO> out = response.getBody() != null ? response.getBody() : Collections.emptyList();
-            RAG_CACHE.put(key, new CacheEntry(out, System.currentTimeMillis()));
+            RAG_CACHE.put(key, new CacheEntry(out, System.currentTimeMillis(), response.getHeaders().getETag()));
             return out;
         } catch (Exception ex) {
-            // Timeout hoặc lỗi mạng → trả rỗng để controller fallback sang tìm kiếm nội bộ
+            // Timeout hoặc lỗi mạng → dùng bản cache còn hạn, nếu không trả rỗng để controller fallback sang tìm kiếm nội bộ
+            if (ce != null && (System.currentTimeMillis() - ce.ts) < RAG_TTL_MS) {
+                return ce.data;
+            }
             return Collections.emptyList();
         }
     }
@@ -0,0 +1,44 @@
+import pytest
+
+from amenity_vocab import AMENITIES, AmenityVocabulary
+
+
+@pytest.fixture(scope="module")
+def vocab():
+    return AmenityVocabulary()
+
+
+def test_bits_follow_amenities_order(vocab):
+    # Bit được lưu trong metadata Chroma: thứ tự AMENITIES không được đổi
+    assert [vocab.bit[a[0]] for a in AMENITIES] == [1 << i for i in range(len(AMENITIES))]
+
+
+def test_synonyms_map_to_same_amenity(vocab):
+    assert vocab.mask("có bể bơi") == vocab.mask("Hồ bơi") == vocab.mask("infinity pool") == vocab.bit["pool"]
+    assert vocab.mask("điều hoà") == vocab.bit["air_conditioning"]
+
+
+def test_mask_of_free_text_and_names(vocab):
+    mask = vocab.mask("có bể bơi, điều hoà và đưa đón sân bay")
+    assert vocab.names(mask) == ["Máy lạnh", "Hồ bơi", "Đưa đón sân bay"]
+    assert vocab.mask("") == vocab.mask(None) == 0
+
+
+def test_parse_splits_known_and_unknown_terms(vocab):
+    mask, unknown = vocab.parse(["Wifi", "phòng gym", " karaoke ", ""])
+    assert mask == vocab.bit["wifi"] | vocab.bit["gym"]
+    assert unknown == ["karaoke"]
+
+
+def test_service_amenity_mask_prefers_stored_mask(ai_service):
+    pool = ai_service.amenity_mask("Hồ bơi")
+    assert pool == ai_service.AMENITY_VOCAB.bit["pool"]
+    assert ai_service.meta_amenity_mask({"amenity_mask": 0, "amenities_list": "Hồ bơi"}) == 0
+    # Document index trước khi có amenity_mask: tính từ amenities_list
+    assert ai_service.meta_amenity_mask({"amenities_list": "Wifi, Hồ bơi"}) == pool | ai_service.amenity_mask("Wifi")
+
+
+def test_service_place_matching_folds_d_without_changing_strip_accents(ai_service):
+    assert ai_service.strip_accents("Đà Nẵng") == "đa nang"
+    assert ai_service.city_shard("Đà Nẵng") == ai_service.city_shard("da nang") == "danang"
+    assert ai_service.deterministic_extract("đi cùng gia đình") == {"travel_companion": "family"}
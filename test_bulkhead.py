@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+import bulkheads
+
+
+def test_zero_limit_disables_bulkhead():
+    bulkhead = bulkheads.Bulkhead("test", limit=0)
+    with bulkhead.slot(), bulkhead.slot():
+        assert bulkhead.stats()["active"] == 0
+
+
+def test_full_queue_is_shed():
+    bulkhead = bulkheads.Bulkhead("test", limit=1, queue_max=0, wait_s=1.0)
+    with bulkhead.slot():
+        with pytest.raises(bulkheads.Overloaded) as exc:
+            bulkhead.acquire()
+    assert exc.value.reason == "queue_full"
+    assert exc.value.status_code == 503
+    assert bulkhead.stats()["active"] == 0
+
+
+def test_wait_timeout_is_shed_and_leaves_queue():
+    bulkhead = bulkheads.Bulkhead("test", limit=1, queue_max=4, wait_s=0.05)
+    with bulkhead.slot():
+        with pytest.raises(bulkheads.Overloaded) as exc:
+            bulkhead.acquire()
+    assert exc.value.reason == "wait_timeout"
+    assert bulkhead.stats()["waiting"] == 0
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    bulkhead = bulkheads.Bulkhead("test", limit=1, queue_max=8, wait_s=5.0)
+    order = []
+
+    def waiter(name, priority):
+        bulkheads.request_priority.set(priority)
+        with bulkhead.slot():
+            order.append(name)
+
+    bulkhead.acquire()
+    threads = []
+    for name, priority in (("bg1", bulkheads.PRIORITY_BACKGROUND), ("user1", bulkheads.PRIORITY_DEFAULT),
+                           ("bg2", bulkheads.PRIORITY_BACKGROUND), ("user2", bulkheads.PRIORITY_DEFAULT)):
+        t = threading.Thread(target=waiter, args=(name, priority))
+        t.start()
+        threads.append(t)
+        # Đợi waiter vào hàng để thứ tự đến là xác định
+        while bulkhead.stats()["waiting"] < len(threads):
+            time.sleep(0.001)
+    bulkhead.release()
+    for t in threads:
+        t.join(timeout=5)
+    assert order == ["user1", "user2", "bg1", "bg2"]
+    assert bulkhead.stats() == {"limit": 1, "active": 0, "waiting": 0, "queue_max": 8}
+
+
+def test_guard_holds_a_slot_per_call():
+    bulkhead = bulkheads.Bulkhead("test", limit=2)
+
+    @bulkhead.guard
+    def active():
+        return bulkhead.stats()["active"]
+
+    assert active() == 1
+    assert bulkhead.stats()["active"] == 0
@@ -0,0 +1,128 @@
+import socket
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import change_sync
+from change_sync import ChangeSync, split_payloads
+from index_queue import IndexQueue
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.executed.append(sql)
+
+    def fetchall(self):
+        return list(self.conn.rows)
+
+
+class FakeConn:
+    """Kết nối giả: rows cho truy vấn fingerprint; notify() đẩy payload và đánh thức select() qua socket."""
+
+    def __init__(self):
+        self.rows, self.executed, self.notifies, self.autocommit = [], [], [], []
+        self._pending = []
+        self._lock = threading.Lock()
+        self._reader, self._writer = socket.socketpair()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def notify(self, *payloads):
+        with self._lock:
+            self._pending += [SimpleNamespace(payload=p) for p in payloads]
+        self._writer.send(b"x")
+
+    def poll(self):
+        self._reader.setblocking(False)
+        try:
+            self._reader.recv(1024)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            self.notifies += self._pending
+            self._pending = []
+
+
+@pytest.fixture
+def conn():
+    return FakeConn()
+
+
+@pytest.fixture
+def connect(conn):
+    @contextmanager
+    def connect(autocommit=False):
+        conn.autocommit.append(autocommit)
+        yield conn
+
+    return connect
+
+
+@pytest.mark.parametrize("payloads, expected", [
+    (["B", "A", "B"], (["A", "B"], [])),
+    (["deleted:A"], ([], ["A"])),
+    # Notify sau cùng thắng: xoá rồi tạo lại là thay đổi, sửa rồi xoá là xoá
+    (["deleted:A", "A", "B", "deleted:B"], (["A"], ["B"])),
+    ([], ([], [])),
+])
+def test_split_payloads(payloads, expected):
+    assert split_payloads(payloads) == expected
+
+
+def test_first_poll_only_records_a_baseline(conn, connect):
+    calls = []
+    sync = ChangeSync("poll", connect, lambda ids, deleted: calls.append((ids, deleted)))
+    conn.rows = [("E1", "a"), ("E2", "b")]
+    sync.poll_once()
+    assert calls == [] and sync.last_sync_at is not None
+    assert conn.executed == [change_sync.CDC_FINGERPRINT_SQL]
+
+
+def test_poll_reports_changed_new_and_deleted_rows(conn, connect):
+    calls = []
+    sync = ChangeSync("poll", connect, lambda ids, deleted: calls.append((sorted(ids), deleted)))
+    conn.rows = [("E1", "a"), ("E2", "b"), ("E3", "c")]
+    sync.poll_once()
+    conn.rows = [("E1", "a"), ("E2", "b2"), ("E4", "d")]
+    sync.poll_once()
+    sync.poll_once()
+    assert calls == [(["E2", "E4"], ["E3"])]
+
+
+def test_listen_debounces_notifies_into_one_sync(conn, connect, monkeypatch):
+    monkeypatch.setattr(change_sync, "CDC_INSTALL_TRIGGERS", True)
+    calls = []
+    synced = threading.Event()
+
+    def on_changes(ids, deleted):
+        calls.append((ids, deleted))
+        synced.set()
+
+    sync = ChangeSync("notify", connect, on_changes, debounce_ms=200)
+    sync.start()
+    try:
+        conn.notify("E1", "E2")
+        conn.notify("deleted:E2", "E3", "E1")
+        assert synced.wait(5)
+    finally:
+        sync.stop()
+    assert calls == [(["E1", "E3"], ["E2"])]
+    assert conn.autocommit == [True]
+    assert conn.executed == [change_sync.CDC_TRIGGER_SQL, f"LISTEN {change_sync.CDC_CHANNEL};"]
+    assert not sync.stats()["alive"]
+
+
+def test_service_enqueues_changes_for_the_index_worker(ai_service, tmp_path, monkeypatch):
+    queue = IndexQueue(str(tmp_path / "jobs.sqlite3"), lambda q, jobs: None)
+    monkeypatch.setattr(ai_service, "index_queue", queue)
+    ai_service.sync_changed_establishments(["E1", "E2"], ["E0"])
+    assert sorted((j[0], j[1]) for j in queue.claim(10)) == [("E0", "remove"), ("E1", "add"), ("E2", "add")]
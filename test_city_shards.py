@@ -0,0 +1,93 @@
+import uuid
+
+import chromadb
+import pytest
+
+ROWS = [
+    ("E1", "Đà Nẵng", "khách sạn biển Mỹ Khê hồ bơi"),
+    ("E2", "Da Nang", "resort Sơn Trà spa hồ bơi"),
+    ("E3", "Hà Nội", "khách sạn phố cổ Hoàn Kiếm"),
+    ("E4", "TP. Hồ Chí Minh", "căn hộ quận 1 hồ bơi"),
+    ("E5", "Sài Gòn", "khách sạn Bến Thành gym"),
+    ("E6", "Atlantis", "homestay hồ bơi"),
+]
+
+
+@pytest.fixture
+def svc(ai_service):
+    return ai_service
+
+
+@pytest.fixture(scope="module")
+def client():
+    return chromadb.EphemeralClient()
+
+
+@pytest.fixture
+def store(svc, client):
+    """Cùng dữ liệu trong một ShardedVectorStore và một collection đơn để so sánh kết quả."""
+    name = f"shards_{uuid.uuid4().hex[:8]}"
+    sharded = svc.ShardedVectorStore(client, name, svc.embeddings)
+    texts = [text for _, _, text in ROWS]
+    metas = [{"id": est_id, "city": city} for est_id, city, _ in ROWS]
+    sharded.add_texts(texts, metas)
+    flat = client.create_collection(f"{name}_flat", embedding_function=None)
+    flat.add(ids=[r[0] for r in ROWS], embeddings=svc.embeddings.embed_documents(texts), metadatas=metas,
+             documents=texts)
+    return sharded, flat
+
+
+@pytest.mark.parametrize("city, shard", [
+    ("Đà Nẵng", "danang"), ("da nang", "danang"), ("TP. Hồ Chí Minh", "hochiminh"), ("Sài Gòn", "hochiminh"),
+    ("Atlantis", None), (None, None), ("", None),
+])
+def test_city_shard_canonicalises_aliases(svc, city, shard):
+    assert svc.city_shard(city) == shard
+
+
+def test_documents_are_routed_by_city(store):
+    sharded, _ = store
+    assert sharded._collection.counts() == {"danang": 2, "hanoi": 1, "hochiminh": 2, "other": 1}
+    assert sharded._collection.count() == 6
+
+
+def test_query_with_city_touches_only_its_shard(svc, store):
+    sharded, _ = store
+    vec = svc.embeddings.embed_query("hồ bơi")
+    raw = sharded._collection.query(query_embeddings=[vec], n_results=5, include=["metadatas", "distances"],
+                                    cities=["Đà Nẵng"])
+    assert sorted(m["id"] for m in raw["metadatas"][0]) == ["E1", "E2"]
+    unknown = sharded._collection.query(query_embeddings=[vec], n_results=5, include=["metadatas", "distances"],
+                                        cities=["Huế"])
+    assert unknown["ids"] == [[]]
+
+
+def test_fan_out_matches_a_single_collection(svc, store):
+    sharded, flat = store
+    vecs = [svc.embeddings.embed_query(q) for q in ("hồ bơi", "phố cổ", "gym")]
+    merged = sharded._collection.query(query_embeddings=vecs, n_results=4, include=["metadatas", "distances"],
+                                       cities=[None, "Atlantis", None])
+    expected = flat.query(query_embeddings=vecs, n_results=4, include=["metadatas", "distances"])
+    for got_metas, got_dists, want_metas, want_dists in zip(merged["metadatas"], merged["distances"],
+                                                            expected["metadatas"], expected["distances"]):
+        assert [m["id"] for m in got_metas] == [m["id"] for m in want_metas]
+        assert got_dists == pytest.approx(want_dists)
+        assert got_dists == sorted(got_dists)
+
+
+def test_get_update_delete_across_shards(store):
+    col = store[0]._collection
+    # where city định tuyến tới một shard; trong shard vẫn là bộ lọc khớp đúng của Chroma
+    assert [m["id"] for m in col.get(where={"city": "Sài Gòn"})["metadatas"]] == ["E5"]
+    assert len(col.get(limit=3)["ids"]) == 3
+    doc_ids = col.get(where={"id": {"$in": ["E1", "E3"]}}, include=["metadatas"])
+    col.update(ids=doc_ids["ids"], metadatas=[{**m, "star_rating": 5} for m in doc_ids["metadatas"]])
+    assert {m["id"]: m.get("star_rating") for m in col.get(include=["metadatas"])["metadatas"]}["E3"] == 5
+    col.delete(where={"id": {"$in": ["E1", "E6"]}})
+    assert col.counts() == {"danang": 1, "hanoi": 1, "hochiminh": 2, "other": 0}
+
+
+def test_reopening_discovers_existing_shards(svc, client, store):
+    sharded, _ = store
+    reopened = svc.ShardedCollection(client, sharded._collection.base_name)
+    assert reopened.counts() == sharded._collection.counts()
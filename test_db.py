@@ -0,0 +1,102 @@
+import pytest
+
+import db
+import deadlines
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self.conn.executed.append(sql)
+        if self.conn.fail_search_path:
+            raise RuntimeError("permission denied")
+
+
+class FakeConn:
+    def __init__(self, fail_search_path=False):
+        self.executed, self.isolation = [], None
+        self.closed = self.rolled_back = self.cancelled = False
+        self.fail_search_path = fail_search_path
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def set_isolation_level(self, level):
+        self.isolation = level
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_connect(monkeypatch):
+    made = []
+
+    def install(**kwargs):
+        def connect(**config):
+            assert config == db.DB_CONFIG
+            made.append(FakeConn(**kwargs))
+            return made[-1]
+
+        monkeypatch.setattr(db.psycopg2, "connect", connect)
+        return made
+
+    return install
+
+
+def test_connect_sets_search_path_and_closes(fake_connect):
+    made = fake_connect()
+    with db.connect() as conn:
+        assert conn.executed == ["SET search_path TO public;"] and conn.isolation is None
+    assert made[0].closed
+
+
+def test_connect_closes_when_the_body_raises(fake_connect):
+    made = fake_connect()
+    with pytest.raises(ValueError):
+        with db.connect():
+            raise ValueError("query failed")
+    assert made[0].closed
+
+
+def test_autocommit_and_search_path_failure_is_tolerated(fake_connect):
+    fake_connect(fail_search_path=True)
+    with db.connect(autocommit=True) as conn:
+        assert conn.isolation == db.psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        assert not conn.rolled_back
+    with db.connect() as conn:
+        assert conn.rolled_back
+
+
+def test_connection_is_tracked_by_the_running_stage(fake_connect):
+    made = fake_connect()
+    holder = deadlines.StageConnections()
+    token = deadlines._stage_connections.set(holder)
+    try:
+        with db.connect():
+            holder.cancel_all()
+    finally:
+        deadlines._stage_connections.reset(token)
+    assert made[0].cancelled and made[0].closed
+    with pytest.raises(deadlines.DeadlineExceeded):
+        token = deadlines._stage_connections.set(holder)
+        try:
+            with db.connect():
+                pass
+        finally:
+            deadlines._stage_connections.reset(token)
+    assert made[1].closed
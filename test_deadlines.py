@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import deadlines
+from deadlines import DeadlineExceeded, RequestBudget
+
+
+@pytest.fixture
+def budget():
+    def install(budget_ms):
+        b = RequestBudget(budget_ms)
+        tokens.append(deadlines.request_budget.set(b))
+        return b
+
+    tokens = []
+    yield install
+    for token in reversed(tokens):
+        deadlines.request_budget.reset(token)
+
+
+class FakeConn:
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def test_budget_without_deadline_never_expires():
+    b = RequestBudget(0)
+    assert b.remaining() is None
+    b.check()
+
+
+def test_budget_expires_and_reports_reason():
+    b = RequestBudget(1)
+    time.sleep(0.01)
+    with pytest.raises(DeadlineExceeded) as exc:
+        b.check()
+    assert exc.value.reason == "deadline"
+
+
+def test_cancel_keeps_first_reason():
+    b = RequestBudget(10_000)
+    b.cancel("client_disconnected")
+    b.cancel("deadline")
+    with pytest.raises(DeadlineExceeded) as exc:
+        b.check()
+    assert exc.value.reason == "client_disconnected"
+
+
+@pytest.mark.parametrize("header, deadline", [("250", True), ("abc", False), (None, False), ("0", False)])
+def test_budget_from_header(header, deadline):
+    assert (deadlines.budget_from_header(header).deadline is not None) is deadline
+
+
+def test_check_budget_counts_the_stage(budget):
+    b = budget(10_000)
+    deadlines.check_budget("op", "first")
+    b.cancel("deadline")
+    before = deadlines.DEADLINE_EVENTS.values.get(("op", "second", "deadline"), 0)
+    with pytest.raises(DeadlineExceeded):
+        deadlines.check_budget("op", "second")
+    assert deadlines.DEADLINE_EVENTS.values[("op", "second", "deadline")] == before + 1
+
+
+def test_check_budget_outside_a_request_is_a_no_op():
+    deadlines.check_budget("op", "stage")
+
+
+def test_optional_stage_runs_inline_without_deadline(budget):
+    budget(0)
+    assert deadlines.optional_stage("op", "stage", lambda: threading.current_thread().name, None) \
+        == threading.current_thread().name
+
+
+def test_optional_stage_returns_fallback_and_cancels_query(budget, monkeypatch):
+    monkeypatch.setattr(deadlines, "DEADLINE_RESERVE_MS", 0.0)
+    b = budget(100)
+    conn = FakeConn()
+    release = threading.Event()
+
+    def slow_query():
+        deadlines.track_stage_connection(conn)
+        release.wait(5)
+        return "late"
+
+    t0 = time.monotonic()
+    assert deadlines.optional_stage("op", "availability", slow_query, "fallback") == "fallback"
+    assert time.monotonic() - t0 < 1.0
+    assert conn.cancelled.wait(1)
+    assert b.skipped == ["availability"]
+    release.set()
+
+
+def test_optional_stage_skipped_when_budget_is_spent(budget):
+    b = budget(1)
+    time.sleep(0.01)
+    ran = []
+    assert deadlines.optional_stage("op", "prices", lambda: ran.append(1), {}) == {}
+    assert ran == [] and b.skipped == ["prices"]
+
+
+def test_track_stage_connection_refuses_cancelled_stage():
+    holder = deadlines.StageConnections()
+    holder.cancel_all()
+    token = deadlines._stage_connections.set(holder)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            deadlines.track_stage_connection(FakeConn())
+    finally:
+        deadlines._stage_connections.reset(token)
+
+
+def test_await_within_budget_cancels_slow_work():
+    async def scenario():
+        b = RequestBudget(50)
+        deadlines.request_budget.set(b)
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(5)
+
+        with pytest.raises(DeadlineExceeded):
+            await deadlines.await_within_budget(slow())
+        assert started.is_set()
+        return b
+
+    assert asyncio.run(scenario()).reason == "deadline"
+
+
+def test_await_within_budget_stops_on_client_disconnect(monkeypatch):
+    monkeypatch.setattr(deadlines, "DISCONNECT_POLL_S", 0.01)
+
+    class Disconnected:
+        async def is_disconnected(self):
+            return True
+
+    async def scenario():
+        b = RequestBudget(10_000)
+        deadlines.request_budget.set(b)
+        with pytest.raises(DeadlineExceeded) as exc:
+            await deadlines.await_within_budget(asyncio.sleep(5), Disconnected())
+        return exc.value.reason
+
+    assert asyncio.run(scenario()) == "client_disconnected"
+
+
+def test_await_within_budget_returns_result_in_time():
+    async def scenario():
+        deadlines.request_budget.set(RequestBudget(5_000))
+        return await deadlines.await_within_budget(asyncio.sleep(0, result=42))
+
+    assert asyncio.run(scenario()) == 42
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from embedding_batcher import BatchingEmbeddings, embed_query_batch
+
+
+class RecordingEmbedder:
+    """Vector = [độ dài, loại]; ghi lại từng lời gọi provider."""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def _embed(self, kind, texts):
+        with self._lock:
+            self.calls.append((kind, list(texts)))
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("quota exceeded")
+        return [[float(len(t)), 1.0 if kind == "query" else 0.0] for t in texts]
+
+    def embed_documents(self, texts):
+        return self._embed("document", texts)
+
+    def embed_queries(self, texts):
+        return self._embed("query", texts)
+
+    def embed_query(self, text):
+        return self._embed("query", [text])[0]
+
+
+def embed_concurrently(batcher, texts, method="embed_query"):
+    with ThreadPoolExecutor(len(texts)) as pool:
+        return list(pool.map(getattr(batcher, method), texts))
+
+
+def test_concurrent_queries_share_one_provider_call():
+    inner = RecordingEmbedder()
+    batcher = BatchingEmbeddings(inner, window_ms=100, max_batch=100)
+    texts = [f"q{i}" * (i + 1) for i in range(8)]
+    assert embed_concurrently(batcher, texts) == [[float(len(t)), 1.0] for t in texts]
+    assert len(inner.calls) == 1
+    assert sorted(inner.calls[0][1]) == sorted(texts)
+
+
+def test_duplicate_texts_are_sent_once():
+    inner = RecordingEmbedder()
+    batcher = BatchingEmbeddings(inner, window_ms=100)
+    results = embed_concurrently(batcher, ["same"] * 5)
+    assert results == [[4.0, 1.0]] * 5
+    assert [texts for _, texts in inner.calls] == [["same"]]
+
+
+def test_queries_and_documents_go_in_separate_batches():
+    inner = RecordingEmbedder()
+    batcher = BatchingEmbeddings(inner, window_ms=100)
+    with ThreadPoolExecutor(2) as pool:
+        q = pool.submit(batcher.embed_query, "query")
+        d = pool.submit(batcher.embed_documents, ["doc one", "doc two"])
+        assert q.result() == [5.0, 1.0]
+        assert d.result() == [[7.0, 0.0], [7.0, 0.0]]
+    assert sorted(kind for kind, _ in inner.calls) == ["document", "query"]
+
+
+def test_provider_batches_are_capped():
+    inner = RecordingEmbedder()
+    batcher = BatchingEmbeddings(inner, window_ms=0, max_batch=3)
+    assert len(batcher.embed_documents([str(i) for i in range(7)])) == 7
+    assert [len(texts) for _, texts in inner.calls] == [3, 3, 1]
+
+
+def test_zero_window_calls_provider_directly():
+    inner = RecordingEmbedder()
+    batcher = BatchingEmbeddings(inner, window_ms=0)
+    assert batcher.embed_query("abc") == [3.0, 1.0]
+    assert batcher._dispatcher is None
+
+
+def test_provider_error_reaches_every_caller():
+    batcher = BatchingEmbeddings(RecordingEmbedder(fail=True), window_ms=50)
+
+    def call(text):
+        with pytest.raises(RuntimeError, match="quota exceeded"):
+            batcher.embed_query(text)
+        return True
+
+    with ThreadPoolExecutor(3) as pool:
+        assert all(pool.map(call, ["a", "b", "c"]))
+
+
+def test_attributes_come_from_the_wrapped_embedder():
+    inner = RecordingEmbedder()
+    inner.collection_tag = "hashing_256"
+    assert BatchingEmbeddings(inner).collection_tag == "hashing_256"
+
+
+def test_embed_query_batch_falls_back_to_single_queries():
+    class QueryOnly:
+        def embed_documents(self, texts):
+            raise TypeError("no task_type")
+
+        def embed_query(self, text):
+            return [float(len(text))]
+
+    assert embed_query_batch(QueryOnly(), ["a", "bb"]) == [[1.0], [2.0]]
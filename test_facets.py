@@ -0,0 +1,130 @@
+import pytest
+
+from amenity_vocab import AmenityVocabulary
+from facets import FacetIndex
+
+BUCKETS = (500000, 1000000, 2000000, 3000000, 5000000)
+METAS = [
+    {"id": "A1", "city": "Đà Nẵng", "type": "HOTEL", "amenities_list": "Hồ bơi, Spa", "price_range_vnd": 800000,
+     "star_rating": 4, "max_capacity": 3},
+    # Chunk thứ hai của cùng cơ sở: chỉ đếm một lần
+    {"id": "A1", "city": "Đà Nẵng", "type": "HOTEL", "amenities_list": "Hồ bơi, Spa", "price_range_vnd": 800000,
+     "star_rating": 4, "max_capacity": 3},
+    {"id": "A2", "city": "Đà Nẵng", "type": "hotel", "amenities_list": "Hồ bơi, Gym", "price_range_vnd": "2500000",
+     "star_rating": 5, "max_capacity": 2},
+    {"id": "A3", "city": "Đà Nẵng", "type": "HOMESTAY", "amenities_list": "Wifi", "price_range_vnd": 400000},
+    {"id": "B1", "city": "Hà Nội", "type": "HOTEL", "amenities_list": "Spa", "price_range_vnd": 6000000,
+     "star_rating": 3, "max_capacity": 6},
+]
+VOCAB = AmenityVocabulary()
+
+
+def city_key(city):
+    return str(city or "").strip().lower()
+
+
+def make_index(metas, loads=None):
+    def load():
+        if loads is not None:
+            loads.append(1)
+        return list(metas)
+
+    return FacetIndex(BUCKETS, VOCAB, load, city_key, lambda meta: VOCAB.mask(meta.get("amenities_list")))
+
+
+def amenity_count(agg, amenity_id):
+    return int(agg["amenities"][VOCAB.ids.index(amenity_id)])
+
+
+def test_counts_per_city_and_type():
+    index = make_index(METAS)
+    agg = index.aggregate("Đà Nẵng")
+    assert agg["count"] == 3 and agg["types"] == {"HOTEL": 2, "HOMESTAY": 1}
+    assert agg["prices"].tolist() == [1, 1, 0, 1, 0, 0]
+    assert agg["stars"] == {4: 1, 5: 1, None: 1} and agg["capacity"] == {3: 1, 2: 1, None: 1}
+    assert [amenity_count(agg, a) for a in ("pool", "spa", "gym", "wifi")] == [2, 1, 1, 1]
+
+    hotels = index.aggregate("đà nẵng", "hotel")
+    # Phân bố loại chỉ lọc theo city
+    assert hotels["count"] == 2 and hotels["types"] == {"HOTEL": 2, "HOMESTAY": 1}
+    assert hotels["prices"].tolist() == [0, 1, 0, 1, 0, 0] and amenity_count(hotels, "wifi") == 0
+
+    everywhere = index.aggregate(None)
+    assert everywhere["count"] == 4 and everywhere["prices"].tolist() == [1, 1, 0, 1, 0, 1]
+    assert index.aggregate("Huế")["count"] == 0
+
+
+def test_summary():
+    summary = make_index(METAS).summary("Đà Nẵng", "HOTEL")
+    assert summary["count"] == 2
+    assert list(summary["amenities"].items()) == [("Hồ bơi", 2), ("Spa", 1), ("Gym", 1)]
+    assert summary["price_buckets"][1] == {"max": 1000000, "count": 1}
+    assert summary["price_buckets"][-1] == {"max": None, "count": 0}
+    assert summary["stars"] == {"4": 1, "5": 1}
+    assert summary["capacity"] == {"min": 2, "max": 3, "unknown": 0}
+    assert make_index(METAS).summary("Đà Nẵng", "HOMESTAY")["capacity"] is None
+
+
+def test_built_lazily_once_and_rebuilt_after_invalidate():
+    loads = []
+    index = make_index(METAS, loads)
+    # Chưa dựng: cập nhật tăng dần bỏ qua, lần dựng đọc trạng thái mới nhất
+    index.upsert([{"id": "X", "city": "Huế", "type": "HOTEL"}])
+    index.remove(["A1"])
+    assert index.stats() == {"built": False, "establishments": 0, "keys": 0}
+    index.aggregate(None)
+    index.summary("Đà Nẵng")
+    assert loads == [1] and index.stats() == {"built": True, "establishments": 4, "keys": 3}
+    index.invalidate()
+    assert index.aggregate(None)["count"] == 4 and loads == [1, 1]
+
+
+@pytest.mark.parametrize("change", ["upsert_new", "move_city", "edit_amenities", "remove", "remove_unknown"])
+def test_incremental_updates_match_a_rebuild(change):
+    index = make_index(METAS)
+    index.aggregate(None)
+    metas = list(METAS)
+    if change == "upsert_new":
+        new = {"id": "C1", "city": "Huế", "type": "VILLA", "amenities_list": "Gym", "price_range_vnd": 1500000}
+        index.upsert([new])
+        metas.append(new)
+    elif change == "move_city":
+        moved = {**METAS[4], "city": "Đà Nẵng"}
+        index.upsert([moved])
+        metas[4] = moved
+    elif change == "edit_amenities":
+        edited = {**METAS[2], "amenities_list": "Wifi", "max_capacity": 8}
+        index.upsert([edited, edited])
+        metas = [m for m in metas if m["id"] != "A2"] + [edited]
+    elif change == "remove":
+        index.remove(["A1", "B1"])
+        metas = [m for m in metas if m["id"] not in ("A1", "B1")]
+    else:
+        index.remove(["ZZ"])
+    rebuilt = make_index(metas)
+    for city, est_type in ((None, None), ("Đà Nẵng", None), ("Đà Nẵng", "HOTEL"), ("Hà Nội", None), ("Huế", None)):
+        assert index.summary(city, est_type) == rebuilt.summary(city, est_type)
+    assert index.stats() == rebuilt.stats()
+
+
+@pytest.fixture
+def svc(ai_service, monkeypatch):
+    monkeypatch.setattr(ai_service, "facet_index", FacetIndex(
+        BUCKETS, ai_service.AMENITY_VOCAB, lambda: METAS, ai_service.strip_accents, ai_service.meta_amenity_mask))
+    return ai_service
+
+
+@pytest.mark.parametrize("missing_key, params, expected", [
+    ("establishment_type", {"city": "Đà Nẵng"}, ["HOTEL"]),
+    ("amenities_priority", {"city": "Đà Nẵng", "establishment_type": "HOTEL", "amenities_priority": "Hồ bơi"},
+     ["Spa", "Gym"]),
+    ("travel_companion", {"city": "Đà Nẵng", "establishment_type": "HOTEL"}, ["single", "couple", "friends"]),
+    # Có cơ sở chưa rõ sức chứa → không loại lựa chọn nào
+    ("travel_companion", {"city": "Đà Nẵng"}, ["single", "couple", "family", "friends"]),
+    ("max_price", {"city": "Đà Nẵng", "establishment_type": "HOTEL"}, ["1000000", "2000000", "3000000", "5000000"]),
+    ("max_price", {"city": "Hà Nội"}, None),
+    ("amenities_priority", {"city": "Atlantis"}, ["Ho boi", "Spa", "Bai do xe", "Gym", "Buffet sang", "Gan bien"]),
+    ("duration", {"city": "Đà Nẵng"}, ["1", "2", "3", "4", "5", "6", "7"]),
+])
+def test_facet_options_only_offer_choices_with_matches(svc, missing_key, params, expected):
+    assert svc.facet_options(missing_key, params) == expected
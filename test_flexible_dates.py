@@ -0,0 +1,141 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from inventory import InventoryCalendar
+
+
+@pytest.fixture
+def svc(ai_service):
+    return ai_service
+
+
+@pytest.mark.parametrize("text, today, expected", [
+    ("cuối tuần tháng 10", date(2026, 9, 1),
+     {"date_from": "2026-10-01", "date_to": "2026-10-31", "weekend_only": True, "duration": 2}),
+    ("3 đêm tháng sau", date(2026, 9, 15), {"date_from": "2026-10-01", "date_to": "2026-10-31", "duration": 3}),
+    # Tháng đã qua → năm sau; tháng hiện tại → từ hôm nay
+    ("đi tháng 3", date(2026, 9, 15), {"date_from": "2027-03-01", "date_to": "2027-03-31"}),
+    ("tháng 9", date(2026, 9, 15), {"date_from": "2026-09-15", "date_to": "2026-09-30"}),
+    ("tháng sau", date(2026, 1, 31), {"date_from": "2026-02-01", "date_to": "2026-02-28"}),
+    ("thang toi", date(2026, 12, 20), {"date_from": "2027-01-01", "date_to": "2027-01-31"}),
+    ("tháng này 2 ngày", date(2026, 2, 10), {"date_from": "2026-02-10", "date_to": "2026-02-28", "duration": 2}),
+    # Thứ Tư → tuần sau bắt đầu thứ Hai
+    ("tuần sau", date(2026, 10, 21), {"date_from": "2026-10-26", "date_to": "2026-11-01"}),
+    ("weekend", date(2026, 10, 21),
+     {"date_from": "2026-10-21", "date_to": "2026-11-03", "weekend_only": True, "duration": 2}),
+])
+def test_infer_flexible_dates(svc, text, today, expected):
+    assert svc.infer_flexible_dates(text, today=today) == expected
+
+
+@pytest.mark.parametrize("text", [None, "", "Đà Nẵng 2 đêm", "tháng 13", "0 đêm"])
+def test_infer_flexible_dates_without_period(svc, text):
+    assert svc.infer_flexible_dates(text, today=date(2026, 9, 1)) == {}
+
+
+def test_zero_nights_is_ignored(svc):
+    assert "duration" not in svc.infer_flexible_dates("0 đêm tháng 10", today=date(2026, 9, 1))
+
+
+# Thứ Hai 05/10 → thứ Sáu 09/10, 2 đêm: lịch 05..10/10
+FLEX = {"from": date(2026, 10, 5), "to": date(2026, 10, 9), "nights": 2, "weekend": False}
+
+
+def calendar(*types, first=FLEX["from"], days=6):
+    """InventoryCalendar từ (est_id, type_id, số phòng trống từng ngày, giá từng ngày): mỗi ngày một dòng lịch."""
+    rows = [(type_id, first + timedelta(days=i), f, 0, p)
+            for _, type_id, free, prices in types for i, (f, p) in enumerate(zip(free, prices))]
+    return InventoryCalendar([(est_id, type_id, None, 1, None) for est_id, type_id, _, _ in types], rows,
+                             first, first + timedelta(days=days))
+
+
+def summary(options):
+    return [(o.check_in_date, o.check_out_date, o.min_total_price, o.units_left) for o in options]
+
+
+def test_windows_pick_cheapest_type_per_check_in(svc):
+    inventory = calendar(("A", 1, [1, 1, 1, 0, 1, 1], [100, 100, 50, 50, 200, 200]), ("A", 2, [3] * 6, [120] * 6))
+    assert summary(svc.feasible_date_windows(inventory, FLEX, None)["A"]) == [
+        ("2026-10-06", "2026-10-08", 150, 1),
+        ("2026-10-05", "2026-10-07", 200, 1),
+        # Loại 1 hết phòng đêm 08/10 → loại 2; hoà giá thì ngày sớm hơn trước
+        ("2026-10-07", "2026-10-09", 240, 3),
+    ]
+
+
+def test_sold_out_establishment_is_omitted(svc):
+    inventory = calendar(("A", 1, [1] * 6, [100] * 6), ("B", 2, [0] * 6, [100] * 6))
+    assert set(svc.feasible_date_windows(inventory, FLEX, None)) == {"A"}
+    assert svc.feasible_date_windows(calendar(), FLEX, None) == {}
+
+
+def test_weekend_only_keeps_friday_and_saturday_check_ins(svc):
+    inventory = calendar(("A", 1, [1] * 7, [100, 100, 100, 100, 300, 300, 300]), days=7)
+    flex = {**FLEX, "to": date(2026, 10, 10), "weekend": True}
+    assert summary(svc.feasible_date_windows(inventory, flex, None)["A"]) == [
+        ("2026-10-09", "2026-10-11", 600, 1),
+        ("2026-10-10", "2026-10-12", 600, 1),
+    ]
+
+
+def test_unpriced_windows_rank_after_priced(svc, monkeypatch):
+    monkeypatch.setattr(svc, "FLEX_DATE_OPTIONS", 10)
+    inventory = calendar(("C", 1, [2] * 6, [None, 10, 10, 10, 10, 10]))
+    assert summary(svc.feasible_date_windows(inventory, FLEX, None)["C"]) == [
+        ("2026-10-06", "2026-10-08", 20, 2),
+        ("2026-10-07", "2026-10-09", 20, 2),
+        ("2026-10-08", "2026-10-10", 20, 2),
+        ("2026-10-09", "2026-10-11", 20, 2),
+        ("2026-10-05", "2026-10-07", None, 2),
+    ]
+
+
+def test_rows_accept_datetimes_and_ignore_days_outside_calendar(svc):
+    rows = [(1, datetime(2026, 10, 5, 0, 0), 1, 0, 100), (1, datetime(2026, 10, 6), 1, 0, 100),
+            (1, date(2026, 10, 4), 0, 0, 1), (1, date(2026, 10, 20), 0, 0, 1)]
+    inventory = InventoryCalendar([("A", 1, None, 1, 100)], rows, FLEX["from"], date(2026, 10, 7))
+    assert summary(svc.feasible_date_windows(inventory, FLEX, None)["A"]) == [("2026-10-05", "2026-10-07", 200, 1)]
+
+
+def test_days_without_rows_use_type_stock_and_base_price(svc):
+    # Phòng đôi 2 phòng giá 500, chỉ có dòng lịch ngày 06/10 (hết phòng) và 08/10 (giá 400);
+    # suite 4 khách giá 900, không giới hạn số phòng
+    types = [("A", 1, 2, 2, 500), ("A", 2, 4, None, 900)]
+    rows = [(1, date(2026, 10, 6), None, 2, None), (1, date(2026, 10, 8), 3, 1, 400)]
+    inventory = InventoryCalendar(types, rows, FLEX["from"], date(2026, 10, 11))
+    assert summary(svc.feasible_date_windows(inventory, FLEX, 2)["A"]) == [
+        ("2026-10-07", "2026-10-09", 900, 2),
+        ("2026-10-08", "2026-10-10", 900, 2),
+        ("2026-10-09", "2026-10-11", 1000, 2),
+    ]
+    # Không giới hạn số phòng → units_left None
+    assert summary(svc.feasible_date_windows(inventory, FLEX, 4)["A"])[0] == ("2026-10-05", "2026-10-07", 1800, None)
+    assert svc.feasible_date_windows(inventory, FLEX, 5) == {}
+
+
+def test_establishment_without_inventory_is_kept_without_date_options(svc, monkeypatch):
+    types = [("A", 1, None, 1, 100), ("B", 2, None, 1, 100)]
+    rows = [(2, date(2026, 10, 5) + timedelta(days=i), 1, 1, None) for i in range(6)]
+    calls = []
+
+    def fetch_inventory(est_ids, first, last):
+        calls.append((est_ids, first, last))
+        return InventoryCalendar([t for t in types if t[0] in est_ids], rows, first, last)
+
+    monkeypatch.setattr(svc, "fetch_inventory", fetch_inventory)
+    plan = {"flex": FLEX, "num_guests": 2}
+    options = svc.flexible_date_options(plan, ["A", "B", "C"])
+    assert calls == [(["A", "B", "C"], date(2026, 10, 5), date(2026, 10, 11))]
+    # A: không có dòng lịch → tồn mặc định; B: hết phòng mọi ngày → bỏ; C: chưa có loại phòng → giữ, không gợi ý ngày
+    assert set(options) == {"A", "C"} and options["C"] is None
+    assert summary(options["A"])[0] == ("2026-10-05", "2026-10-07", 200, 1)
+
+    plan = svc.prepare_search({"date_from": "2026-10-05", "date_to": "2026-10-09", "duration": 2,
+                               "travel_companion": "couple"})
+    results = svc.finalize_search(plan, False, {"A": 0.1, "B": 0.2, "C": 0.3}, {}, {})
+    assert [(r.establishment_id, r.date_options is None) for r in results] == [("A", False), ("C", True)]
+
+    monkeypatch.setattr(svc, "fetch_inventory", lambda *a: None)
+    assert svc.flexible_date_options(plan, ["A"]) is None
+    assert [r.establishment_id for r in svc.finalize_search(plan, False, {"A": 0.1, "B": 0.2}, {}, {})] == ["A", "B"]
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+import index_queue
+from index_queue import IndexQueue
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(process=lambda queue, jobs: queue.complete(jobs), **kwargs):
+        queues.append(IndexQueue(str(tmp_path / f"q{len(queues)}.sqlite3"), process, **kwargs))
+        return queues[-1]
+
+    yield make
+    for q in queues:
+        q.stop()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(index_queue.time, "time", lambda: now[0])
+    return now
+
+
+def test_repeated_updates_coalesce_into_one_job(make_queue):
+    q = make_queue()
+    assert q.enqueue("E1", "add") is False
+    assert q.enqueue("E1", "add") is True
+    assert q.enqueue("E1", "remove") is True
+    assert q.claim(10) == [("E1", "remove", 3)]
+
+
+def test_complete_keeps_a_job_updated_while_processing(make_queue):
+    q = make_queue()
+    q.enqueue("E1", "add")
+    q.enqueue("E2", "add")
+    jobs = q.claim(10)
+    q.enqueue("E1", "add")
+    q.complete(jobs)
+    assert q.claim(10) == [("E1", "add", 2)]
+
+
+def test_failed_job_backs_off_and_stops_after_max_attempts(make_queue, clock):
+    q = make_queue(max_attempts=2)
+    q.enqueue("E1", "add")
+    q.fail(q.claim(10), "boom")
+    assert q.claim(10) == []
+    clock[0] += 2
+    jobs = q.claim(10)
+    assert jobs == [("E1", "add", 1)]
+    q.fail(jobs, "boom")
+    clock[0] += 3600
+    assert q.claim(10) == []
+    assert q.stats()["failed"] == 1 and q.stats()["depth"] == 0
+    # Cập nhật mới cho ID đó đặt lại số lần thử
+    q.enqueue("E1", "add")
+    assert q.claim(10) == [("E1", "add", 2)]
+
+
+def test_stats_report_depth_and_lag(make_queue, clock):
+    q = make_queue()
+    assert q.stats() == {"depth": 0, "lag_seconds": 0.0, "failed": 0, "worker_alive": False}
+    q.enqueue("E1", "add")
+    clock[0] += 7.5
+    q.enqueue("E2", "remove")
+    assert q.stats()["depth"] == 2 and q.stats()["lag_seconds"] == 7.5
+
+
+def test_worker_batches_a_burst_of_jobs(make_queue):
+    batches = []
+    done = threading.Event()
+
+    def process(queue, jobs):
+        batches.append(sorted(j[0] for j in jobs))
+        queue.complete(jobs)
+        if queue.stats()["depth"] == 0:
+            done.set()
+
+    q = make_queue(process, window_ms=200)
+    for i in range(5):
+        q.enqueue(f"E{i}", "add")
+    q.start()
+    assert done.wait(5)
+    assert batches == [["E0", "E1", "E2", "E3", "E4"]]
+
+
+def test_worker_retries_a_failed_batch_job_by_job(make_queue):
+    calls = []
+    settled = threading.Event()
+
+    def process(queue, jobs):
+        calls.append([j[0] for j in jobs])
+        if "BAD" in calls[-1]:
+            if len(jobs) == 1:
+                settled.set()
+            raise RuntimeError("embedding failed")
+        queue.complete(jobs)
+
+    q = make_queue(process, window_ms=0)
+    q.enqueue("OK", "add")
+    q.enqueue("BAD", "add")
+    q.start()
+    assert settled.wait(5)
+    # Job lỗi bị lùi lịch: không còn job nào tới hạn
+    deadline = time.monotonic() + 5
+    while q.claim(10) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert calls[:3] == [["OK", "BAD"], ["OK"], ["BAD"]]
+    assert q.claim(10) == []
+    assert q.stats()["depth"] == 1
@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import pytest
+
+import inventory
+from inventory import InventoryCalendar, stay_nights
+
+# E1: phòng đôi 2 phòng (không có dòng lịch ngày 06), suite 4 khách không giới hạn số phòng
+# E2: một loại phòng 2 khách, hết phòng ngày 06; E3: không có loại phòng đang hoạt động
+TYPES = [
+    ("E1", 11, 2, 2, 500000), ("E1", 12, 4, None, 1500000),
+    ("E2", 21, 2, 1, 800000),
+]
+ROWS = [
+    (11, date(2026, 10, 5), None, 2, None),
+    (11, date(2026, 10, 7), 3, 1, 650000),
+    (21, date(2026, 10, 6), 1, 1, None),
+    # Ngoài khoảng và loại phòng lạ: bỏ qua
+    (11, date(2026, 11, 1), 1, 1, None), (99, date(2026, 10, 5), 0, 0, None),
+]
+FIRST, LAST = date(2026, 10, 5), date(2026, 10, 9)
+
+
+@pytest.fixture
+def calendar():
+    return InventoryCalendar(TYPES, ROWS, FIRST, LAST)
+
+
+def test_missing_rows_fall_back_to_type_stock(calendar):
+    # Dòng có total_units NULL dùng total_units của loại phòng; ngày không có dòng giữ tồn mặc định
+    assert calendar.avail[:, 0].tolist() == [0, 2, 2, 2]
+    assert calendar.avail[:, 1].tolist() == [inventory.UNLIMITED] * 4
+    assert calendar.price[:, 0].tolist() == [500000, 500000, 650000, 500000]
+
+
+@pytest.mark.parametrize("est_id, guests, start, end, expected", [
+    ("E1", 2, date(2026, 10, 6), date(2026, 10, 8), True),
+    ("E1", 2, date(2026, 10, 5), date(2026, 10, 6), True),   # phòng đôi hết, suite vẫn đủ 2 khách
+    ("E1", 4, date(2026, 10, 5), date(2026, 10, 9), True),
+    ("E1", 5, None, None, False),                            # không loại nào đủ sức chứa
+    ("E1", 3, None, None, True),
+    ("E2", 2, date(2026, 10, 5), date(2026, 10, 7), False),  # hết phòng đêm 06
+    ("E2", 2, date(2026, 10, 7), date(2026, 10, 9), True),
+    ("E2", 2, datetime(2026, 10, 7), datetime(2026, 10, 7), True),  # trả phòng cùng ngày = một đêm
+    ("E3", 8, date(2026, 10, 5), date(2026, 10, 9), True),   # không có dữ liệu tồn phòng: không lọc
+])
+def test_stay_available(calendar, est_id, guests, start, end, expected):
+    assert calendar.stay_available(est_id, guests, start, end) is expected
+
+
+def test_stay_outside_loaded_range_is_rejected(calendar):
+    with pytest.raises(ValueError):
+        calendar.stay_available("E1", 2, date(2026, 10, 8), date(2026, 10, 10))
+
+
+def test_stay_nights():
+    assert stay_nights(datetime(2026, 10, 5, 14), date(2026, 10, 7)) == (date(2026, 10, 5), date(2026, 10, 7))
+    assert stay_nights(date(2026, 10, 5), date(2026, 10, 4)) == (date(2026, 10, 5), date(2026, 10, 6))
+    assert stay_nights(None, date(2026, 10, 5)) == (None, None)
+
+
+class FakeCursor:
+    def __init__(self, results):
+        self.results, self.executed = results, []
+
+    def execute(self, sql, args=None):
+        self.executed.append((" ".join(sql.split()), args))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    cursors = []
+
+    def install(*results, error=None):
+        @contextmanager
+        def connect():
+            if error:
+                raise error
+            cursors.append(FakeCursor(list(results)))
+            yield type("Conn", (), {"cursor": lambda self: cursors[-1]})()
+
+        monkeypatch.setattr(inventory, "connect", connect)
+        return cursors
+
+    return install
+
+
+def test_fetch_inventory_reads_types_then_rows_of_the_range(fake_db):
+    cursors = fake_db(TYPES, ROWS)
+    calendar = inventory.fetch_inventory(["E1", "E2", "E3"], FIRST, LAST)
+    (types_sql, types_args), (rows_sql, rows_args) = cursors[0].executed
+    assert "FROM unit_type" in types_sql and types_args == (["E1", "E2", "E3"],)
+    assert "FROM unit_availability" in rows_sql and rows_args == ([11, 12, 21], FIRST, LAST)
+    assert not calendar.stay_available("E2", 2, date(2026, 10, 6), date(2026, 10, 7))
+
+
+def test_fetch_inventory_without_dates_or_types_skips_the_calendar_query(fake_db):
+    cursors = fake_db(TYPES)
+    assert inventory.fetch_inventory(["E1"], FIRST, FIRST).stay_available("E1", 4)
+    assert len(cursors[0].executed) == 1
+    cursors = fake_db([])
+    assert inventory.fetch_inventory(["E9"], FIRST, LAST).stay_available("E9", 2, FIRST, LAST)
+    assert len(cursors[-1].executed) == 1
+    assert inventory.fetch_inventory([], FIRST, LAST).stay_available("E1", 2)
+
+
+def test_fetch_inventory_returns_none_on_db_error(fake_db):
+    fake_db(error=RuntimeError("connection refused"))
+    assert inventory.fetch_inventory(["E1"], FIRST, LAST) is None
+
+
+@pytest.mark.parametrize("est_id, guests, start, end, expected", [
+    ("E1", 2, None, None, 500000),
+    ("E1", 3, None, None, 1500000),
+    # 05: phòng đôi hết → suite; 06 không có dòng lịch → giá gốc; 07 override 650000
+    ("E1", 2, date(2026, 10, 5), date(2026, 10, 6), 1500000),
+    ("E1", 2, date(2026, 10, 5), date(2026, 10, 8), 500000),
+    ("E1", 2, date(2026, 10, 7), date(2026, 10, 8), 650000),
+    ("E2", 2, date(2026, 10, 6), date(2026, 10, 7), None),
+    ("E2", 4, None, None, None),
+    ("E3", 2, None, None, None),
+])
+def test_cheapest_price(calendar, est_id, guests, start, end, expected):
+    assert calendar.cheapest_price(est_id, guests, start, end) == expected
+
+
+def test_fetch_cheapest_prices_falls_back_to_base_price(ai_service, monkeypatch):
+    ranges = []
+
+    def fetch_inventory(est_ids, first, last):
+        ranges.append((first, last))
+        return InventoryCalendar([t for t in TYPES if t[0] in est_ids], ROWS, first, last)
+
+    monkeypatch.setattr(ai_service, "fetch_inventory", fetch_inventory)
+    prices = ai_service.fetch_cheapest_prices(["E1", "E2", "E3"], datetime(2026, 10, 6), datetime(2026, 10, 8), 2)
+    assert prices == {"E1": 500000, "E2": 800000} and ranges == [(date(2026, 10, 6), date(2026, 10, 8))]
+    assert ai_service.fetch_cheapest_prices(["E1", "E2"], None, None, 4) == {"E1": 1500000}
+    monkeypatch.setattr(ai_service, "fetch_inventory", lambda *a: None)
+    assert ai_service.fetch_cheapest_prices(["E1"], None, None, 2) == {}
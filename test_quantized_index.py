@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from quantized_index import QuantizedIndex
+
+K = 10
+
+
+@pytest.fixture(scope="module")
+def catalogue():
+    """600 vector chuẩn hoá quanh 20 cụm (giống embedding thật hơn nhiễu đều) + 50 truy vấn gần các điểm."""
+    rng = np.random.default_rng(7)
+    centers = rng.normal(size=(20, 64))
+    X = centers[rng.integers(0, 20, 600)] + 0.5 * rng.normal(size=(600, 64))
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    Q = X[rng.choice(600, 50, replace=False)] + 0.05 * rng.normal(size=(50, 64))
+    ids = [f"E{i}" for i in range(600)]
+    exact = ((Q[:, None, :] - X[None]) ** 2).sum(axis=2)
+    truth = [{ids[j] for j in np.argsort(row)[:K]} for row in exact]
+    return ids, X.astype(np.float32), [{"id": i} for i in ids], Q.astype(np.float32), truth
+
+
+def recall(index, catalogue):
+    _, _, _, Q, truth = catalogue
+    results = index.search_many(Q.tolist(), K)
+    return np.mean([len(t & {m["id"] for m, _ in r}) / K for t, r in zip(truth, results)])
+
+
+def built(catalogue, *args, **kwargs):
+    ids, X, metas, _, _ = catalogue
+    index = QuantizedIndex(*args, **kwargs)
+    index.build(ids, X, metas)
+    return index
+
+
+@pytest.mark.parametrize("mode, dims, reduction", [
+    ("int8", 0, "truncate"),
+    ("int8", 32, "pca"),
+    ("binary", 0, "truncate"),
+    ("float", 16, "truncate"),
+    ("float", 16, "pca"),
+])
+def test_rerank_bounds_recall_loss(catalogue, mode, dims, reduction):
+    assert recall(built(catalogue, mode, dims, reduction, rerank_pool=50), catalogue) >= 0.98
+
+
+def test_int8_codes_alone_keep_recall(catalogue):
+    # rerank_pool = k: tập top-k chỉ do mã nén quyết định
+    assert recall(built(catalogue, "int8", rerank_pool=K), catalogue) >= 0.95
+
+
+def test_pool_covering_catalogue_is_exact(catalogue):
+    ids, X, _, Q, truth = catalogue
+    index = built(catalogue, "binary", 8, "truncate", rerank_pool=len(ids))
+    assert recall(index, catalogue) == 1.0
+    meta, dist = index.search_many([Q[0].tolist()], 1)[0][0]
+    assert dist == pytest.approx(float(((X[ids.index(meta["id"])] - Q[0]) ** 2).sum()), rel=1e-5)
+
+
+def test_floats_are_memmapped_from_disk(catalogue, tmp_path):
+    path = str(tmp_path / "floats.npy")
+    index = built(catalogue, "int8", rerank_pool=50, float_path=path)
+    assert isinstance(index._state["floats"], np.memmap)
+    assert recall(index, catalogue) >= 0.98
+
+
+@pytest.mark.parametrize("mode, dims, bytes_per_vector", [("int8", 0, 64), ("int8", 32, 32), ("binary", 0, 8)])
+def test_stats_report_compressed_size(catalogue, mode, dims, bytes_per_vector):
+    stats = built(catalogue, mode, dims, "truncate").stats()
+    assert stats["count"] == 600 and stats["bytes_per_vector"] == bytes_per_vector
+    assert stats["float32_bytes"] == 600 * 64 * 4 and not stats["stale"]
+
+
+def test_invalidate_rebuilds_from_loader(catalogue):
+    ids, X, metas, Q, _ = catalogue
+    source = {"n": 100}
+    index = QuantizedIndex("int8", loader=lambda: (ids[:source["n"]], X[:source["n"]], metas[:source["n"]]))
+    assert index.stats()["stale"]
+    index.search_many([Q[0].tolist()], K)
+    assert index.stats()["count"] == 100
+    source["n"] = 600
+    index.search_many([Q[0].tolist()], K)
+    assert index.stats()["count"] == 100
+    index.invalidate()
+    index.search_many([Q[0].tolist()], K)
+    assert index.stats()["count"] == 600
+
+
+def test_stale_index_without_loader_raises():
+    with pytest.raises(RuntimeError):
+        QuantizedIndex("int8").search_many([[0.0, 1.0]], K)
@@ -0,0 +1,55 @@
+import pytest
+
+
+@pytest.fixture
+def store_cls(ai_service):
+    return ai_service.SessionStore
+
+
+def test_get_returns_copy_of_saved_params(store_cls):
+    store = store_cls(max_items=10, ttl_s=60)
+    store.put("s1", {"city": "Đà Nẵng"})
+    got = store.get("s1")
+    got["city"] = "Hà Nội"
+    assert store.get("s1") == {"city": "Đà Nẵng"}
+    assert store.get("missing") is None
+
+
+def test_lru_evicts_least_recently_used(store_cls):
+    store = store_cls(max_items=2, ttl_s=60)
+    store.put("a", {"n": 1})
+    store.put("b", {"n": 2})
+    store.get("a")  # a mới dùng → b bị đẩy ra
+    store.put("c", {"n": 3})
+    assert store.get("b") is None
+    assert store.get("a") == {"n": 1}
+    assert store.get("c") == {"n": 3}
+    assert store.stats()["evictions"] == 1
+
+
+def test_expired_session_is_dropped(store_cls, monkeypatch, ai_service):
+    now = [1000.0]
+    monkeypatch.setattr(ai_service.time, "time", lambda: now[0])
+    store = store_cls(max_items=10, ttl_s=60)
+    store.put("s1", {"duration": 2})
+    now[0] += 61
+    assert store.get("s1") is None
+    assert store.stats()["in_memory"] == 0
+
+
+def test_sqlite_store_survives_restart(store_cls, tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store_cls(max_items=10, ttl_s=60, path=path).put("s1", {"city": "Huế", "num_guests": 2})
+    # Tiến trình mới: RAM trống, đọc lại từ SQLite
+    restarted = store_cls(max_items=10, ttl_s=60, path=path)
+    assert restarted.get("s1") == {"city": "Huế", "num_guests": 2}
+    assert restarted.stats() == {"in_memory": 1, "max": 10, "evictions": 0, "persistent": True}
+
+
+def test_sqlite_store_ignores_expired_rows(store_cls, tmp_path, monkeypatch, ai_service):
+    path = str(tmp_path / "sessions.sqlite3")
+    now = [1000.0]
+    monkeypatch.setattr(ai_service.time, "time", lambda: now[0])
+    store_cls(max_items=10, ttl_s=60, path=path).put("s1", {"city": "Huế"})
+    now[0] += 120
+    assert store_cls(max_items=10, ttl_s=60, path=path).get("s1") is None
@@ -0,0 +1,61 @@
+import pytest
+
+
+@pytest.fixture
+def svc(ai_service):
+    return ai_service
+
+
+@pytest.fixture
+def plan(svc):
+    return svc.prepare_search({"city": "Đà Nẵng", "establishment_type": "HOTEL", "amenities_priority": "Hồ bơi"})
+
+
+@pytest.mark.parametrize("header, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", W/"abc" , "y"', True),
+    ("*", True),
+    (' * ', True),
+    ('"abd"', False),
+    ('abc', False),
+    ("", False),
+    (None, False),
+])
+def test_etag_matches(svc, header, expected):
+    assert svc.etag_matches(header, '"abc"') is expected
+
+
+def test_no_etag_never_matches(svc):
+    assert not svc.etag_matches("*", None)
+    assert not svc.etag_matches('"abc"', None)
+
+
+def test_etag_tracks_index_epoch_and_plan(svc, plan):
+    etag = svc.search_etag(plan, False, 3)
+    assert etag.startswith(f'"{svc.INDEX_BOOT_ID}-3-') and etag.endswith('"')
+    assert svc.search_etag(dict(plan), False, 3) == etag
+    assert svc.search_etag(plan, False, 4) != etag
+    assert svc.search_etag({**plan, "type": "RESTAURANT"}, False, 3) != etag
+
+
+def test_inventory_dependent_etag_expires_with_ttl(svc, plan, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(svc.time, "time", lambda: now[0])
+    monkeypatch.setattr(svc, "RAG_INVENTORY_TTL_S", 60.0)
+    guests = {**plan, "num_guests": 2}
+    etag = svc.search_etag(guests, False, 1)
+    assert svc.search_etag(guests, False, 1) == etag
+    # Không phụ thuộc phòng trống → không đổi theo thời gian
+    static = svc.search_etag(plan, False, 1)
+    now[0] += 60
+    assert svc.search_etag(guests, False, 1) != etag
+    assert svc.search_etag(plan, True, 1) != svc.search_etag(plan, False, 1)
+    assert svc.search_etag(plan, False, 1) == static
+
+
+def test_inventory_dependent_search_has_no_etag_without_ttl(svc, plan, monkeypatch):
+    monkeypatch.setattr(svc, "RAG_INVENTORY_TTL_S", 0.0)
+    assert svc.search_etag({**plan, "num_guests": 2}, False, 1) is None
+    assert svc.search_etag(plan, True, 1) is None
+    assert svc.search_etag(plan, False, 1) is not None
@@ -0,0 +1,113 @@
+import uuid
+from datetime import date
+
+import chromadb
+import pytest
+from langchain_chroma import Chroma
+
+from inventory import InventoryCalendar
+from search_planner import CatalogStats, choose_search_plan
+
+# (id, city, type, mô tả)
+ESTABLISHMENTS = [
+    ("E1", "Đà Nẵng", "HOTEL", "khách sạn biển Mỹ Khê hồ bơi"),
+    ("E2", "Đà Nẵng", "HOTEL", "khách sạn Sơn Trà hồ bơi spa"),
+    ("E3", "Đà Nẵng", "HOMESTAY", "homestay gần cầu Rồng hồ bơi"),
+    ("E4", "Đà Nẵng", "HOTEL", "khách sạn trung tâm hồ bơi gym"),
+    ("E5", "Đà Nẵng", "HOTEL", "khách sạn ven sông Hàn hồ bơi"),
+    ("E6", "Hà Nội", "HOTEL", "khách sạn phố cổ hồ bơi"),
+]
+# E1: còn phòng; E2: phòng đôi không có dòng lịch (dùng total_units); E3: không có loại phòng (không lọc);
+# E4: hết phòng đêm 06/10; E5: chỉ có phòng 2 khách
+TYPES = [
+    ("E1", 11, 4, 3, 900000),
+    ("E2", 21, 4, 2, 700000),
+    ("E4", 41, 4, 1, 600000),
+    ("E5", 51, 2, 5, 500000),
+    ("E6", 61, 4, 1, 400000),
+]
+ROWS = [
+    (11, date(2026, 10, 5), 3, 1, None),
+    (41, date(2026, 10, 6), 1, 1, None),
+]
+
+
+@pytest.fixture
+def svc(ai_service, monkeypatch):
+    """Index nhỏ trong Chroma tạm + Postgres giả: cơ sở theo city/type và tồn phòng từ TYPES/ROWS."""
+    store = Chroma(collection_name=f"planner_{uuid.uuid4().hex[:8]}", embedding_function=ai_service.embeddings,
+                   client=chromadb.EphemeralClient())
+    store.add_texts([text for *_, text in ESTABLISHMENTS],
+                    [{"id": est_id, "name": est_id, "city": city, "type": est_type, "amenities_list": "Hồ bơi"}
+                     for est_id, city, est_type, _ in ESTABLISHMENTS])
+    monkeypatch.setattr(ai_service, "vectorstore", store)
+    monkeypatch.setattr(ai_service, "quantized_index", None)
+    monkeypatch.setattr(ai_service, "catalog_stats", CatalogStats(
+        0, 30, ai_service.load_index_metadatas, ai_service.strip_accents))
+
+    def eligible(cities, est_type, limit):
+        return [est_id for est_id, city, t, _ in ESTABLISHMENTS
+                if city in cities and (not est_type or t == est_type.upper())][:limit]
+
+    def fetch_inventory(est_ids, first, last):
+        return InventoryCalendar([t for t in TYPES if t[0] in est_ids], ROWS, first, last)
+
+    monkeypatch.setattr(ai_service, "fetch_eligible_establishment_ids", eligible)
+    monkeypatch.setattr(ai_service, "fetch_inventory", fetch_inventory)
+    return ai_service
+
+
+def kept_ids(svc, params, mode, monkeypatch):
+    monkeypatch.setattr(svc, "SEARCH_PLANNER_MODE", mode)
+    plan = svc.prepare_search(params)
+    best_by_id, _, capacity_ok = svc.execute_search(plan, "test")
+    return sorted(eid for eid in best_by_id
+                  if capacity_ok.get((eid, plan["num_guests"], plan["start_dt"], plan["end_dt"]), True))
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({"city": "Đà Nẵng", "travel_companion": "couple", "check_in_date": "2026-10-05",
+      "check_out_date": "2026-10-08"}, ["E1", "E2", "E3", "E5"]),
+    ({"city": "Đà Nẵng", "travel_companion": "family", "check_in_date": "2026-10-07", "duration": "2"},
+     ["E1", "E2", "E3", "E4"]),
+    ({"city": "Đà Nẵng", "travel_companion": "family"}, ["E1", "E2", "E3", "E4"]),
+    ({"city": "Đà Nẵng", "establishment_type": "hotel", "travel_companion": "friends",
+      "check_in_date": "2026-10-06", "check_out_date": "2026-10-07"}, ["E1", "E2"]),
+    ({"city": "Đà Nẵng", "check_in_date": "2026-10-06"}, ["E1", "E2", "E3", "E4", "E5"]),
+])
+def test_sql_first_and_vector_first_keep_the_same_establishments(svc, monkeypatch, params, expected):
+    params = {"amenities_priority": "hồ bơi", **params}
+    assert kept_ids(svc, params, "sql", monkeypatch) == expected
+    assert kept_ids(svc, params, "vector", monkeypatch) == expected
+    assert ("sql", "forced") in svc.SEARCH_PLANS.values
+
+
+def test_availability_db_error_keeps_every_candidate_on_both_plans(svc, monkeypatch):
+    monkeypatch.setattr(svc, "fetch_inventory", lambda *a: None)
+    params = {"city": "Đà Nẵng", "amenities_priority": "hồ bơi", "travel_companion": "family",
+              "check_in_date": "2026-10-06"}
+    assert kept_ids(svc, params, "sql", monkeypatch) == kept_ids(svc, params, "vector", monkeypatch) \
+        == ["E1", "E2", "E3", "E4", "E5"]
+
+
+def test_sql_failure_falls_back_to_vector_and_cools_down(svc, monkeypatch):
+    monkeypatch.setattr(svc, "fetch_eligible_establishment_ids", lambda *a: None)
+    params = {"city": "Đà Nẵng", "amenities_priority": "hồ bơi"}
+    assert kept_ids(svc, params, "sql", monkeypatch) == ["E1", "E2", "E3", "E4", "E5"]
+    plan = svc.prepare_search(params)
+    assert choose_search_plan(plan, svc.catalog_stats, svc.SEARCH_K, "sql") == ("vector", "sql_cooldown")
+
+
+@pytest.mark.parametrize("city, est_type, search_k, expected", [
+    (None, None, 100, ("vector", "unconstrained")),
+    ("Huế", None, 100, ("vector", "no_estimate")),
+    ("Đà Nẵng", "HOTEL", 100, ("sql", "cheaper")),
+    ("Hà Nội", None, 4, ("vector", "selective_enough")),
+    ("Hà Nội", "HOTEL", 4, ("sql", "low_recall")),
+])
+def test_choose_search_plan_from_catalog_stats(svc, city, est_type, search_k, expected):
+    metas = [{"id": f"H{i}", "city": "Hà Nội", "type": "HOTEL" if i < 6 else "VILLA"} for i in range(40)]
+    metas += [{"id": est_id, "city": c, "type": t} for est_id, c, t, _ in ESTABLISHMENTS]
+    stats = CatalogStats(300, 30, lambda: metas, svc.strip_accents)
+    plan = svc.prepare_search({"city": city, "establishment_type": est_type})
+    assert choose_search_plan(plan, stats, search_k, "auto") == expected
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import COALESCED_CALLS, SingleFlight, flight_key
+
+
+def run_concurrently(n, fn):
+    with ThreadPoolExecutor(n) as pool:
+        return [f.result() for f in [pool.submit(fn) for _ in range(n)]]
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight("test_share")
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"value": 1}
+
+    results = run_concurrently(6, lambda: flight.do("k", work))
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 6
+    counts = {role: COALESCED_CALLS.values.get(("test_share", role), 0) for role in ("leader", "follower")}
+    assert counts == {"leader": 1, "follower": 5}
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight("test_keys")
+    calls = []
+    with ThreadPoolExecutor(2) as pool:
+        for key in ("a", "b"):
+            pool.submit(flight.do, key, lambda: calls.append(1) or time.sleep(0.05))
+    assert len(calls) == 2
+
+
+def test_key_is_released_after_completion():
+    flight = SingleFlight("test_release")
+    calls = []
+    assert flight.do("k", lambda: calls.append(1) or len(calls)) == 1
+    assert not flight.in_flight("k")
+    # Không phải cache: lần gọi sau chạy lại
+    assert flight.do("k", lambda: calls.append(1) or len(calls)) == 2
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight("test_error")
+
+    def boom():
+        time.sleep(0.1)
+        raise ValueError("provider down")
+
+    def call():
+        with pytest.raises(ValueError, match="provider down"):
+            flight.do("k", boom)
+        return True
+
+    assert all(run_concurrently(4, call))
+    assert not flight.in_flight("k")
+
+
+def test_copy_result_isolates_callers():
+    flight = SingleFlight("test_copy", copy_result=True)
+    results = run_concurrently(3, lambda: flight.do("k", lambda: time.sleep(0.1) or {"items": []}))
+    results[0]["items"].append("mutated")
+    assert results[1] == {"items": []} and results[2] == {"items": []}
+
+
+def test_cancelled_follower_does_not_cancel_the_leader():
+    flight = SingleFlight("test_async")
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        return "done"
+
+    async def scenario():
+        leader = asyncio.ensure_future(flight.do_async("k", work))
+        while not flight.in_flight("k"):
+            await asyncio.sleep(0.001)
+        follower = asyncio.ensure_future(flight.do_async("k", work))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        release.set()
+        return await leader, follower.cancelled()
+
+    assert asyncio.run(scenario()) == ("done", True)
+
+
+def test_flight_key_is_order_insensitive_for_dicts():
+    assert flight_key({"a": 1, "b": 2}, "x") == flight_key({"b": 2, "a": 1}, "x")
+    assert flight_key({"a": 1}, "x") != flight_key({"a": 1}, "y")
@@ -0,0 +1,86 @@
+import re
+from pathlib import Path
+
+import pytest
+
+from vn_gazetteer import PROVINCES, PlaceMatcher, alias_key, build_gazetteer, fold
+
+
+@pytest.fixture(scope="module")
+def gazetteer():
+    display, aliases, accented = build_gazetteer()
+    return display, PlaceMatcher(aliases, accented)
+
+
+def find(gazetteer, text):
+    display, matcher = gazetteer
+    canonical = matcher.find(text)
+    return display.get(canonical) if canonical else None
+
+
+def test_fold_keeps_length_and_maps_d_stroke():
+    assert fold("Đà Nẵng") == "da nang"
+    assert len(fold("Thừa Thiên Huế")) == len("Thừa Thiên Huế")
+    assert fold(None) == ""
+
+
+def test_alias_key_collapses_punctuation():
+    assert alias_key("TP. Hồ  Chí-Minh") == "tp ho chi minh"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Tôi muốn đi Đà Nẵng cuối tuần", "Đà Nẵng"),
+    ("toi muon di da nang", "Đà Nẵng"),
+    ("khách sạn ở danang", "Đà Nẵng"),
+    ("đặt phòng tại TP.HCM", "Hồ Chí Minh"),
+    ("nghỉ dưỡng Phú Quốc", "Phú Quốc"),
+])
+def test_finds_city_in_free_text(gazetteer, text, expected):
+    assert find(gazetteer, text) == expected
+
+
+def test_longest_alias_wins(gazetteer):
+    # "thua thien hue" dài hơn "hue" → tỉnh, không phải thành phố
+    assert find(gazetteer, "du lịch Thừa Thiên Huế") == "Thừa Thiên Huế"
+    assert find(gazetteer, "du lịch Huế") == "Huế"
+    assert find(gazetteer, "Bà Rịa - Vũng Tàu") == "Bà Rịa - Vũng Tàu"
+
+
+def test_matches_whole_words_only(gazetteer):
+    assert find(gazetteer, "huephong") is None
+    assert find(gazetteer, "") is None
+
+
+def test_accent_sensitive_alias_needs_exact_accents(gazetteer):
+    # "hoi an" không dấu trùng cụm từ thường gặp → giữa câu chỉ nhận "Hội An" đúng dấu
+    assert find(gazetteer, "phố cổ Hội An") == "Hội An"
+    assert find(gazetteer, "hỏi an ninh khách sạn") is None
+    assert find(gazetteer, "pho co hoi an") is None
+    assert find(gazetteer, "can hai phong gan bien") is None
+    assert find(gazetteer, "cần hai phòng ở Đà Nẵng") == "Đà Nẵng"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("hoi an", "Hội An"),
+    (" Hoi An ", "Hội An"),
+    ("di hoi an 3 dem", "Hội An"),
+    ("khach san o hai phong", "Hải Phòng"),
+    ("resort tại long an", "Long An"),
+])
+def test_plain_accent_sensitive_alias_alone_or_after_lead_word(gazetteer, text, expected):
+    assert find(gazetteer, text) == expected
+
+
+def test_every_frontend_province_resolves(gazetteer):
+    ts = Path(__file__).parent / "frontend" / "partner-portal" / "src" / "constants" / "vnProvinces.ts"
+    # "Bình Liêu" ở frontend là huyện, không phải tỉnh
+    provinces = [p for p in re.findall(r"'([^']+)'", ts.read_text(encoding="utf-8")) if p != "Bình Liêu"]
+    assert len(provinces) == len(PROVINCES) == 63
+    for province in provinces:
+        assert find(gazetteer, province) == province.replace("TP. ", ""), province
+
+
+def test_find_all_reports_spans_in_original_text():
+    matcher = PlaceMatcher({"da nang": "danang", "hue": "hue"})
+    text = "Đà Nẵng rồi Huế"
+    assert [(text[s:e], c) for s, e, c in matcher.find_all(text)] == [("Đà Nẵng", "danang"), ("Huế", "hue")]